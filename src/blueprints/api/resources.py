@@ -1,14 +1,45 @@
-from flask import request
+import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from uuid import uuid4
+
+from flask import (
+    Response,
+    current_app,
+    redirect,
+    request,
+    send_file,
+    stream_with_context,
+    url_for,
+)
 from flask.views import MethodView
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
 
 from src.utils import json_response
-from src.models import ProdutorRural, Lavoura
+from src.models import EVENTOS, ProdutorRural, Lavoura, Perda, Job
 from src.extensions.database import db
+from src.extensions.export import FORMATS, export_perdas, parse_filters
+from src.extensions.importer import InvalidFileError, import_lavouras
+from src.extensions.tiles import get_tile
+from src.extensions.spatial import get_index
+from src.extensions import analytics, ingest, jobs, snapshot
+from src.extensions.changes import ExpiredCursorError, changes_since
+from src.extensions.search import search_produtores
+from src.extensions.notifier import TooManySubscribersError
+from src.extensions.summaries import summary_payload
+from src.extensions.timeouts import apply_request_budget, timeout_response
 from src.extensions.authentication import (
     create_user,
     generate_token,
     token_required,
+    TOKEN_ENVIRON,
     AlreadyRegisteredError,
     InvalidUserError,
     IncorrectPasswordError,
@@ -96,21 +127,43 @@ class UserTokenAPI(MethodView):
 class ProdutorAPI(MethodView):
     @token_required
     def get(self, **kwargs):
+        q = request.args.get("q", None)
+        if q:
+            limit = int(current_app.config["SEARCH_LIMIT"])
+            return json_response(
+                payload={
+                    "produtores": [
+                        {
+                            "id": produtor.id,
+                            "nome": produtor.nome,
+                            "cpf": produtor.cpf,
+                            "email": produtor.email,
+                            "rank": rank,
+                            **summary_payload(produtor.resumo_perdas),
+                        }
+                        for produtor, rank in search_produtores(q, limit)
+                    ]
+                }
+            )
+
         cpf = request.args.get("cpf", None)
+        produtores = ProdutorRural.query.options(
+            joinedload(ProdutorRural.resumo_perdas)
+        )
         if cpf:
-            produtores = ProdutorRural.query.filter(
+            produtores = produtores.filter(
                 ProdutorRural.cpf.like("%" + cpf + "%")
-            ).all()
-        else:
-            produtores = ProdutorRural.query.all()
+            )
 
         return json_response(
             payload={
                 "produtores": [
                     {
+                        "id": produtor.id,
                         "nome": produtor.nome,
                         "cpf": produtor.cpf,
                         "email": produtor.email,
+                        **summary_payload(produtor.resumo_perdas),
                     }
                     for produtor in produtores
                 ]
@@ -143,13 +196,13 @@ class ProdutorAPI(MethodView):
             )
 
         try:
-            produtor = ProdutorRural(nome=nome, email=email, cpf=cpf)
-            db.session.add(produtor)
-            db.session.commit()
+            ingest.write(ProdutorRural, nome=nome, email=email, cpf=cpf)
         except IntegrityError:
             return json_response(
                 status_code=400, message="CPF already registered"
             )
+        except ingest.IngestTimeoutError as e:
+            return json_response(status_code=503, message=str(e))
         except Exception:
             return json_response(status_code=500, message="Could not create")
 
@@ -245,11 +298,835 @@ class LavouraAPI(MethodView):
             payload={
                 "lavouras": [
                     {
+                        "id": lavoura.id,
                         "latitude": lavoura.latitude,
                         "longitude": lavoura.longitude,
                         "tipo": lavoura.tipo,
+                        **summary_payload(lavoura.resumo_perdas),
                     }
-                    for lavoura in Lavoura.query.all()
+                    for lavoura in Lavoura.query.options(
+                        joinedload(Lavoura.resumo_perdas)
+                    )
                 ]
             }
         )
+
+
+class LavouraTileAPI(MethodView):
+    @token_required
+    def get(self, z, x, y, **kwargs):
+        """Returns the pre-aggregated crop and loss clusters of a map tile"""
+        max_zoom = int(current_app.config["TILE_MAX_ZOOM"])
+        if z > max_zoom:
+            return json_response(
+                status_code=400,
+                message=f"Zoom level must be at most {max_zoom}",
+            )
+        if x >= 2**z or y >= 2**z:
+            return json_response(
+                status_code=404, message=f"Tile {z}/{x}/{y} does not exist"
+            )
+
+        return json_response(
+            payload={"z": z, "x": x, "y": y, "clusters": get_tile(z, x, y)}
+        )
+
+
+class LavouraImportAPI(MethodView):
+    @token_required
+    def post(self, **kwargs):
+        """Bulk imports crop plots from a CSV file
+
+        The file can be sent as the `file` field of a multipart form or as
+        the raw request body
+        """
+        owner = kwargs["token_information"]["username"]
+        upload = request.files.get("file", None)
+        if upload is None:
+            if not request.content_length:
+                return json_response(
+                    status_code=400, message="You must provide a CSV file"
+                )
+            return _import_lavouras_csv(request.stream, owner)
+
+        # Uploads are SpooledTemporaryFiles, which TextIOWrapper can not
+        # wrap before Python 3.11 (they have no readable())
+        with tempfile.TemporaryFile() as stream:
+            upload.save(stream)
+            stream.seek(0)
+            return _import_lavouras_csv(stream, owner)
+
+
+def _import_lavouras_csv(stream, owner: str):
+    """Imports a CSV stream of crops, or queues it with ?async=1
+
+    Parameters
+    ----------
+    stream : io.RawIOBase
+        The CSV file, as bytes
+    owner : str
+        The username of who sent it
+    """
+    if _is_async():
+        path = jobs.storage_path(f"upload-{uuid4().hex}.csv")
+        with open(path, "wb") as file:
+            shutil.copyfileobj(stream, file)
+        job = jobs.enqueue("import_lavouras", {"path": path}, owner=owner)
+        return json_response(status_code=202, payload=jobs.job_payload(job))
+
+    try:
+        result = import_lavouras(
+            io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+        )
+    except InvalidFileError as e:
+        return json_response(status_code=400, message=str(e))
+    except UnicodeDecodeError:
+        return json_response(
+            status_code=400, message="The CSV file must be UTF-8"
+        )
+
+    return json_response(status_code=201, payload=result)
+
+
+class PerdaAPI(MethodView):
+    @token_required
+    def post(self, **kwargs):
+        """Registers a loss
+
+        Body: `data` (YYYY-MM-DD), `evento` (code), `produtor_rural_id`
+        and `lavoura_id`
+        """
+        body = request.get_json()
+        if body is None:
+            return json_response(
+                status_code=400, message="You must provide a json body"
+            )
+
+        for field in ("data", "evento", "produtor_rural_id", "lavoura_id"):
+            if body.get(field) is None:
+                return json_response(
+                    status_code=400,
+                    message=f"Field '{field}' must not be empty",
+                )
+        try:
+            data = date.fromisoformat(body["data"])
+        except (TypeError, ValueError):
+            return json_response(
+                status_code=400, message="Field 'data' must be YYYY-MM-DD"
+            )
+        # Not isinstance: JSON true and false are bools, which are ints
+        if type(body["evento"]) is not int or body["evento"] not in EVENTOS:
+            return json_response(
+                status_code=400,
+                message=f"Field 'evento' must be one of {list(EVENTOS)}",
+            )
+        if not all(
+            type(body[field]) is int
+            for field in ("produtor_rural_id", "lavoura_id")
+        ):
+            return json_response(
+                status_code=400,
+                message=(
+                    "Fields 'produtor_rural_id' and 'lavoura_id' must be"
+                    " integers"
+                ),
+            )
+
+        try:
+            perda_id = ingest.write(
+                Perda,
+                data=data,
+                evento=body["evento"],
+                produtor_rural_id=body["produtor_rural_id"],
+                lavoura_id=body["lavoura_id"],
+            )
+        except IntegrityError:
+            return json_response(
+                status_code=400, message="Unknown producer or crop"
+            )
+        except ingest.IngestTimeoutError as e:
+            return json_response(status_code=503, message=str(e))
+        except Exception:
+            return json_response(status_code=500, message="Could not create")
+
+        return json_response(201, payload={"id": perda_id})
+
+
+class PerdaExportAPI(MethodView):
+    @token_required
+    def get(self, **kwargs):
+        """Streams the loss history joined with producers and crops
+
+        Query string: `format` (csv, parquet or arrow), `inicio`, `fim`
+        and `evento`
+        """
+        file_format = request.args.get("format", "csv")
+        if file_format not in FORMATS:
+            return json_response(
+                status_code=400,
+                message="Field 'format' must be one of " + ", ".join(FORMATS),
+            )
+
+        try:
+            filters = parse_filters(
+                inicio=request.args.get("inicio", None),
+                fim=request.args.get("fim", None),
+                evento=request.args.get("evento", None),
+            )
+        except ValueError as e:
+            return json_response(status_code=400, message=str(e))
+
+        if _is_async():
+            job = jobs.enqueue(
+                "export_perdas",
+                {
+                    "format": file_format,
+                    "inicio": request.args.get("inicio", None),
+                    "fim": request.args.get("fim", None),
+                    "evento": request.args.get("evento", None),
+                },
+                owner=kwargs["token_information"]["username"],
+            )
+            return json_response(
+                status_code=202, payload=jobs.job_payload(job)
+            )
+
+        mimetype, extension = FORMATS[file_format]
+        return Response(
+            stream_with_context(export_perdas(format=file_format, **filters)),
+            mimetype=mimetype,
+            headers={
+                "Content-Disposition": (
+                    f"attachment; filename=perdas.{extension}"
+                )
+            },
+        )
+
+
+class PerdaVizinhosAPI(MethodView):
+    @token_required
+    def get(self, perda_id, **kwargs):
+        """Finds the crops near a loss and their losses around its date
+
+        Query string: `raio` (km) and `dias` (the window is the loss date
+        plus or minus `dias`)
+        """
+        try:
+            raio = float(
+                request.args.get(
+                    "raio", current_app.config["SPATIAL_DEFAULT_RADIUS_KM"]
+                )
+            )
+            dias = int(
+                request.args.get(
+                    "dias", current_app.config["SPATIAL_DEFAULT_DAYS"]
+                )
+            )
+        except ValueError:
+            return json_response(
+                status_code=400,
+                message="Fields 'raio' and 'dias' must be numbers",
+            )
+        max_raio = float(current_app.config["SPATIAL_MAX_RADIUS_KM"])
+        if not 0 < raio <= max_raio or dias < 0:
+            return json_response(
+                status_code=400,
+                message=(
+                    f"Field 'raio' must be between 0 and {max_raio} and"
+                    " field 'dias' must not be negative"
+                ),
+            )
+
+        perda = Perda.query.get(perda_id)
+        if not perda:
+            return json_response(
+                status_code=404,
+                message=f"Perda with id {perda_id} was not found",
+            )
+
+        index = get_index()
+        lavoura_ids, distances = index.lavouras_within(
+            perda.lavoura.latitude, perda.lavoura.longitude, raio
+        )
+        day = perda.data.toordinal()
+        perdas = index.perdas_between(lavoura_ids, day - dias, day + dias)
+
+        vizinhas = {
+            lavoura_id: {
+                "id": lavoura_id,
+                "distancia_km": round(distance, 3),
+                "perdas": [],
+            }
+            for lavoura_id, distance in zip(
+                lavoura_ids.tolist(), distances.tolist()
+            )
+            if lavoura_id != perda.lavoura_id
+        }
+        for (
+            other_id,
+            ordinal,
+            evento,
+            lavoura_id,
+            produtor_id,
+        ) in perdas.tolist():
+            if other_id != perda.id and lavoura_id in vizinhas:
+                vizinhas[lavoura_id]["perdas"].append(
+                    {
+                        "id": other_id,
+                        "data": date.fromordinal(ordinal).isoformat(),
+                        "evento": EVENTOS.get(evento, evento),
+                        "produtor_rural_id": produtor_id,
+                    }
+                )
+
+        return json_response(
+            payload={
+                "perda": {
+                    "id": perda.id,
+                    "data": perda.data.isoformat(),
+                    "evento": EVENTOS.get(perda.evento, perda.evento),
+                    "lavoura_id": perda.lavoura_id,
+                },
+                "lavouras": list(vizinhas.values()),
+            }
+        )
+
+
+class PerdaAnalyticsAPI(MethodView):
+    @token_required
+    def get(self, **kwargs):
+        """Counts losses per group
+
+        Query string: `agrupar` (comma separated evento, tipo, celula, mes
+        and/or ano), the filters `inicio`, `fim`, `evento` and `tipo`,
+        `celula` (grid cell size in degrees) and `percentis` (comma
+        separated percentiles of the losses per crop)
+        """
+        try:
+            params = analytics.parse_params(
+                **{
+                    name: request.args.get(name)
+                    for name in (
+                        "agrupar",
+                        "inicio",
+                        "fim",
+                        "evento",
+                        "tipo",
+                        "celula",
+                        "percentis",
+                    )
+                }
+            )
+            payload = analytics.perda_statistics(**params)
+        except ValueError as e:
+            return json_response(status_code=400, message=str(e))
+        return json_response(payload=payload)
+
+
+def _user_job(job_id: int, token_information: dict) -> Job:
+    """Returns a job of the requesting user
+
+    Jobs of other users are reported as missing, so their ids leak
+    nothing
+    """
+    job = Job.query.get(job_id)
+    if job is None or job.owner != token_information.get("username"):
+        return None
+    return job
+
+
+class JobAPI(MethodView):
+    @token_required
+    def get(self, job_id, **kwargs):
+        """Returns the status and progress of a background job"""
+        job = _user_job(job_id, kwargs["token_information"])
+        if not job:
+            return json_response(
+                status_code=404, message=f"Job {job_id} was not found"
+            )
+        return json_response(payload=jobs.job_payload(job))
+
+    @token_required
+    def delete(self, job_id, **kwargs):
+        """Cancels a queued job or asks a running one to stop"""
+        job = _user_job(job_id, kwargs["token_information"])
+        if not job:
+            return json_response(
+                status_code=404, message=f"Job {job_id} was not found"
+            )
+        if not jobs.cancel(job):
+            return json_response(
+                status_code=409, message=f"Job {job_id} has already finished"
+            )
+        return json_response(payload=jobs.job_payload(Job.query.get(job_id)))
+
+
+class JobRetryAPI(MethodView):
+    @token_required
+    def post(self, job_id, **kwargs):
+        """Puts a failed or cancelled job back in the queue"""
+        job = _user_job(job_id, kwargs["token_information"])
+        if not job:
+            return json_response(
+                status_code=404, message=f"Job {job_id} was not found"
+            )
+        if not jobs.retry(job):
+            return json_response(
+                status_code=409,
+                message=f"Job {job_id} is not failed nor cancelled",
+            )
+        return json_response(
+            status_code=202, payload=jobs.job_payload(Job.query.get(job_id))
+        )
+
+
+class JobResultAPI(MethodView):
+    @token_required
+    def get(self, job_id, **kwargs):
+        """Downloads the file generated by a background job
+
+        Snapshot builds redirect to `/snapshot`, which serves the newest
+        snapshot
+        """
+        job = _user_job(job_id, kwargs["token_information"])
+        if (
+            job
+            and job.kind == "build_snapshot"
+            and job.status == Job.SUCCEEDED
+        ):
+            return redirect(
+                url_for("api.snapshot_api", **request.args.to_dict()),
+                code=303,
+            )
+        result = json.loads(job.result) if job and job.result else None
+        if not result or "file" not in result:
+            return json_response(
+                status_code=404,
+                message=f"Job {job_id} has no file to download",
+            )
+
+        path = jobs.storage_path(result["file"])
+        if not os.path.exists(path):
+            return json_response(
+                status_code=410,
+                message=f"The file of job {job_id} was removed",
+            )
+        return send_file(
+            path,
+            mimetype=result.get("mimetype", None),
+            as_attachment=True,
+            attachment_filename=result.get("filename", result["file"]),
+            conditional=True,
+        )
+
+
+class SnapshotAPI(MethodView):
+    @token_required
+    def get(self, **kwargs):
+        """Downloads the offline snapshot (a gzipped SQLite database)
+
+        Supports `If-None-Match` (the ETag is the snapshot version) and
+        `Range`, so clients can skip unchanged snapshots and resume
+        interrupted downloads
+        """
+        latest = snapshot.latest_snapshot()
+        if latest is None:
+            return json_response(
+                status_code=404, message="No snapshot has been built yet"
+            )
+        path = snapshot.snapshot_path(latest["file"])
+        if not os.path.exists(path):
+            return json_response(
+                status_code=404, message="No snapshot has been built yet"
+            )
+
+        response = send_file(
+            path,
+            mimetype="application/gzip",
+            as_attachment=True,
+            attachment_filename=latest["file"],
+            add_etags=False,
+            cache_timeout=int(current_app.config["SNAPSHOT_MAX_AGE"]),
+        )
+        response.set_etag(latest["version"])
+        response.headers["Accept-Ranges"] = "bytes"
+        response.headers["X-Snapshot-Version"] = latest["version"]
+        response.headers["X-Snapshot-Cursor"] = str(latest["cursor"])
+        response.headers["X-Snapshot-Sha256"] = latest["sha256"]
+        # Private, since the request carries an access token
+        response.cache_control.public = False
+        response.cache_control.private = True
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=latest["size"]
+        )
+
+
+class ChangeAPI(MethodView):
+    @token_required
+    def get(self, **kwargs):
+        """Lists producer and crop changes after a cursor
+
+        Query string: `since`, the `cursor` of the previous page (0 for a
+        full sync), and `limit`. Once the changes after `since` are
+        pruned, the response is a 410 describing the latest snapshot,
+        whose cursor the client syncs from after downloading it
+        """
+        page_size = int(current_app.config["CHANGES_PAGE_SIZE"])
+        try:
+            since = int(request.args.get("since", 0))
+            limit = int(request.args.get("limit", page_size))
+        except ValueError:
+            return json_response(
+                status_code=400,
+                message="Fields 'since' and 'limit' must be integers",
+            )
+        if since < 0 or not 0 < limit <= page_size:
+            return json_response(
+                status_code=400,
+                message=(
+                    "Field 'since' must not be negative and field 'limit'"
+                    f" must be between 1 and {page_size}"
+                ),
+            )
+
+        try:
+            payload = changes_since(since, limit)
+        except ExpiredCursorError:
+            return json_response(
+                status_code=410,
+                message=(
+                    "Cursor expired, download the snapshot and sync again"
+                    " from its cursor"
+                ),
+                payload={"snapshot": snapshot.latest_snapshot()},
+            )
+        return json_response(payload=payload)
+
+
+class PerdaStreamAPI(MethodView):
+    @token_required
+    def get(self, **kwargs):
+        """Streams new and changed losses as Server-Sent Events
+
+        Every event is named after the operation (insert, update or
+        delete) and has the loss as JSON data. A stream holds a server
+        thread while open, so past `PERDA_STREAM_MAX_CLIENTS` streams the
+        response is a 503 with a Retry-After header
+        """
+        notifier = current_app.extensions["perda_notifier"]
+        keepalive = float(current_app.config["PERDA_STREAM_KEEPALIVE"])
+        try:
+            subscriber = notifier.subscribe()
+        except TooManySubscribersError:
+            body, status_code = json_response(
+                status_code=503,
+                message="Too many open streams, try again later",
+            )
+            return body, status_code, {"Retry-After": "30"}
+
+        def stream():
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    change = subscriber.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if change is None:
+                    return
+                yield (
+                    f"id: {change['id']}\n"
+                    f"event: {change['operation']}\n"
+                    f"data: {json.dumps(change)}\n\n"
+                )
+
+        response = Response(
+            stream(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+        # Also when the client leaves before the stream starts
+        response.call_on_close(lambda: notifier.unsubscribe(subscriber))
+        return response
+
+
+class MemoryProfileAPI(MethodView):
+    @token_required
+    def get(self, **kwargs):
+        """Returns the per-route memory profile"""
+        profiler = current_app.extensions.get("memory_profiler")
+        if profiler is None:
+            return json_response(
+                status_code=404, message="Memory profiling is disabled"
+            )
+        return json_response(payload=profiler.report())
+
+    @token_required
+    def delete(self, **kwargs):
+        """Resets the per-route memory profile"""
+        profiler = current_app.extensions.get("memory_profiler")
+        if profiler is None:
+            return json_response(
+                status_code=404, message="Memory profiling is disabled"
+            )
+        profiler.reset()
+        return json_response(message="Memory profile reset")
+
+
+class CpuProfileAPI(MethodView):
+    @token_required
+    def get(self, profile_id, **kwargs):
+        """Returns a profiled request
+
+        Query string: `format`, `json` (default) for the top functions and
+        the collapsed stacks, or `collapsed` for the stacks alone as text
+        """
+        profiler = current_app.extensions.get("cpu_profiler")
+        if profiler is None:
+            return json_response(
+                status_code=404, message="CPU profiling is disabled"
+            )
+        report = profiler.get(profile_id)
+        if report is None:
+            return json_response(
+                status_code=404, message=f"Profile {profile_id} was not found"
+            )
+        if request.args.get("format") == "collapsed":
+            return Response(report["collapsed"], mimetype="text/plain")
+        return json_response(payload=report)
+
+
+class StatementTimeoutAPI(MethodView):
+    @token_required
+    def get(self, **kwargs):
+        """Returns the per-route query budgets and the queries cancelled"""
+        timeouts = current_app.extensions["statement_timeouts"]
+        return json_response(payload=timeouts.report())
+
+
+class BatchAPI(MethodView):
+    @token_required
+    def post(self, **kwargs):
+        """Runs a list of sub-requests against the API in a single request
+
+        The token is validated once, by the batch itself. Sub-requests
+        share the batch app context, so they share its database session.
+
+        Body
+        ----
+        requests : list[dict]
+            Each one with `method`, `path` and, optionally, `query` and
+            `body`
+        atomic : bool, optional
+            Runs everything in one transaction, stopping at the first
+            failure, by default False
+        parallel : bool, optional
+            Runs the sub-requests concurrently when all of them are GET
+            requests, by default False
+        """
+        body = request.get_json()
+        if body is None:
+            return json_response(
+                status_code=400, message="You must provide a json body"
+            )
+
+        sub_requests = body.get("requests", None)
+        atomic = bool(body.get("atomic", False))
+        parallel = bool(body.get("parallel", False))
+
+        if not isinstance(sub_requests, list) or not sub_requests:
+            return json_response(
+                status_code=400,
+                message="Field 'requests' must be a non empty list",
+            )
+        max_requests = int(current_app.config["BATCH_MAX_REQUESTS"])
+        if len(sub_requests) > max_requests:
+            return json_response(
+                status_code=400,
+                message=f"A batch accepts at most {max_requests} requests",
+            )
+        for sub_request in sub_requests:
+            if not isinstance(sub_request, dict) or not sub_request.get(
+                "path"
+            ):
+                return json_response(
+                    status_code=400,
+                    message="Every request must have at least a 'path'",
+                )
+
+        read_only = all(
+            str(sub_request.get("method", "GET")).upper() == "GET"
+            for sub_request in sub_requests
+        )
+
+        if parallel and read_only and not atomic:
+            responses = _run_parallel(
+                current_app._get_current_object(),
+                sub_requests,
+                kwargs["token_information"],
+            )
+        elif atomic:
+            responses = _run_atomic(sub_requests, kwargs["token_information"])
+        else:
+            responses = []
+            for sub_request in sub_requests:
+                response = _dispatch(sub_request, kwargs["token_information"])
+                if int(response["status"]) >= 400:
+                    # Leaves the shared session usable for the next ones
+                    db.session.rollback()
+                responses.append(response)
+
+        return json_response(payload={"responses": responses})
+
+
+def _is_async() -> bool:
+    """Checks if the request asked to run as a background job"""
+    return request.args.get("async", "").lower() in ("1", "true")
+
+
+def _sub_request_error(sub_request: dict) -> str:
+    """Tells why a sub-request can not be dispatched
+
+    Returns
+    -------
+    str | None
+        None for a valid sub-request
+    """
+    path = sub_request["path"]
+    if not isinstance(sub_request.get("method", "GET"), str):
+        return "Field 'method' must be a string"
+    # Absolute (and scheme relative) URLs would be dispatched as their path
+    if (
+        not isinstance(path, str)
+        or not path.startswith("/")
+        or path.startswith("//")
+    ):
+        return "Field 'path' must be a string starting with '/'"
+    if not isinstance(sub_request.get("query", None), (dict, str, type(None))):
+        return "Field 'query' must be an object or a string"
+    return None
+
+
+def _dispatch(sub_request: dict, token_information: dict) -> dict:
+    """Runs a batch sub-request inside the current app context
+
+    Parameters
+    ----------
+    sub_request : dict
+        Must have a `path` key. `method`, `query` and `body` are optional
+    token_information : dict
+        The already decoded batch token, handed to the sub-request only
+
+    Returns
+    -------
+    dict
+        The sub-response: {"status", "body"}, a 400 for malformed
+        sub-requests
+    """
+    error = _sub_request_error(sub_request)
+    if error is not None:
+        body, status_code = json_response(
+            status_code=400,
+            message=error,
+            path=str(sub_request["path"]),
+            method=str(sub_request.get("method", "GET")),
+        )
+        return {"status": int(status_code), "body": body}
+
+    app = current_app._get_current_object()
+    path = sub_request["path"]
+    method = sub_request.get("method", "GET").upper()
+
+    with app.test_request_context(
+        path,
+        method=method,
+        query_string=sub_request.get("query", None),
+        json=sub_request.get("body", None),
+        environ_overrides={TOKEN_ENVIRON: token_information},
+    ):
+        try:
+            apply_request_budget()
+            endpoint, view_args = app.url_map.bind("").match(
+                path, method=method
+            )
+            view = app.view_functions[endpoint]
+            if getattr(view, "view_class", None) is BatchAPI:
+                rv = json_response(
+                    status_code=400, message="Batches can not be nested"
+                )
+            else:
+                rv = view(**view_args)
+        except HTTPException as e:
+            rv = json_response(status_code=e.code)
+        except DBAPIError as e:
+            rv = timeout_response(e) or json_response(status_code=500)
+        except Exception:
+            rv = json_response(status_code=500)
+        response = app.make_response(rv)
+
+    return {"status": response.status_code, "body": response.get_json()}
+
+
+def _run_atomic(sub_requests: list, token_information: dict) -> list:
+    """Runs the sub-requests in a single transaction
+
+    Each sub-request runs inside a SAVEPOINT, so the commits made by the
+    views only release it. Everything is committed at the end, or rolled
+    back at the first failing sub-request.
+
+    Parameters
+    ----------
+    sub_requests : list[dict]
+    token_information : dict
+        The already decoded batch token
+
+    Returns
+    -------
+    list[dict]
+        The sub-responses, up to the failing one
+    """
+    responses = []
+    for sub_request in sub_requests:
+        savepoint = db.session.begin_nested()
+        response = _dispatch(sub_request, token_information)
+        responses.append(response)
+
+        if int(response["status"]) >= 400:
+            db.session.rollback()
+            db.session.rollback()
+            return responses
+
+        if savepoint.is_active:
+            # The view didn't commit (e.g. a GET), so release it here
+            db.session.commit()
+
+    db.session.commit()
+    return responses
+
+
+def _run_parallel(app, sub_requests: list, token_information: dict) -> list:
+    """Runs read-only sub-requests concurrently
+
+    Each worker thread gets its own app context and, so, its own
+    database session.
+
+    Parameters
+    ----------
+    app : Flask
+    sub_requests : list[dict]
+    token_information : dict
+        The already decoded batch token
+
+    Returns
+    -------
+    list[dict]
+        The sub-responses, in the same order of `sub_requests`
+    """
+
+    def _worker(sub_request):
+        with app.app_context():
+            return _dispatch(sub_request, token_information)
+
+    max_workers = int(app.config["BATCH_MAX_WORKERS"])
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_worker, sub_requests))
@@ -1,11 +1,48 @@
 from flask import Blueprint
 
-from .resources import UserAPI, UserTokenAPI, ProdutorAPI, LavouraAPI
+from .resources import (
+    UserAPI,
+    UserTokenAPI,
+    ProdutorAPI,
+    LavouraAPI,
+    BatchAPI,
+    PerdaAPI,
+    PerdaExportAPI,
+    LavouraImportAPI,
+    LavouraTileAPI,
+    PerdaVizinhosAPI,
+    PerdaAnalyticsAPI,
+    JobAPI,
+    JobRetryAPI,
+    JobResultAPI,
+    ChangeAPI,
+    SnapshotAPI,
+    PerdaStreamAPI,
+    MemoryProfileAPI,
+    CpuProfileAPI,
+    StatementTimeoutAPI,
+)
 
 user_view = UserAPI.as_view("user_api")
 user_token_view = UserTokenAPI.as_view("user_token_api")
 produtor_view = ProdutorAPI.as_view("produtor_api")
 lavoura_view = LavouraAPI.as_view("lavoura_api")
+batch_view = BatchAPI.as_view("batch_api")
+perda_view = PerdaAPI.as_view("perda_api")
+perda_export_view = PerdaExportAPI.as_view("perda_export_api")
+lavoura_import_view = LavouraImportAPI.as_view("lavoura_import_api")
+lavoura_tile_view = LavouraTileAPI.as_view("lavoura_tile_api")
+perda_vizinhos_view = PerdaVizinhosAPI.as_view("perda_vizinhos_api")
+perda_analytics_view = PerdaAnalyticsAPI.as_view("perda_analytics_api")
+job_view = JobAPI.as_view("job_api")
+job_retry_view = JobRetryAPI.as_view("job_retry_api")
+job_result_view = JobResultAPI.as_view("job_result_api")
+change_view = ChangeAPI.as_view("change_api")
+snapshot_view = SnapshotAPI.as_view("snapshot_api")
+perda_stream_view = PerdaStreamAPI.as_view("perda_stream_api")
+memory_profile_view = MemoryProfileAPI.as_view("memory_profile_api")
+cpu_profile_view = CpuProfileAPI.as_view("cpu_profile_api")
+statement_timeout_view = StatementTimeoutAPI.as_view("statement_timeout_api")
 
 
 def init_app(bp: Blueprint):
@@ -23,3 +60,53 @@ def init_app(bp: Blueprint):
         view_func=lavoura_view,
         methods=["GET"],
     )
+    bp.add_url_rule(
+        "/lavouras/import", view_func=lavoura_import_view, methods=["POST"]
+    )
+    bp.add_url_rule(
+        "/lavouras/tiles/<int:z>/<int:x>/<int:y>",
+        view_func=lavoura_tile_view,
+        methods=["GET"],
+    )
+    bp.add_url_rule("/batch", view_func=batch_view, methods=["POST"])
+    bp.add_url_rule("/perdas/", view_func=perda_view, methods=["POST"])
+    bp.add_url_rule(
+        "/perdas/export", view_func=perda_export_view, methods=["GET"]
+    )
+    bp.add_url_rule(
+        "/perdas/<int:perda_id>/vizinhos",
+        view_func=perda_vizinhos_view,
+        methods=["GET"],
+    )
+    bp.add_url_rule(
+        "/analytics/perdas", view_func=perda_analytics_view, methods=["GET"]
+    )
+    bp.add_url_rule(
+        "/jobs/<int:job_id>", view_func=job_view, methods=["GET", "DELETE"]
+    )
+    bp.add_url_rule(
+        "/jobs/<int:job_id>/retry", view_func=job_retry_view, methods=["POST"]
+    )
+    bp.add_url_rule(
+        "/jobs/<int:job_id>/result",
+        view_func=job_result_view,
+        methods=["GET"],
+    )
+    bp.add_url_rule("/changes", view_func=change_view, methods=["GET"])
+    bp.add_url_rule("/snapshot", view_func=snapshot_view, methods=["GET"])
+    bp.add_url_rule(
+        "/perdas/stream", view_func=perda_stream_view, methods=["GET"]
+    )
+    bp.add_url_rule(
+        "/debug/memory",
+        view_func=memory_profile_view,
+        methods=["GET", "DELETE"],
+    )
+    bp.add_url_rule(
+        "/debug/profiles/<profile_id>",
+        view_func=cpu_profile_view,
+        methods=["GET"],
+    )
+    bp.add_url_rule(
+        "/debug/timeouts", view_func=statement_timeout_view, methods=["GET"]
+    )
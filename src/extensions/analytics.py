@@ -0,0 +1,576 @@
+import threading
+from datetime import date
+
+import numpy as np
+from flask import Flask, current_app
+
+from src.extensions import capture
+from src.extensions.database import db
+from src.extensions.export import parse_filters
+from src.extensions.refresh import BackgroundRefresh
+from src.models import EVENTOS, Lavoura, Perda
+
+# Dimensions of the crop (the others are of the loss)
+LAVOURA_DIMENSIONS = ("tipo", "celula")
+DIMENSIONS = ("evento", *LAVOURA_DIMENSIONS, "mes", "ano")
+
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def _months(ordinals: np.ndarray) -> np.ndarray:
+    """Converts date ordinals to months since 1970-01"""
+    return (
+        (ordinals - _EPOCH)
+        .astype("datetime64[D]")
+        .astype("datetime64[M]")
+        .astype(np.int64)
+    )
+
+
+class PerdaColumns:
+    """Losses and crops kept in memory as compact NumPy columns
+
+    Changes go to small pending dicts that are merged into the columns
+    before the next query. New copies are built and kept fresh in the
+    background (see `BackgroundRefresh`).
+    """
+
+    def __init__(self, lavouras: list, perdas: list):
+        self.lock = threading.Lock()
+        self.tipos = []
+        self.tipo_codes = {}
+        self.lavoura_ids = np.array(
+            [row[0] for row in lavouras], dtype=np.int32
+        )
+        self.latitudes = np.array(
+            [row[1] for row in lavouras], dtype=np.float32
+        )
+        self.longitudes = np.array(
+            [row[2] for row in lavouras], dtype=np.float32
+        )
+        self.tipos_lavoura = np.array(
+            [self._tipo_code(row[3]) for row in lavouras], dtype=np.int16
+        )
+        self.perda_ids = np.array([row[0] for row in perdas], dtype=np.int32)
+        self.datas = np.array(
+            [row[1].toordinal() for row in perdas], dtype=np.int32
+        )
+        self.eventos = np.array([row[2] for row in perdas], dtype=np.int8)
+        self.perda_lavoura_ids = np.array(
+            [row[3] for row in perdas], dtype=np.int32
+        )
+        self.pending_lavouras = {}
+        self.pending_perdas = {}
+        self.positions = self._locate(self.perda_lavoura_ids)
+
+    @classmethod
+    def load(cls) -> "PerdaColumns":
+        """Loads every crop and loss from the database"""
+        lavouras = (
+            db.session.query(
+                Lavoura.id, Lavoura.latitude, Lavoura.longitude, Lavoura.tipo
+            )
+            .order_by(Lavoura.id)
+            .all()
+        )
+        perdas = db.session.query(
+            Perda.id, Perda.data, Perda.evento, Perda.lavoura_id
+        ).all()
+        return cls(lavouras, perdas)
+
+    def _tipo_code(self, tipo: str) -> int:
+        code = self.tipo_codes.get(tipo)
+        if code is None:
+            code = self.tipo_codes[tipo] = len(self.tipos)
+            self.tipos.append(tipo)
+        return code
+
+    def _locate(self, lavoura_ids: np.ndarray) -> np.ndarray:
+        """Finds the crop positions of some losses, -1 for unknown crops"""
+        positions = np.searchsorted(self.lavoura_ids, lavoura_ids)
+        found = positions < len(self.lavoura_ids)
+        found[found] = self.lavoura_ids[positions[found]] == lavoura_ids[found]
+        return np.where(found, positions, -1).astype(np.int32)
+
+    def apply(self, changes: list) -> bool:
+        """Queues committed changes
+
+        Parameters
+        ----------
+        changes : list
+            (model, operation, values) tuples, see `capture.subscribe`
+
+        Returns
+        -------
+        bool
+            Always False, the changes are merged before the next query
+        """
+        lavouras, perdas = {}, {}
+        for model, operation, values in changes:
+            deleted = operation == capture.DELETE
+            if model is Lavoura:
+                lavouras[values["id"]] = (
+                    None
+                    if deleted
+                    else (
+                        values["latitude"],
+                        values["longitude"],
+                        values["tipo"],
+                    )
+                )
+            else:
+                perdas[values["id"]] = (
+                    None
+                    if deleted
+                    else (
+                        values["data"].toordinal(),
+                        values["evento"],
+                        values["lavoura_id"],
+                    )
+                )
+        with self.lock:
+            self.pending_lavouras.update(lavouras)
+            self.pending_perdas.update(perdas)
+        return False
+
+    def _merge(self):
+        """Folds the pending changes into the columns
+
+        The columns are replaced, never changed in place, so a query can
+        keep reading the ones it took while others are merged. Inserts
+        (ids greater than the known ones) are appended, only updates and
+        deletions need a pass over the whole columns
+        """
+        if self.pending_lavouras:
+            self._merge_lavouras()
+        if self.pending_perdas:
+            self._merge_perdas()
+
+    def _merge_lavouras(self):
+        last_id = int(self.lavoura_ids.max(initial=0))
+        existing = [key for key in self.pending_lavouras if key <= last_id]
+        rows = sorted(
+            (lavoura_id, *values)
+            for lavoura_id, values in self.pending_lavouras.items()
+            if values is not None
+        )
+        self.pending_lavouras = {}
+
+        columns = (
+            ("lavoura_ids", np.int32),
+            ("latitudes", np.float32),
+            ("longitudes", np.float32),
+            ("tipos_lavoura", np.int16),
+        )
+        keep = (
+            ~np.isin(self.lavoura_ids, existing) if existing else slice(None)
+        )
+        added = [
+            [row[0] for row in rows],
+            [row[1] for row in rows],
+            [row[2] for row in rows],
+            [self._tipo_code(row[3]) for row in rows],
+        ]
+        for (name, dtype), values in zip(columns, added):
+            setattr(
+                self,
+                name,
+                np.concatenate(
+                    (getattr(self, name)[keep], np.array(values, dtype=dtype))
+                ),
+            )
+
+        if existing:
+            order = np.argsort(self.lavoura_ids, kind="stable")
+            for name, _ in columns:
+                setattr(self, name, getattr(self, name)[order])
+            self.positions = self._locate(self.perda_lavoura_ids)
+        else:
+            # New crops go after the known ones, so only the losses of
+            # unknown crops can move
+            unknown = np.flatnonzero(self.positions < 0)
+            if len(unknown):
+                positions = self.positions.copy()
+                positions[unknown] = self._locate(
+                    self.perda_lavoura_ids[unknown]
+                )
+                self.positions = positions
+
+    def _merge_perdas(self):
+        last_id = int(self.perda_ids.max(initial=0))
+        existing = [key for key in self.pending_perdas if key <= last_id]
+        rows = [
+            (perda_id, *values)
+            for perda_id, values in self.pending_perdas.items()
+            if values is not None
+        ]
+        self.pending_perdas = {}
+
+        lavoura_ids = np.array([row[3] for row in rows], dtype=np.int32)
+        keep = ~np.isin(self.perda_ids, existing) if existing else slice(None)
+        for name, values in (
+            ("perda_ids", np.array([row[0] for row in rows], dtype=np.int32)),
+            ("datas", np.array([row[1] for row in rows], dtype=np.int32)),
+            ("eventos", np.array([row[2] for row in rows], dtype=np.int8)),
+            ("perda_lavoura_ids", lavoura_ids),
+            ("positions", self._locate(lavoura_ids)),
+        ):
+            setattr(
+                self,
+                name,
+                np.concatenate((getattr(self, name)[keep], values)),
+            )
+
+    def snapshot(self) -> dict:
+        """Returns the current columns, with the pending changes merged"""
+        with self.lock:
+            self._merge()
+            return {
+                "lavoura_ids": self.lavoura_ids,
+                "latitudes": self.latitudes,
+                "longitudes": self.longitudes,
+                "tipos_lavoura": self.tipos_lavoura,
+                "tipos": list(self.tipos),
+                "tipo_codes": dict(self.tipo_codes),
+                "datas": self.datas,
+                "eventos": self.eventos,
+                "positions": self.positions,
+            }
+
+
+def parse_params(
+    agrupar: str = None,
+    inicio: str = None,
+    fim: str = None,
+    evento: str = None,
+    tipo: str = None,
+    celula: str = None,
+    percentis: str = None,
+) -> dict:
+    """Validates the analytics query string
+
+    Returns
+    -------
+    dict
+        Keyword arguments for `perda_statistics`
+
+    Raises
+    ------
+    ValueError
+        If any of the parameters is invalid
+    """
+    params = parse_filters(inicio, fim, evento)
+    params["agrupar"] = [name for name in (agrupar or "").split(",") if name]
+    unknown = set(params["agrupar"]) - set(DIMENSIONS)
+    if unknown or len(set(params["agrupar"])) != len(params["agrupar"]):
+        raise ValueError(
+            "Field 'agrupar' must be a comma separated list of "
+            + ", ".join(DIMENSIONS)
+        )
+    if tipo:
+        params["tipo"] = tipo
+    try:
+        params["celula"] = float(
+            celula or current_app.config["ANALYTICS_DEFAULT_CELL"]
+        )
+    except ValueError:
+        params["celula"] = 0
+    if not 0.001 <= params["celula"] <= 90:
+        raise ValueError("Field 'celula' must be between 0.001 and 90")
+    try:
+        params["percentis"] = [
+            float(value) for value in (percentis or "").split(",") if value
+        ]
+    except ValueError:
+        params["percentis"] = [-1]
+    if not all(0 <= value <= 100 for value in params["percentis"]):
+        raise ValueError(
+            "Field 'percentis' must be a comma separated list of numbers"
+            " between 0 and 100"
+        )
+    return params
+
+
+def _dimension(name: str, columns: dict, celula: float, perdas, lavouras):
+    """Encodes a dimension as dense integer codes
+
+    Parameters
+    ----------
+    name : str
+    columns : dict
+        `PerdaColumns.snapshot()`
+    celula : float
+        Grid cell size, in degrees
+    perdas : np.ndarray
+        Indexes of the selected losses
+    lavouras : np.ndarray
+        Mask of the selected crops
+
+    Returns
+    -------
+    tuple
+        (codes of the selected losses, codes of every crop or None,
+        number of codes, function from code to label)
+    """
+    if name == "tipo":
+        raw = columns["tipos_lavoura"].astype(np.int64)
+    elif name == "celula":
+        rows = np.floor(
+            (columns["latitudes"].astype(np.float64) + 90) / celula
+        ).astype(np.int64)
+        cols = np.floor(
+            (columns["longitudes"].astype(np.float64) + 180) / celula
+        ).astype(np.int64)
+        first_col = int(cols[lavouras].min())
+        width = int(cols[lavouras].max()) - first_col + 1
+        raw = rows * width + (cols - first_col)
+    elif name == "evento":
+        raw = columns["eventos"][perdas].astype(np.int64)
+    else:
+        months = _months(columns["datas"][perdas])
+        raw = months if name == "mes" else months // 12
+
+    selected = raw[lavouras] if name in LAVOURA_DIMENSIONS else raw
+    first = int(selected.min())
+    size = int(selected.max()) - first + 1
+
+    def label(code: int):
+        value = code + first
+        if name == "evento":
+            return EVENTOS.get(value, value)
+        if name == "tipo":
+            return columns["tipos"][value]
+        if name == "celula":
+            return {
+                "latitude": round((value // width) * celula - 90, 6),
+                "longitude": round(
+                    (value % width + first_col) * celula - 180, 6
+                ),
+            }
+        if name == "mes":
+            return f"{1970 + value // 12}-{value % 12 + 1:02d}"
+        return 1970 + value
+
+    if name in LAVOURA_DIMENSIONS:
+        codes = raw - first
+        return codes[columns["positions"][perdas]], codes, size, label
+    return raw - first, None, size, label
+
+
+def _group(keys: np.ndarray, size: int) -> tuple:
+    """Groups equal keys
+
+    Counts with `bincount` (linear) when the key range is small enough,
+    and by sorting otherwise
+
+    Returns
+    -------
+    tuple
+        (sorted distinct keys, their counts, group of every key)
+    """
+    if size <= max(2**20, 2 * len(keys)):
+        counts = np.bincount(keys, minlength=size)
+        distinct = np.flatnonzero(counts)
+        groups = np.empty(size, dtype=np.int64)
+        groups[distinct] = np.arange(len(distinct))
+        return distinct, counts[distinct], groups[keys]
+    distinct, inverse, counts = np.unique(
+        keys, return_inverse=True, return_counts=True
+    )
+    return distinct, counts, inverse
+
+
+def _percentiles(
+    group_of_perdas: np.ndarray,
+    positions: np.ndarray,
+    lavouras: np.ndarray,
+    percentis: list,
+) -> dict:
+    """Percentiles of the losses per crop in every group
+
+    Crops of the group without losses count as zero. Uses the nearest
+    rank method, so every percentile is an observed loss count.
+
+    Parameters
+    ----------
+    group_of_perdas : np.ndarray
+        Group of every selected loss
+    positions : np.ndarray
+        Crop position of every selected loss
+    lavouras : np.ndarray
+        Number of crops in every group
+    percentis : list
+
+    Returns
+    -------
+    dict
+        {percentile: value of every group}
+    """
+    n_groups = len(lavouras)
+    width = int(positions.max()) + 1
+    pairs, counts = np.unique(
+        group_of_perdas * width + positions, return_counts=True
+    )
+    groups = pairs // width
+    order = np.lexsort((counts, groups))
+    counts, groups = counts[order], groups[order]
+    starts = np.searchsorted(groups, np.arange(n_groups))
+    zeros = lavouras - np.bincount(groups, minlength=n_groups)
+
+    result = {}
+    for percentil in percentis:
+        rank = np.maximum(np.ceil(percentil / 100 * lavouras), 1).astype(
+            np.int64
+        )
+        has_losses = rank > zeros
+        index = np.clip(starts + rank - zeros - 1, 0, len(counts) - 1)
+        result[f"{percentil:g}"] = np.where(has_losses, counts[index], 0)
+    return result
+
+
+def perda_statistics(
+    agrupar: list,
+    inicio: date = None,
+    fim: date = None,
+    evento: int = None,
+    tipo: str = None,
+    celula: float = 0.1,
+    percentis: list = (),
+) -> dict:
+    """Counts losses per group, with rates and percentiles
+
+    Parameters
+    ----------
+    agrupar : list
+        Dimensions (see `DIMENSIONS`) to group by, in output order
+    inicio, fim : date, optional
+        Date window, inclusive
+    evento : int, optional
+    tipo : str, optional
+        Crop tipo
+    celula : float, optional
+        Grid cell size, in degrees, by default 0.1
+    percentis : list, optional
+        Percentiles of the losses per crop, by default none
+
+    Returns
+    -------
+    dict
+        {"grupos", "perdas", "lavouras", "truncado"}. Each group has
+        its dimension labels, `perdas`, `lavouras` (crops in the group's
+        tipo/cell), `taxa` (losses per crop) and the `percentis`
+
+    Raises
+    ------
+    ValueError
+        If the groups can not be encoded in 64 bits
+    """
+    columns = get_columns().snapshot()
+
+    lavouras = np.ones(len(columns["lavoura_ids"]), dtype=bool)
+    perdas = columns["positions"] >= 0
+    if inicio is not None:
+        perdas &= columns["datas"] >= inicio.toordinal()
+    if fim is not None:
+        perdas &= columns["datas"] <= fim.toordinal()
+    if evento is not None:
+        perdas &= columns["eventos"] == evento
+    if tipo is not None:
+        lavouras &= columns["tipos_lavoura"] == columns["tipo_codes"].get(
+            tipo, -1
+        )
+        perdas[perdas] = lavouras[columns["positions"][perdas]]
+    perdas = np.flatnonzero(perdas)
+
+    result = {
+        "grupos": [],
+        "perdas": len(perdas),
+        "lavouras": int(lavouras.sum()),
+        "truncado": False,
+    }
+    if not len(perdas):
+        return result
+
+    dimensions = [
+        (name, *_dimension(name, columns, celula, perdas, lavouras))
+        for name in agrupar
+    ]
+    keys = np.zeros(len(perdas), dtype=np.int64)
+    lavoura_keys = np.zeros(len(lavouras), dtype=np.int64)
+    size = lavoura_size = 1
+    for name, codes, lavoura_codes, dimension_size, _ in dimensions:
+        size *= dimension_size
+        keys = keys * dimension_size + codes
+        if lavoura_codes is not None:
+            lavoura_size *= dimension_size
+            lavoura_keys = lavoura_keys * dimension_size + lavoura_codes
+    if size >= 2**62:
+        raise ValueError("Too many groups, use a larger 'celula'")
+
+    groups, counts, group_of_perdas = _group(keys, size)
+    lavoura_groups, lavoura_counts, _ = _group(
+        lavoura_keys[lavouras], lavoura_size
+    )
+
+    # Splits the group keys back into dimension codes
+    group_codes = {}
+    remainder = groups
+    for name, _, _, dimension_size, _ in reversed(dimensions):
+        group_codes[name] = remainder % dimension_size
+        remainder = remainder // dimension_size
+    group_lavoura_keys = np.zeros(len(groups), dtype=np.int64)
+    for name, _, lavoura_codes, dimension_size, _ in dimensions:
+        if lavoura_codes is not None:
+            group_lavoura_keys = (
+                group_lavoura_keys * dimension_size + group_codes[name]
+            )
+    group_lavouras = lavoura_counts[
+        np.searchsorted(lavoura_groups, group_lavoura_keys)
+    ]
+
+    percentiles = {}
+    if percentis:
+        percentiles = _percentiles(
+            group_of_perdas,
+            columns["positions"][perdas].astype(np.int64),
+            group_lavouras,
+            percentis,
+        )
+
+    selected = np.arange(len(groups))
+    max_groups = int(current_app.config["ANALYTICS_MAX_GROUPS"])
+    if len(groups) > max_groups:
+        selected = np.sort(np.argpartition(-counts, max_groups)[:max_groups])
+        result["truncado"] = True
+
+    for index in selected.tolist():
+        group = {
+            name: label(int(group_codes[name][index]))
+            for name, _, _, _, label in dimensions
+        }
+        group["perdas"] = int(counts[index])
+        group["lavouras"] = int(group_lavouras[index])
+        group["taxa"] = round(group["perdas"] / group["lavouras"], 6)
+        if percentiles:
+            group["percentis"] = {
+                name: int(values[index])
+                for name, values in percentiles.items()
+            }
+        result["grupos"].append(group)
+    return result
+
+
+def get_columns() -> PerdaColumns:
+    """Returns the app analytics columns, refreshed if it is due"""
+    return current_app.extensions["perda_columns"].get()
+
+
+def init_app(app: Flask):
+    app.extensions["perda_columns"] = BackgroundRefresh(
+        app,
+        "perda-columns",
+        (Lavoura, Perda),
+        PerdaColumns.load,
+        refresh_interval=float(app.config["ANALYTICS_REFRESH_INTERVAL"]),
+        rebuild_interval=float(app.config["ANALYTICS_REBUILD_INTERVAL"]),
+    )
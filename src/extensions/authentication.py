@@ -11,6 +11,10 @@ from src.utils import json_response
 from src.extensions.database import db
 from src.models import User
 
+# WSGI environ key of an already decoded token. Only requests built by the
+# app itself (batch sub-requests) can set it, HTTP clients can not
+TOKEN_ENVIRON = "softfocus.token_information"
+
 
 class InvalidUserError(Exception):
     pass
@@ -42,6 +46,11 @@ def token_required(func: callable) -> callable:
 
     @wraps(func)
     def inner(*args, **kwargs):
+        # Batch sub-requests get the token decoded by their batch
+        token_information = request.environ.get(TOKEN_ENVIRON, None)
+        if token_information is not None:
+            return func(*args, **kwargs, token_information=token_information)
+
         token = request.args.get("access_token", None)
         if not token:
             body = request.get_json()
@@ -166,7 +175,22 @@ def generate_token(username: str = "", password: str = "") -> bytes:
     if not check_password_hash(user.password, password):
         raise IncorrectPasswordError()
 
-    token = jwt.encode(
+    return issue_token(username)
+
+
+def issue_token(username: str) -> bytes:
+    """Issues a token for a user, without checking any password
+
+    Parameters
+    ----------
+    username : str
+
+    Returns
+    -------
+    bytes
+        Token: `jwt.encode()` response, valid for 3 hours
+    """
+    return jwt.encode(
         {
             "username": username,
             "exp": time() + (3 * 60 * 60),
@@ -174,8 +198,6 @@ def generate_token(username: str = "", password: str = "") -> bytes:
         key=getenv("SECRET_KEY"),
     )
 
-    return token
-
 
 def init_app(app):
     SimpleLogin(app, login_checker=verify_login)
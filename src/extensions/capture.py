@@ -0,0 +1,149 @@
+from flask import Flask, current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, scoped_session
+
+from src.extensions.database import db
+
+INSERT = "insert"
+UPDATE = "update"
+DELETE = "delete"
+
+# session.info key of the changes not committed yet, per transaction
+PENDING = "captured_changes"
+
+
+def subscribe(
+    app: Flask, models: tuple, callback: callable, before_commit=False
+):
+    """Calls `callback` with the changes of some models once committed
+
+    Changes are captured at each flush and handed over only when the
+    outermost transaction commits. The changes of a savepoint are kept
+    when it is released and dropped when it is rolled back, so nothing
+    rolled back ever reaches a subscriber.
+
+    Parameters
+    ----------
+    app : Flask
+    models : tuple
+        The models whose changes are wanted
+    callback : callable
+        Called, inside the app context, with a list of
+        (model, operation, values) tuples in the order they were
+        flushed. `values` has every column of the row
+    before_commit : bool, optional
+        Calls `callback` right before the outermost transaction commits
+        instead, so it can still write in it, by default False
+    """
+    app.extensions.setdefault("change_subscribers", []).append(
+        (tuple(models), callback, before_commit)
+    )
+    for name, listener in (
+        ("after_flush", _capture),
+        ("before_commit", _before_commit),
+        ("after_commit", _commit),
+        ("after_transaction_end", _discard),
+    ):
+        if not event.contains(db.session, name, listener):
+            event.listen(db.session, name, listener)
+
+
+def track(session: Session, model, rows):
+    """Captures rows inserted without the ORM (e.g. bulk inserts)
+
+    Parameters
+    ----------
+    session : Session
+    model : db.Model
+    rows : iterable
+        Column value dicts of the inserted rows
+    """
+    if isinstance(session, scoped_session):
+        session = session()
+    _pending(session, session.transaction).extend(
+        (model, INSERT, values) for values in rows
+    )
+
+
+def _boundary(transaction):
+    """The transaction that really commits or rolls back `transaction`
+
+    It is the nearest savepoint or the outermost transaction, skipping
+    subtransactions (e.g. the one of each flush)
+    """
+    while transaction.parent is not None and not transaction.nested:
+        transaction = transaction.parent
+    return transaction
+
+
+def _pending(session: Session, transaction) -> list:
+    pending = session.info.setdefault(PENDING, {})
+    return pending.setdefault(_boundary(transaction), [])
+
+
+def row_values(instance) -> dict:
+    """Returns the column values of a model instance"""
+    return {
+        attribute.key: getattr(instance, attribute.key)
+        for attribute in inspect(instance).mapper.column_attrs
+    }
+
+
+def _capture(session: Session, flush_context):
+    subscribers = current_app.extensions.get("change_subscribers", ())
+    models = tuple(model for models, _, _ in subscribers for model in models)
+    changes = [
+        (type(instance), operation, row_values(instance))
+        for instances, operation in (
+            (session.new, INSERT),
+            (session.dirty, UPDATE),
+            (session.deleted, DELETE),
+        )
+        for instance in instances
+        if isinstance(instance, models)
+        and (
+            operation != UPDATE
+            or session.is_modified(instance, include_collections=False)
+        )
+    ]
+    if changes:
+        _pending(session, session.transaction).extend(changes)
+
+
+def _deliver(changes: list, before_commit: bool):
+    for models, callback, when in current_app.extensions["change_subscribers"]:
+        if when != before_commit:
+            continue
+        wanted = [
+            change for change in changes if issubclass(change[0], models)
+        ]
+        if wanted:
+            callback(wanted)
+
+
+def _before_commit(session: Session):
+    transaction = session.transaction
+    if transaction.nested:
+        return
+    # The commit flushes what is left only after this event
+    session.flush()
+    changes = session.info.get(PENDING, {}).get(transaction)
+    if changes:
+        _deliver(changes, before_commit=True)
+
+
+def _commit(session: Session):
+    transaction = session.transaction
+    changes = session.info.get(PENDING, {}).pop(transaction, None)
+    if not changes:
+        return
+    if transaction.nested:
+        # A released savepoint still depends on its parent transaction
+        _pending(session, transaction.parent).extend(changes)
+        return
+    _deliver(changes, before_commit=False)
+
+
+def _discard(session: Session, transaction):
+    # Whatever a transaction did not commit was rolled back
+    session.info.get(PENDING, {}).pop(transaction, None)
@@ -0,0 +1,251 @@
+from datetime import datetime, timedelta
+
+import click
+from flask import Flask
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from src.extensions import capture
+from src.extensions.database import db
+from src.extensions.snapshot import latest_snapshot
+from src.models import ChangeLog, Lavoura, Perda, ProdutorRural
+
+# Entities of the feed
+ENTITIES = {ProdutorRural: "produtor", Lavoura: "lavoura"}
+# Logged too, for the in-memory copies of other processes to catch up
+# (see `changed_rows`), but left out of the feed
+LOGGED = {**ENTITIES, Perda: "perda"}
+
+# Rows loaded per query when catching up
+CATCH_UP_BATCH_SIZE = 500
+
+changes_cli = AppGroup("changes", help="Maintains the change log")
+
+
+class ExpiredCursorError(Exception):
+    pass
+
+
+def serialize(entity: str, instance) -> dict:
+    """Serializes a synced entity the same way the feed sends it"""
+    if entity == "produtor":
+        return {
+            "id": instance.id,
+            "nome": instance.nome,
+            "email": instance.email,
+            "cpf": instance.cpf,
+        }
+    return {
+        "id": instance.id,
+        "latitude": instance.latitude,
+        "longitude": instance.longitude,
+        "tipo": instance.tipo,
+    }
+
+
+def _log_changes(changes: list):
+    connection = db.session.connection()
+    if connection.dialect.name == "postgresql":
+        # Ids are taken at commit time, one transaction at a time, so they
+        # follow the commit order: once a client has seen an id, no lower
+        # one can show up later. SQLite writers are serialized already
+        connection.execute("LOCK TABLE change_log IN EXCLUSIVE MODE")
+    now = datetime.utcnow()
+    connection.execute(
+        ChangeLog.__table__.insert(),
+        [
+            {
+                "entity": LOGGED[model],
+                "entity_id": values["id"],
+                "operation": operation,
+                "created_at": now,
+            }
+            for model, operation, values in changes
+        ],
+    )
+
+
+def changes_since(cursor: int, limit: int) -> dict:
+    """Lists the changes after a cursor
+
+    Many changes of the same row in a page are merged into the last one,
+    which carries the current row data
+
+    Parameters
+    ----------
+    cursor : int
+        The last cursor the client has seen, 0 to start over
+    limit : int
+        Maximum number of change log rows read
+
+    Returns
+    -------
+    dict
+        {"changes", "cursor", "has_more"}
+
+    Raises
+    ------
+    ExpiredCursorError
+        If the changes after the cursor were pruned. The client must
+        start over from the latest snapshot and its cursor
+    """
+    first_id = db.session.query(func.min(ChangeLog.id)).scalar()
+    if first_id is not None and cursor < first_id - 1:
+        raise ExpiredCursorError()
+
+    logs = (
+        ChangeLog.query.filter(
+            ChangeLog.id > cursor, ChangeLog.entity.in_(ENTITIES.values())
+        )
+        .order_by(ChangeLog.id)
+        .limit(limit + 1)
+        .all()
+    )
+    has_more = len(logs) > limit
+    logs = logs[:limit]
+
+    latest = {}
+    for log in logs:
+        latest.pop((log.entity, log.entity_id), None)
+        latest[(log.entity, log.entity_id)] = log
+
+    instances = {}
+    for model, entity in ENTITIES.items():
+        ids = [
+            entity_id
+            for (log_entity, entity_id), log in latest.items()
+            if log_entity == entity and log.operation != ChangeLog.DELETE
+        ]
+        if ids:
+            for instance in model.query.filter(model.id.in_(ids)):
+                instances[(entity, instance.id)] = instance
+
+    changes = []
+    for key, log in latest.items():
+        instance = instances.get(key)
+        # A row missing here was deleted by a change in a later page
+        operation = log.operation if instance is not None else "delete"
+        changes.append(
+            {
+                "cursor": log.id,
+                "entity": log.entity,
+                "id": log.entity_id,
+                "operation": operation,
+                "data": (
+                    serialize(log.entity, instance)
+                    if operation != ChangeLog.DELETE
+                    else None
+                ),
+            }
+        )
+
+    return {
+        "changes": changes,
+        "cursor": logs[-1].id if logs else cursor,
+        "has_more": has_more,
+    }
+
+
+def newest_cursor() -> int:
+    """Returns the id of the newest change, 0 if there is none"""
+    return db.session.query(func.max(ChangeLog.id)).scalar() or 0
+
+
+def changed_rows(cursor: int, models: tuple) -> tuple:
+    """Lists the rows of some logged models changed after a cursor
+
+    Unlike a filter on the row ids, it also finds the rows inserted with
+    an id lower than the newest one seen, but committed after it, and
+    the rows updated or deleted
+
+    Parameters
+    ----------
+    cursor : int
+    models : tuple
+        Models of `LOGGED`
+
+    Returns
+    -------
+    tuple
+        (changes, new cursor). Changes are the (model, operation, values)
+        tuples `capture` subscribers get, with the current values of each
+        changed row, or only its id if it is gone
+
+    Raises
+    ------
+    ExpiredCursorError
+        If the changes after the cursor were pruned
+    """
+    first_id = db.session.query(func.min(ChangeLog.id)).scalar()
+    if first_id is not None and cursor < first_id - 1:
+        raise ExpiredCursorError()
+
+    # Up to the newest change of any entity, so a cursor is not left
+    # behind (and then pruned) while only the others change
+    newest_id = newest_cursor()
+    entities = {LOGGED[model]: model for model in models}
+    changed = {model: set() for model in models}
+    for entity, entity_id in db.session.query(
+        ChangeLog.entity, ChangeLog.entity_id
+    ).filter(
+        ChangeLog.id > cursor,
+        ChangeLog.id <= newest_id,
+        ChangeLog.entity.in_(entities),
+    ):
+        changed[entities[entity]].add(entity_id)
+
+    changes = []
+    for model, ids in changed.items():
+        ids = sorted(ids)
+        for start in range(0, len(ids), CATCH_UP_BATCH_SIZE):
+            end = start + CATCH_UP_BATCH_SIZE
+            batch = ids[start:end]
+            found = {
+                instance.id: capture.row_values(instance)
+                for instance in model.query.filter(model.id.in_(batch))
+            }
+            changes.extend(
+                (
+                    (model, capture.UPDATE, found[row_id])
+                    if row_id in found
+                    else (model, capture.DELETE, {"id": row_id})
+                )
+                for row_id in batch
+            )
+    return changes, max(cursor, newest_id)
+
+
+@changes_cli.command("prune")
+@click.option(
+    "--keep-days",
+    type=int,
+    default=90,
+    show_default=True,
+    help="Age of the oldest change kept",
+)
+def prune_command(keep_days):
+    """Deletes old changes
+
+    Clients whose cursor is older than that must download the snapshot
+    again, so changes after the latest snapshot are always kept. So is
+    the newest change: an empty log could not tell expired cursors apart
+    """
+    latest = latest_snapshot()
+    if latest is None:
+        raise click.ClickException(
+            "There is no snapshot for expired clients to start over from,"
+            " build one first"
+        )
+    newest_id = newest_cursor()
+    deleted = ChangeLog.query.filter(
+        ChangeLog.created_at < datetime.utcnow() - timedelta(days=keep_days),
+        ChangeLog.id <= latest["cursor"],
+        ChangeLog.id < newest_id,
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f"{deleted} changes deleted", err=True)
+
+
+def init_app(app: Flask):
+    capture.subscribe(app, tuple(LOGGED), _log_changes, before_commit=True)
+    app.cli.add_command(changes_cli)
@@ -12,6 +12,60 @@ config = {
         "PASSWORD_SCHEMES": ["pbkdf2_sha512", "md5_crypt"],
         "SQLALCHEMY_DATABASE_URI": "from .env",
         "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "BATCH_MAX_REQUESTS": 20,
+        "BATCH_MAX_WORKERS": 4,
+        "EXPORT_BATCH_SIZE": 5000,
+        "IMPORT_CHUNK_SIZE": 10000,
+        "LAVOURA_TIPOS": [],
+        "TILE_MAX_ZOOM": 16,
+        "TILE_GRID_SIZE": 16,
+        "TILE_INVALIDATION_MAX_KEYS": 200,
+        "SPATIAL_REBUILD_THRESHOLD": 10000,
+        "SPATIAL_DEFAULT_RADIUS_KM": 10,
+        "SPATIAL_MAX_RADIUS_KM": 200,
+        "SPATIAL_DEFAULT_DAYS": 7,
+        "SPATIAL_REFRESH_INTERVAL": 60,
+        "SPATIAL_REBUILD_INTERVAL": 3600,
+        "SPATIAL_BUILD_ON_STARTUP": True,
+        "JOBS_STORAGE_PATH": "",
+        "JOBS_STALE_AFTER": 300,
+        "JOBS_HEARTBEAT_INTERVAL": 30,
+        "CHANGES_PAGE_SIZE": 500,
+        "PERDA_STREAM_QUEUE_SIZE": 1000,
+        "PERDA_STREAM_KEEPALIVE": 15,
+        # Every open stream keeps a server thread busy, keep it below the
+        # threads of a worker (or use an async worker, e.g. gevent)
+        "PERDA_STREAM_MAX_CLIENTS": 20,
+        "SEARCH_LIMIT": 20,
+        "PROFILING_TOKEN": "",
+        "MEMORY_PROFILING": False,
+        "MEMORY_PROFILING_SAMPLE_RATE": 0.01,
+        "MEMORY_PROFILING_TOP": 10,
+        "MEMORY_PROFILING_FRAMES": 1,
+        "MEMORY_PROFILING_HISTORY": 100,
+        "PROFILING_INTERVAL": 0.001,
+        "PROFILING_TOP": 30,
+        "PROFILING_HISTORY": 20,
+        "INGEST_GROUP_COMMIT": False,
+        "INGEST_MAX_BATCH": 500,
+        "INGEST_MAX_DELAY_MS": 5,
+        "INGEST_QUEUE_SIZE": 10000,
+        "INGEST_TIMEOUT": 10,
+        "ANALYTICS_REFRESH_INTERVAL": 60,
+        "ANALYTICS_REBUILD_INTERVAL": 3600,
+        "ANALYTICS_MAX_GROUPS": 10000,
+        "ANALYTICS_DEFAULT_CELL": 0.1,
+        "SNAPSHOT_PATH": "",
+        "SNAPSHOT_COMPRESSION": 6,
+        "SNAPSHOT_KEEP": 2,
+        "SNAPSHOT_MAX_AGE": 300,
+        # Milliseconds a single query may run, 0 for no limit
+        "STATEMENT_TIMEOUT_DEFAULT": 30000,
+        "STATEMENT_TIMEOUTS": {
+            "GET /api/v1/produtores/": 5000,
+            "GET /api/v1/lavouras/": 5000,
+            "GET /api/v1/perdas/export": 60000,
+        },
     },
     "DEVELOPMENT": {
         "DEBUG": True,
@@ -26,7 +80,26 @@ config = {
 }
 
 extensions = {
-    "DEFAULT": ["database", "authentication", "errors"],
+    "DEFAULT": [
+        "database",
+        "authentication",
+        "errors",
+        "export",
+        "importer",
+        "tiles",
+        "spatial",
+        "partitions",
+        "jobs",
+        "changes",
+        "notifier",
+        "summaries",
+        "ingest",
+        "analytics",
+        "snapshot",
+        "memory",
+        "profiler",
+        "timeouts",
+    ],
     "DEVELOPMENT": [],
     "TESTING": [],
     "PRODUCTION": [],
@@ -1,11 +1,30 @@
+import sqlite3
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-
+from sqlalchemy import event
 
 db = SQLAlchemy()
 
 
+def _sqlite_connect(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        # pysqlite starts and ends transactions on its own, which breaks
+        # SAVEPOINTs: a ROLLBACK TO does not undo what came before it.
+        # SQLAlchemy emits the BEGIN instead (see `_sqlite_begin`)
+        dbapi_connection.isolation_level = None
+        # Every session read now holds a transaction open until the
+        # session ends. With the write-ahead log, those readers do not
+        # block the writers of other connections (e.g. job progress)
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+
+def _sqlite_begin(connection):
+    if connection.dialect.name == "sqlite":
+        connection.execute("BEGIN")
+
+
 def init_app(app: Flask):
     """Initiates SQLAlchemy and Migrate on a Flask app
 
@@ -16,3 +35,13 @@ def init_app(app: Flask):
     """
     Migrate(app, db, directory="src/extensions/database/migrations")
     db.init_app(app)
+    # On the app engine only, other SQLite engines (e.g. the snapshot
+    # files) keep the pysqlite defaults. Created here, before any
+    # connection is made
+    engine = db.get_engine(app)
+    for name, listener in (
+        ("connect", _sqlite_connect),
+        ("begin", _sqlite_begin),
+    ):
+        if not event.contains(engine, name, listener):
+            event.listen(engine, name, listener)
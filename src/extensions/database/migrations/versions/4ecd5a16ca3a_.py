@@ -0,0 +1,32 @@
+"""tile cache
+
+Revision ID: 4ecd5a16ca3a
+Revises: a14493f54e9b
+Create Date: 2021-04-20 21:14:02.118734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4ecd5a16ca3a'
+down_revision = 'a14493f54e9b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tile_cache',
+    sa.Column('z', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('x', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('y', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.PrimaryKeyConstraint('z', 'x', 'y')
+    )
+    op.create_index('ix_lavoura_latitude_longitude', 'lavoura', ['latitude', 'longitude'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_lavoura_latitude_longitude', table_name='lavoura')
+    op.drop_table('tile_cache')
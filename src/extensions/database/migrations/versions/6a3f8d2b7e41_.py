@@ -0,0 +1,39 @@
+"""change log
+
+Revision ID: 6a3f8d2b7e41
+Revises: 1c7d0e93a5f2
+Create Date: 2021-04-26 20:33:48.094512
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6a3f8d2b7e41'
+down_revision = '1c7d0e93a5f2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_log',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('entity', sa.String(length=20), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('operation', sa.String(length=10), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+    # Existing rows become inserts, so clients can start from cursor 0
+    for entity, table in (('produtor', 'produtor_rural'), ('lavoura', 'lavoura')):
+        op.execute(
+            "INSERT INTO change_log (entity, entity_id, operation, created_at)"
+            f" SELECT '{entity}', id, 'insert', CURRENT_TIMESTAMP FROM {table}"
+            " ORDER BY id"
+        )
+
+
+def downgrade():
+    op.drop_table('change_log')
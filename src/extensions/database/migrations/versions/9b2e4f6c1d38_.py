@@ -0,0 +1,146 @@
+"""perda indexes and yearly partitions
+
+Revision ID: 9b2e4f6c1d38
+Revises: 4ecd5a16ca3a
+Create Date: 2021-04-22 18:41:37.502214
+
+"""
+from datetime import date
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b2e4f6c1d38'
+down_revision = '4ecd5a16ca3a'
+branch_labels = None
+depends_on = None
+
+
+def _is_postgresql():
+    return op.get_bind().dialect.name == 'postgresql'
+
+
+def _partition_perda():
+    """Rebuilds `perda` as a table range partitioned by `data`
+
+    PostgreSQL 11+: the primary key must include the partition key, and
+    rows outside every yearly partition go to `perda_default`. As the
+    key is (id, data), `id` alone is kept unique by a trigger instead
+    """
+    bind = op.get_bind()
+    first_year, last_year = bind.execute(
+        sa.text(
+            'SELECT EXTRACT(YEAR FROM MIN(data))::int,'
+            ' EXTRACT(YEAR FROM MAX(data))::int FROM perda'
+        )
+    ).first()
+    current_year = date.today().year
+    first_year = min(first_year or current_year, current_year)
+    last_year = max(last_year or current_year, current_year) + 1
+
+    op.execute('ALTER TABLE perda RENAME TO perda_old')
+    op.execute('ALTER INDEX perda_pkey RENAME TO perda_old_pkey')
+    # Keeps the id sequence alive when the old table is dropped
+    op.execute('ALTER SEQUENCE perda_id_seq OWNED BY NONE')
+    op.execute('''
+        CREATE TABLE perda (
+            id integer NOT NULL DEFAULT nextval('perda_id_seq'),
+            data date NOT NULL,
+            evento integer NOT NULL,
+            produtor_rural_id integer NOT NULL
+                REFERENCES produtor_rural (id),
+            lavoura_id integer NOT NULL REFERENCES lavoura (id),
+            CONSTRAINT perda_pkey PRIMARY KEY (id, data)
+        ) PARTITION BY RANGE (data)
+    ''')
+    for year in range(first_year, last_year + 1):
+        op.execute(
+            f'CREATE TABLE perda_y{year} PARTITION OF perda'
+            f" FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+        )
+    op.execute('CREATE TABLE perda_default PARTITION OF perda DEFAULT')
+    op.execute(
+        'INSERT INTO perda (id, data, evento, produtor_rural_id, lavoura_id)'
+        ' SELECT id, data, evento, produtor_rural_id, lavoura_id'
+        ' FROM perda_old'
+    )
+    op.execute('DROP TABLE perda_old')
+    op.execute('ALTER SEQUENCE perda_id_seq OWNED BY perda.id')
+    _guard_perda_id()
+
+
+def _guard_perda_id():
+    """Rejects a second `perda` row with the same id
+
+    Ids from the sequence never clash, but one given explicitly could.
+    The advisory lock serializes writers of the same id, so a concurrent
+    transaction sees the other row once it commits
+    """
+    op.execute('''
+        CREATE FUNCTION perda_unique_id() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock(
+                'perda'::regclass::oid::int, NEW.id
+            );
+            IF (SELECT count(*) FROM perda WHERE id = NEW.id) > 1 THEN
+                RAISE unique_violation USING
+                    MESSAGE = format('duplicate perda id %s', NEW.id),
+                    CONSTRAINT = 'perda_id_key';
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    op.execute(
+        'CREATE TRIGGER perda_unique_id AFTER INSERT OR UPDATE OF id'
+        ' ON perda FOR EACH ROW EXECUTE PROCEDURE perda_unique_id()'
+    )
+
+
+def _unpartition_perda():
+    op.execute('DROP TRIGGER perda_unique_id ON perda')
+    op.execute('DROP FUNCTION perda_unique_id()')
+    op.execute('ALTER TABLE perda RENAME TO perda_partitioned')
+    op.execute('ALTER INDEX perda_pkey RENAME TO perda_partitioned_pkey')
+    op.execute('ALTER SEQUENCE perda_id_seq OWNED BY NONE')
+    op.execute('''
+        CREATE TABLE perda (
+            id integer NOT NULL DEFAULT nextval('perda_id_seq'),
+            data date NOT NULL,
+            evento integer NOT NULL,
+            produtor_rural_id integer NOT NULL
+                REFERENCES produtor_rural (id),
+            lavoura_id integer NOT NULL REFERENCES lavoura (id),
+            CONSTRAINT perda_pkey PRIMARY KEY (id)
+        )
+    ''')
+    op.execute(
+        'INSERT INTO perda (id, data, evento, produtor_rural_id, lavoura_id)'
+        ' SELECT id, data, evento, produtor_rural_id, lavoura_id'
+        ' FROM perda_partitioned'
+    )
+    # Dropping the parent drops every attached partition
+    op.execute('DROP TABLE perda_partitioned')
+    op.execute('ALTER SEQUENCE perda_id_seq OWNED BY perda.id')
+
+
+def upgrade():
+    if _is_postgresql():
+        _partition_perda()
+        # Losses are reported roughly in date order, so a BRIN index is
+        # tiny and good enough for the date range reports
+        op.create_index('ix_perda_data_brin', 'perda', ['data'], unique=False, postgresql_using='brin')
+    op.create_index(op.f('ix_perda_produtor_rural_id'), 'perda', ['produtor_rural_id'], unique=False)
+    op.create_index(op.f('ix_perda_lavoura_id'), 'perda', ['lavoura_id'], unique=False)
+    op.create_index('ix_perda_data_evento', 'perda', ['data', 'evento'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_perda_data_evento', table_name='perda')
+    op.drop_index(op.f('ix_perda_lavoura_id'), table_name='perda')
+    op.drop_index(op.f('ix_perda_produtor_rural_id'), table_name='perda')
+    if _is_postgresql():
+        op.drop_index('ix_perda_data_brin', table_name='perda')
+        _unpartition_perda()
@@ -0,0 +1,86 @@
+"""produtor name search
+
+Revision ID: d5e8a1f04b6c
+Revises: 6a3f8d2b7e41
+Create Date: 2021-04-28 11:27:05.661980
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5e8a1f04b6c'
+down_revision = '6a3f8d2b7e41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS unaccent')
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        # unaccent() is only STABLE, and index expressions must be
+        # IMMUTABLE, so it is wrapped with its dictionary fixed
+        op.execute('''
+            CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS
+            $$ SELECT public.unaccent('public.unaccent', $1) $$
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        ''')
+        op.execute(
+            'CREATE INDEX ix_produtor_rural_nome_trgm ON produtor_rural'
+            ' USING gin (f_unaccent(lower(nome)) gin_trgm_ops)'
+        )
+        op.execute(
+            'CREATE INDEX ix_produtor_rural_nome_tsv ON produtor_rural'
+            " USING gin (to_tsvector('simple', f_unaccent(nome)))"
+        )
+    elif dialect == 'sqlite':
+        op.execute('''
+            CREATE VIRTUAL TABLE produtor_rural_fts USING fts5(
+                nome,
+                content='produtor_rural',
+                content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        ''')
+        op.execute('''
+            CREATE TRIGGER produtor_rural_fts_insert
+            AFTER INSERT ON produtor_rural BEGIN
+                INSERT INTO produtor_rural_fts (rowid, nome)
+                VALUES (new.id, new.nome);
+            END
+        ''')
+        op.execute('''
+            CREATE TRIGGER produtor_rural_fts_delete
+            AFTER DELETE ON produtor_rural BEGIN
+                INSERT INTO produtor_rural_fts (produtor_rural_fts, rowid, nome)
+                VALUES ('delete', old.id, old.nome);
+            END
+        ''')
+        op.execute('''
+            CREATE TRIGGER produtor_rural_fts_update
+            AFTER UPDATE OF nome ON produtor_rural BEGIN
+                INSERT INTO produtor_rural_fts (produtor_rural_fts, rowid, nome)
+                VALUES ('delete', old.id, old.nome);
+                INSERT INTO produtor_rural_fts (rowid, nome)
+                VALUES (new.id, new.nome);
+            END
+        ''')
+        op.execute(
+            "INSERT INTO produtor_rural_fts (produtor_rural_fts)"
+            " VALUES ('rebuild')"
+        )
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute('DROP INDEX ix_produtor_rural_nome_tsv')
+        op.execute('DROP INDEX ix_produtor_rural_nome_trgm')
+        op.execute('DROP FUNCTION f_unaccent(text)')
+    elif dialect == 'sqlite':
+        op.execute('DROP TRIGGER produtor_rural_fts_update')
+        op.execute('DROP TRIGGER produtor_rural_fts_delete')
+        op.execute('DROP TRIGGER produtor_rural_fts_insert')
+        op.execute('DROP TABLE produtor_rural_fts')
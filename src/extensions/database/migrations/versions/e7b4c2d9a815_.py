@@ -0,0 +1,55 @@
+"""perda summaries
+
+Revision ID: e7b4c2d9a815
+Revises: d5e8a1f04b6c
+Create Date: 2021-04-29 15:02:41.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7b4c2d9a815'
+down_revision = 'd5e8a1f04b6c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('produtor_perda_resumo',
+    sa.Column('produtor_rural_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('perdas', sa.Integer(), nullable=False),
+    sa.Column('ultima_perda', sa.Date(), nullable=False),
+    sa.Column('evento_frequente', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['produtor_rural_id'], ['produtor_rural.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('produtor_rural_id')
+    )
+    op.create_table('lavoura_perda_resumo',
+    sa.Column('lavoura_id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('perdas', sa.Integer(), nullable=False),
+    sa.Column('ultima_perda', sa.Date(), nullable=False),
+    sa.Column('evento_frequente', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['lavoura_id'], ['lavoura.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('lavoura_id')
+    )
+    # Same aggregation as `flask perda-summaries reconcile`
+    for table, column in (
+        ('produtor_perda_resumo', 'produtor_rural_id'),
+        ('lavoura_perda_resumo', 'lavoura_id'),
+    ):
+        op.execute(
+            f"INSERT INTO {table}"
+            f" ({column}, perdas, ultima_perda, evento_frequente)"
+            f" SELECT perda.{column}, count(*), max(perda.data),"
+            " (SELECT frequente.evento FROM perda AS frequente"
+            f" WHERE frequente.{column} = perda.{column}"
+            " GROUP BY frequente.evento"
+            " ORDER BY count(*) DESC, frequente.evento LIMIT 1)"
+            f" FROM perda GROUP BY perda.{column}"
+        )
+
+
+def downgrade():
+    op.drop_table('lavoura_perda_resumo')
+    op.drop_table('produtor_perda_resumo')
@@ -0,0 +1,42 @@
+"""tile counters
+
+Revision ID: f3a9c6e1b274
+Revises: e7b4c2d9a815
+Create Date: 2021-05-03 10:12:37.540118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3a9c6e1b274'
+down_revision = 'e7b4c2d9a815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('tile_cell',
+    sa.Column('z', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('x', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('y', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('cell_x', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('cell_y', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('counter', sa.String(length=210), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('latitude', sa.Float(), nullable=False),
+    sa.Column('longitude', sa.Float(), nullable=False),
+    sa.PrimaryKeyConstraint('z', 'x', 'y', 'cell_x', 'cell_y', 'counter')
+    )
+    # Cached tiles are rebuilt on their next read, with their counters
+    op.execute('DELETE FROM tile_cache')
+    with op.batch_alter_table('tile_cache') as batch_op:
+        batch_op.drop_column('data')
+
+
+def downgrade():
+    op.execute('DELETE FROM tile_cache')
+    with op.batch_alter_table('tile_cache') as batch_op:
+        batch_op.add_column(sa.Column('data', sa.Text(), nullable=False))
+    op.drop_table('tile_cell')
@@ -0,0 +1,346 @@
+import csv
+import io
+from datetime import date
+from itertools import islice
+
+import click
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+
+from src.extensions.database import db
+from src.models import EVENTOS, Lavoura, Perda, ProdutorRural
+
+COLUMNS = (
+    "perda_id",
+    "data",
+    "evento",
+    "evento_nome",
+    "produtor_rural_id",
+    "produtor_nome",
+    "produtor_cpf",
+    "lavoura_id",
+    "latitude",
+    "longitude",
+    "tipo",
+)
+
+FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+def parse_filters(
+    inicio: str = None, fim: str = None, evento: str = None
+) -> dict:
+    """Validates the export filters
+
+    Parameters
+    ----------
+    inicio : str, optional
+        First date (ISO format) to export, by default None
+    fim : str, optional
+        Last date (ISO format) to export, by default None
+    evento : str, optional
+        Evento code to export, by default None
+
+    Returns
+    -------
+    dict
+        The parsed filters, ready for `perdas_query`
+
+    Raises
+    ------
+    ValueError
+        If any of the filters is invalid
+    """
+    filters = {}
+    for name, value in (("inicio", inicio), ("fim", fim)):
+        if value:
+            try:
+                filters[name] = date.fromisoformat(value)
+            except ValueError:
+                raise ValueError(f"Field '{name}' must be a YYYY-MM-DD date")
+    if evento:
+        try:
+            filters["evento"] = int(evento)
+        except ValueError:
+            filters["evento"] = None
+        if filters["evento"] not in EVENTOS:
+            raise ValueError(
+                "Field 'evento' must be one of "
+                + ", ".join(str(code) for code in EVENTOS)
+            )
+    return filters
+
+
+def perdas_query(inicio: date = None, fim: date = None, evento: int = None):
+    """Builds the `Perda` x `ProdutorRural` x `Lavoura` export query
+
+    Parameters
+    ----------
+    inicio : date, optional
+        by default None
+    fim : date, optional
+        by default None
+    evento : int, optional
+        by default None
+
+    Returns
+    -------
+    Query
+        A columns-only query, ordered by `Perda.id`
+    """
+    query = (
+        db.session.query(
+            Perda.id,
+            Perda.data,
+            Perda.evento,
+            ProdutorRural.id,
+            ProdutorRural.nome,
+            ProdutorRural.cpf,
+            Lavoura.id,
+            Lavoura.latitude,
+            Lavoura.longitude,
+            Lavoura.tipo,
+        )
+        .join(ProdutorRural, Perda.produtor_rural_id == ProdutorRural.id)
+        .join(Lavoura, Perda.lavoura_id == Lavoura.id)
+    )
+    if inicio is not None:
+        query = query.filter(Perda.data >= inicio)
+    if fim is not None:
+        query = query.filter(Perda.data <= fim)
+    if evento is not None:
+        query = query.filter(Perda.evento == evento)
+
+    return query.order_by(Perda.id)
+
+
+def iter_batches(query, batch_size: int):
+    """Reads a query through a server side cursor, in fixed size batches
+
+    Parameters
+    ----------
+    query : Query
+    batch_size : int
+
+    Yields
+    -------
+    list[tuple]
+        Up to `batch_size` rows, already in `COLUMNS` order
+    """
+    rows = iter(query.yield_per(batch_size))
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield [
+            (
+                perda_id,
+                data,
+                evento,
+                EVENTOS.get(evento),
+                produtor_rural_id,
+                nome,
+                cpf,
+                lavoura_id,
+                latitude,
+                longitude,
+                tipo,
+            )
+            for (
+                perda_id,
+                data,
+                evento,
+                produtor_rural_id,
+                nome,
+                cpf,
+                lavoura_id,
+                latitude,
+                longitude,
+                tipo,
+            ) in batch
+        ]
+
+
+class _ChunkSink:
+    """Write-only file object that hands back whatever was written to it
+
+    It lets pyarrow writers be drained between record batches, so the
+    output can be streamed without being kept in memory.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_csv(batches):
+    """Serializes row batches as CSV
+
+    Yields
+    -------
+    str
+        The header, then one chunk per batch
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("perda_id", pa.int64()),
+            ("data", pa.date32()),
+            ("evento", pa.int8()),
+            ("evento_nome", pa.string()),
+            ("produtor_rural_id", pa.int64()),
+            ("produtor_nome", pa.string()),
+            ("produtor_cpf", pa.string()),
+            ("lavoura_id", pa.int64()),
+            ("latitude", pa.float64()),
+            ("longitude", pa.float64()),
+            ("tipo", pa.string()),
+        ]
+    )
+
+
+def _record_batch(batch, schema):
+    import pyarrow as pa
+
+    columns = list(zip(*batch))
+    return pa.record_batch(
+        [
+            pa.array(column, type=field.type)
+            for column, field in zip(columns, schema)
+        ],
+        schema=schema,
+    )
+
+
+def stream_parquet(batches):
+    """Serializes row batches as a Parquet file, one row group per batch
+
+    Yields
+    -------
+    bytes
+    """
+    import pyarrow.parquet as pq
+
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for batch in batches:
+        writer.write_batch(_record_batch(batch, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_arrow(batches):
+    """Serializes row batches as an Arrow IPC stream
+
+    Yields
+    -------
+    bytes
+    """
+    import pyarrow as pa
+
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for batch in batches:
+        writer.write_batch(_record_batch(batch, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_perdas(format: str = "csv", batch_size: int = None, **filters):
+    """Streams the joined `Perda` history in the given format
+
+    Parameters
+    ----------
+    format : str, optional
+        One of `FORMATS`, by default "csv"
+    batch_size : int, optional
+        Rows read and serialized at a time, by default EXPORT_BATCH_SIZE
+
+    Returns
+    -------
+    generator
+        Chunks of str (csv) or bytes (parquet and arrow)
+    """
+    if batch_size is None:
+        batch_size = int(current_app.config["EXPORT_BATCH_SIZE"])
+    batches = iter_batches(perdas_query(**filters), batch_size)
+    if format == "parquet":
+        return stream_parquet(batches)
+    if format == "arrow":
+        return stream_arrow(batches)
+    return stream_csv(batches)
+
+
+@click.command("export-perdas")
+@click.option(
+    "--format",
+    "format_",
+    type=click.Choice(list(FORMATS)),
+    default="csv",
+    show_default=True,
+)
+@click.option("--inicio", help="First date, YYYY-MM-DD")
+@click.option("--fim", help="Last date, YYYY-MM-DD")
+@click.option("--evento", help="Evento code")
+@click.option("--batch-size", type=int, help="Rows per batch")
+@click.argument("output", type=click.File("wb"), default="-")
+@with_appcontext
+def export_perdas_command(format_, inicio, fim, evento, batch_size, output):
+    """Exports the loss history joined with producers and crops"""
+    try:
+        filters = parse_filters(inicio=inicio, fim=fim, evento=evento)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+    for chunk in export_perdas(
+        format=format_, batch_size=batch_size, **filters
+    ):
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        output.write(chunk)
+
+
+def init_app(app: Flask):
+    app.cli.add_command(export_perdas_command)
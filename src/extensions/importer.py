@@ -0,0 +1,338 @@
+import csv
+import io
+from itertools import islice
+
+import click
+import numpy as np
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+
+from src.extensions import capture
+from src.extensions.database import db
+from src.extensions.tiles import update_tiles
+from src.models import STRING_BASE_LENGTH, Lavoura
+
+COLUMNS = ("latitude", "longitude", "tipo")
+
+# Coordinates are compared with 6 decimal places (~0.1 m)
+COORDINATE_SCALE = 1_000_000
+_LONGITUDE_SPAN = 360 * COORDINATE_SCALE + 1
+
+# Rows per INSERT ... RETURNING statement, 3 bind parameters each
+RETURNING_BATCH_SIZE = 1000
+
+
+class InvalidFileError(Exception):
+    pass
+
+
+def coordinate_keys(
+    latitudes: np.ndarray, longitudes: np.ndarray
+) -> np.ndarray:
+    """Packs valid coordinate pairs into single int64 keys
+
+    Two coordinates have the same key if they are equal up to
+    `COORDINATE_SCALE`, so they can be deduplicated with plain numpy set
+    operations
+
+    Parameters
+    ----------
+    latitudes : np.ndarray
+    longitudes : np.ndarray
+
+    Returns
+    -------
+    np.ndarray
+        int64 keys
+    """
+    latitudes = np.rint((latitudes + 90) * COORDINATE_SCALE).astype(np.int64)
+    longitudes = np.rint((longitudes + 180) * COORDINATE_SCALE).astype(
+        np.int64
+    )
+    return latitudes * _LONGITUDE_SPAN + longitudes
+
+
+def _to_float(column: np.ndarray) -> np.ndarray:
+    """Converts a text column to float64, with NaN for invalid values"""
+    try:
+        return column.astype(np.float64)
+    except ValueError:
+        # Only dirty chunks pay for the value by value conversion
+        values = np.full(len(column), np.nan)
+        for index, value in enumerate(column):
+            try:
+                values[index] = float(value)
+            except ValueError:
+                pass
+        return values
+
+
+def _allowed_tipos() -> list:
+    tipos = current_app.config["LAVOURA_TIPOS"]
+    if isinstance(tipos, str):
+        tipos = [tipo.strip() for tipo in tipos.split(",") if tipo.strip()]
+    return list(tipos)
+
+
+def _existing_keys() -> np.ndarray:
+    coordinates = np.array(
+        db.session.query(Lavoura.latitude, Lavoura.longitude).all(),
+        dtype=np.float64,
+    ).reshape(-1, 2)
+    return np.unique(coordinate_keys(coordinates[:, 0], coordinates[:, 1]))
+
+
+def _insert_lavouras(values: list) -> list:
+    """Inserts crops in the session transaction
+
+    Returns
+    -------
+    list
+        (id, latitude, longitude, tipo) of the inserted rows only, even
+        when other transactions insert crops meanwhile
+    """
+    table = Lavoura.__table__
+    columns = [table.c.id, table.c.latitude, table.c.longitude, table.c.tipo]
+    if db.session.get_bind().dialect.name == "postgresql":
+        inserted = []
+        # Keeps the statement under the bind parameter limit
+        for start in range(0, len(values), RETURNING_BATCH_SIZE):
+            end = start + RETURNING_BATCH_SIZE
+            inserted.extend(
+                db.session.execute(
+                    table.insert()
+                    .values(values[start:end])
+                    .returning(*columns)
+                )
+            )
+        return inserted
+
+    # SQLite has a single writer, which holds the lock until it commits, so
+    # the newest rows are the ones just inserted
+    db.session.execute(table.insert(), values)
+    return db.session.execute(
+        select(columns).order_by(table.c.id.desc()).limit(len(values))
+    ).fetchall()
+
+
+def validate_chunk(
+    rows: list, seen_keys: np.ndarray, allowed_tipos: list = None
+) -> tuple:
+    """Validates a chunk of CSV rows with vectorized operations
+
+    Parameters
+    ----------
+    rows : list[list[str]]
+        Raw CSV rows, in `COLUMNS` order
+    seen_keys : np.ndarray
+        Sorted coordinate keys already in the database or in earlier
+        chunks
+    allowed_tipos : list, optional
+        Accepted `tipo` values. Any non empty value is accepted if empty,
+        by default None
+
+    Returns
+    -------
+    tuple
+        (valid, reasons, latitudes, longitudes, tipos, keys):
+        `valid` is a boolean mask over `rows` and `reasons` has the
+        rejection reason for the invalid ones
+    """
+    size = len(rows)
+    reasons = np.full(size, "", dtype=object)
+    lengths = np.fromiter(map(len, rows), dtype=np.int64, count=size)
+    well_formed = lengths == len(COLUMNS)
+    reasons[~well_formed] = f"Expected {len(COLUMNS)} columns"
+
+    padded = [
+        row if ok else ("", "", "") for row, ok in zip(rows, well_formed)
+    ]
+    columns = [
+        np.char.strip(np.array(column, dtype=str)) for column in zip(*padded)
+    ]
+    latitudes = _to_float(columns[0])
+    longitudes = _to_float(columns[1])
+    tipos = columns[2]
+
+    valid = well_formed.copy()
+
+    bad_latitude = valid & ~(np.abs(latitudes) <= 90)
+    reasons[bad_latitude] = "Invalid latitude"
+    valid &= ~bad_latitude
+
+    bad_longitude = valid & ~(np.abs(longitudes) <= 180)
+    reasons[bad_longitude] = "Invalid longitude"
+    valid &= ~bad_longitude
+
+    tipo_lengths = np.char.str_len(tipos)
+    good_tipo = (tipo_lengths > 0) & (tipo_lengths <= STRING_BASE_LENGTH)
+    if allowed_tipos:
+        good_tipo &= np.isin(tipos, allowed_tipos)
+    bad_tipo = valid & ~good_tipo
+    reasons[bad_tipo] = "Invalid tipo"
+    valid &= ~bad_tipo
+
+    keys = np.zeros(size, dtype=np.int64)
+    keys[valid] = coordinate_keys(latitudes[valid], longitudes[valid])
+
+    valid_indexes = np.flatnonzero(valid)
+    _, first = np.unique(keys[valid_indexes], return_index=True)
+    repeated = np.ones(len(valid_indexes), dtype=bool)
+    repeated[first] = False
+    repeated |= np.isin(keys[valid_indexes], seen_keys)
+    duplicated = valid_indexes[repeated]
+    reasons[duplicated] = "Duplicated coordinates"
+    valid[duplicated] = False
+
+    return valid, reasons, latitudes, longitudes, tipos, keys
+
+
+def import_lavouras(
+    file,
+    chunk_size: int = None,
+    report: io.TextIOBase = None,
+    on_chunk: callable = None,
+) -> dict:
+    """Bulk imports `Lavoura` rows from a CSV file
+
+    The file must have a `latitude,longitude,tipo` header. It is read,
+    validated and inserted in chunks, each chunk in its own transaction.
+
+    Parameters
+    ----------
+    file : io.TextIOBase
+        The CSV file, opened in text mode
+    chunk_size : int, optional
+        Rows per chunk, by default IMPORT_CHUNK_SIZE
+    report : io.TextIOBase, optional
+        Where the rejected rows are written, as CSV, by default None
+    on_chunk : callable, optional
+        Called with the partial result after each chunk is committed, by
+        default None
+
+    Returns
+    -------
+    dict
+        {"inseridas", "rejeitadas", "rejeicoes"}. `rejeicoes` lists the
+        rejected rows only when there is no `report` file
+
+    Raises
+    ------
+    InvalidFileError
+        If the header is missing or wrong
+    """
+    if chunk_size is None:
+        chunk_size = int(current_app.config["IMPORT_CHUNK_SIZE"])
+
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if (
+        header is None
+        or tuple(column.strip().lower() for column in header) != COLUMNS
+    ):
+        raise InvalidFileError("The CSV header must be: " + ",".join(COLUMNS))
+
+    report_writer = None
+    if report is not None:
+        report_writer = csv.writer(report)
+        report_writer.writerow(("linha", "motivo", *COLUMNS))
+
+    allowed_tipos = _allowed_tipos()
+    seen_keys = _existing_keys()
+    result = {"inseridas": 0, "rejeitadas": 0, "rejeicoes": []}
+    first_line = 2
+
+    while True:
+        rows = list(islice(reader, chunk_size))
+        if not rows:
+            break
+
+        valid, reasons, latitudes, longitudes, tipos, keys = validate_chunk(
+            rows, seen_keys, allowed_tipos
+        )
+
+        if valid.any():
+            inserted = _insert_lavouras(
+                [
+                    {
+                        "latitude": latitude,
+                        "longitude": longitude,
+                        "tipo": tipo,
+                    }
+                    for latitude, longitude, tipo in zip(
+                        latitudes[valid].tolist(),
+                        longitudes[valid].tolist(),
+                        tipos[valid].tolist(),
+                    )
+                ]
+            )
+            capture.track(
+                db.session,
+                Lavoura,
+                (
+                    {
+                        "id": lavoura_id,
+                        "latitude": latitude,
+                        "longitude": longitude,
+                        "tipo": tipo,
+                    }
+                    for lavoura_id, latitude, longitude, tipo in inserted
+                ),
+            )
+            update_tiles(
+                db.session,
+                lavouras=[
+                    (latitude, longitude, tipo, 1)
+                    for _, latitude, longitude, tipo in inserted
+                ],
+            )
+            db.session.commit()
+            seen_keys = np.union1d(seen_keys, keys[valid])
+            result["inseridas"] += int(valid.sum())
+
+        for index in np.flatnonzero(~valid).tolist():
+            line = first_line + index
+            if report_writer is not None:
+                report_writer.writerow((line, reasons[index], *rows[index]))
+            else:
+                result["rejeicoes"].append(
+                    {
+                        "linha": line,
+                        "motivo": reasons[index],
+                        "valores": rows[index],
+                    }
+                )
+        result["rejeitadas"] += int((~valid).sum())
+        first_line += len(rows)
+        if on_chunk is not None:
+            on_chunk(result)
+
+    return result
+
+
+@click.command("import-lavouras")
+@click.argument("file", type=click.File("r", encoding="utf-8-sig"))
+@click.option(
+    "--report",
+    type=click.File("w"),
+    default="-",
+    help="Where the rejected rows are written, as CSV",
+)
+@click.option("--chunk-size", type=int, help="Rows per chunk")
+@with_appcontext
+def import_lavouras_command(file, report, chunk_size):
+    """Bulk imports crop plots from a latitude,longitude,tipo CSV file"""
+    try:
+        result = import_lavouras(file, chunk_size=chunk_size, report=report)
+    except InvalidFileError as e:
+        raise click.BadParameter(str(e))
+
+    click.echo(
+        f"{result['inseridas']} inserted, {result['rejeitadas']} rejected",
+        err=True,
+    )
+
+
+def init_app(app: Flask):
+    app.cli.add_command(import_lavouras_command)
@@ -0,0 +1,172 @@
+import queue
+import threading
+from concurrent.futures import Future, TimeoutError
+from time import monotonic
+
+from flask import Flask, current_app
+
+from src.extensions.database import db
+from src.utils import is_enabled
+
+
+class IngestTimeoutError(Exception):
+    pass
+
+
+class GroupCommitter:
+    """Commits rows written by many requests in shared transactions
+
+    Requests hand their rows to a single flusher thread, which commits
+    whatever arrived within `max_delay` seconds (up to `max_batch` rows)
+    in one transaction, so the commit and its fsync are paid once per
+    batch. When a batch fails, its rows are committed one by one, so a
+    bad row only fails its own request.
+    """
+
+    def __init__(
+        self, app: Flask, max_batch: int, max_delay: float, queue_size: int
+    ):
+        self.app = app
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.flusher = None
+
+    def submit(self, model, values: dict, timeout: float) -> Future:
+        """Queues a row to be inserted
+
+        Returns
+        -------
+        Future
+            Resolves to the row id once its batch is committed
+
+        Raises
+        ------
+        IngestTimeoutError
+            If the queue stays full for `timeout` seconds
+        """
+        with self.lock:
+            if self.flusher is None:
+                self.flusher = threading.Thread(
+                    target=self._flush_forever, name="ingest", daemon=True
+                )
+                self.flusher.start()
+
+        future = Future()
+        try:
+            self.queue.put((model, values, future), timeout=timeout)
+        except queue.Full:
+            raise IngestTimeoutError("Too many pending writes, try again")
+        return future
+
+    def _flush_forever(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            # Requests that gave up waiting are not written
+            batch = [
+                item
+                for item in batch
+                if item[2].set_running_or_notify_cancel()
+            ]
+            if batch:
+                with self.app.app_context():
+                    self._commit(batch)
+
+    def _commit(self, batch: list):
+        try:
+            instances = [model(**values) for model, values, _ in batch]
+            db.session.add_all(instances)
+            db.session.flush()
+            ids = [instance.id for instance in instances]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            for item in batch:
+                self._commit_one(*item)
+            return
+
+        for (_, _, future), row_id in zip(batch, ids):
+            future.set_result(row_id)
+
+    def _commit_one(self, model, values: dict, future: Future):
+        try:
+            instance = model(**values)
+            db.session.add(instance)
+            db.session.flush()
+            row_id = instance.id
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            future.set_exception(e)
+        else:
+            future.set_result(row_id)
+
+
+def write(model, **values) -> int:
+    """Inserts a row, through the group commit when it is enabled
+
+    Rows written inside a savepoint always use the caller's session
+
+    Parameters
+    ----------
+    model : db.Model
+    **values
+        Column values of the new row
+
+    Returns
+    -------
+    int
+        The new row id
+
+    Raises
+    ------
+    IngestTimeoutError
+        If the group commit did not confirm the write in `INGEST_TIMEOUT`
+        seconds. The row may still be committed later
+    Exception
+        Whatever the insert raised, e.g. `IntegrityError`
+    """
+    committer = current_app.extensions.get("group_committer")
+    # Inside a savepoint (e.g. an atomic batch) the row must be part of the
+    # caller's transaction, which the flusher thread can not join
+    if committer is None or db.session().transaction.nested:
+        instance = model(**values)
+        db.session.add(instance)
+        try:
+            db.session.flush()
+            row_id = instance.id
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return row_id
+
+    timeout = float(current_app.config["INGEST_TIMEOUT"])
+    future = committer.submit(model, values, timeout)
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        future.cancel()
+        raise IngestTimeoutError("Write not confirmed in time")
+
+
+def init_app(app: Flask):
+    if not is_enabled(app.config["INGEST_GROUP_COMMIT"]):
+        return
+
+    app.extensions["group_committer"] = GroupCommitter(
+        app,
+        max_batch=int(app.config["INGEST_MAX_BATCH"]),
+        max_delay=int(app.config["INGEST_MAX_DELAY_MS"]) / 1000,
+        queue_size=int(app.config["INGEST_QUEUE_SIZE"]),
+    )
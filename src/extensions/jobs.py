@@ -0,0 +1,558 @@
+import io
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from flask import Flask, current_app
+from sqlalchemy.exc import DBAPIError
+from flask.cli import AppGroup
+from sqlalchemy import and_, or_, select
+
+from src.extensions.database import db
+from src.extensions.export import (
+    FORMATS,
+    export_perdas,
+    parse_filters,
+    perdas_query,
+)
+from src.extensions.importer import import_lavouras
+from src.extensions.snapshot import MODELS as SNAPSHOT_MODELS
+from src.extensions.snapshot import build_snapshot
+from src.extensions.summaries import rebuild_summaries
+from src.extensions.tiles import build_tiles
+from src.models import Job, Perda
+
+# Losses deleted per transaction by the delete_perdas job
+DELETE_BATCH_SIZE = 500
+
+HANDLERS = {}
+
+jobs_cli = AppGroup("jobs", help="Runs and manages background jobs")
+
+
+class UnknownJobError(Exception):
+    pass
+
+
+class JobCancelledError(Exception):
+    pass
+
+
+def handler(kind: str, max_attempts: int = 1) -> callable:
+    """Registers a function as the handler of a job kind
+
+    The handler receives a `JobContext` and the job params as keyword
+    arguments. Its return value must be JSON serializable.
+
+    Parameters
+    ----------
+    kind : str
+    max_attempts : int, optional
+        How many times a failing job runs before it is marked as failed,
+        by default 1
+
+    Returns
+    -------
+    callable
+        The decorator
+    """
+
+    def decorator(func):
+        HANDLERS[kind] = (func, max_attempts)
+        return func
+
+    return decorator
+
+
+class JobContext:
+    """What a running job handler can see of its own job"""
+
+    def __init__(self, job_id: int):
+        self.job_id = job_id
+
+    def progress(self, fraction: float):
+        """Saves the job progress and checks if it was cancelled
+
+        It uses its own connection, so the handler transaction is left
+        untouched
+
+        Parameters
+        ----------
+        fraction : float
+            From 0 to 1
+
+        Raises
+        ------
+        JobCancelledError
+            If the job cancellation was requested
+        """
+        table = Job.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                table.update()
+                .where(table.c.id == self.job_id)
+                .values(
+                    progress=min(max(fraction, 0), 1),
+                    heartbeat_at=datetime.utcnow(),
+                )
+            )
+            cancel_requested = connection.execute(
+                select([table.c.cancel_requested]).where(
+                    table.c.id == self.job_id
+                )
+            ).scalar()
+        if cancel_requested:
+            raise JobCancelledError()
+
+    def storage_path(self, extension: str) -> str:
+        """Returns the path of the file where the job can save its output"""
+        return storage_path(f"job-{self.job_id}.{extension}")
+
+
+class Heartbeat(threading.Thread):
+    """Keeps a running job from looking stale while its handler works
+
+    Handlers only report progress now and then (e.g. once per tile zoom
+    level), so the heartbeat is refreshed from this thread instead,
+    using its own connection
+    """
+
+    def __init__(self, engine, job_id: int, interval: float):
+        super().__init__(name=f"job-{job_id}-heartbeat", daemon=True)
+        self.engine = engine
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        table = Job.__table__
+        while not self.stopped.wait(self.interval):
+            try:
+                with self.engine.begin() as connection:
+                    connection.execute(
+                        table.update()
+                        .where(
+                            and_(
+                                table.c.id == self.job_id,
+                                table.c.status == Job.RUNNING,
+                            )
+                        )
+                        .values(heartbeat_at=datetime.utcnow())
+                    )
+            except DBAPIError:
+                # e.g. SQLite still locked by the handler, the next beat
+                # will do
+                continue
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        self.join()
+
+
+def storage_path(filename: str) -> str:
+    """Returns the path of a file in the jobs storage directory"""
+    directory = current_app.config["JOBS_STORAGE_PATH"]
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def enqueue(kind: str, params: dict = None, owner: str = None) -> Job:
+    """Adds a job to the queue
+
+    Parameters
+    ----------
+    kind : str
+        One of the registered job kinds
+    params : dict, optional
+        The handler keyword arguments, by default None
+    owner : str, optional
+        The username of who asked for the job, by default None (jobs
+        enqueued from the command line, that no API user can see)
+
+    Returns
+    -------
+    Job
+
+    Raises
+    ------
+    UnknownJobError
+        If there is no handler for `kind`
+    """
+    if kind not in HANDLERS:
+        raise UnknownJobError(f"There is no {kind} job")
+
+    job = Job(
+        kind=kind,
+        status=Job.QUEUED,
+        params=json.dumps(params or {}),
+        max_attempts=HANDLERS[kind][1],
+        owner=owner,
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def claim_next() -> int:
+    """Marks the oldest runnable job as running
+
+    Jobs whose worker stopped sending heartbeats for JOBS_STALE_AFTER
+    seconds are runnable again, or failed if they have no attempts left
+
+    Returns
+    -------
+    int
+        The claimed job id, or None if the queue is empty
+    """
+    now = datetime.utcnow()
+    stale = and_(
+        Job.status == Job.RUNNING,
+        Job.heartbeat_at
+        < now - timedelta(seconds=int(current_app.config["JOBS_STALE_AFTER"])),
+    )
+    Job.query.filter(stale, Job.attempts >= Job.max_attempts).update(
+        {
+            Job.status: Job.FAILED,
+            Job.error: "The worker running this job was lost",
+            Job.finished_at: now,
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+
+    runnable = or_(Job.status == Job.QUEUED, stale)
+    candidates = (
+        db.session.query(Job.id).filter(runnable).order_by(Job.id).limit(10)
+    )
+    job_ids = [job_id for (job_id,) in candidates]
+    # On SQLite a transaction that read before another worker's claim can
+    # not write anymore, so each claim starts a new one
+    db.session.commit()
+    for job_id in job_ids:
+        # Only one worker can move it out of the runnable state
+        claimed = Job.query.filter(Job.id == job_id, runnable).update(
+            {
+                Job.status: Job.RUNNING,
+                Job.attempts: Job.attempts + 1,
+                Job.started_at: now,
+                Job.heartbeat_at: now,
+            },
+            synchronize_session=False,
+        )
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def run_job(job_id: int):
+    """Runs a claimed job and saves its outcome
+
+    Failing jobs go back to the queue while they have attempts left
+    """
+    job = Job.query.get(job_id)
+    func, _ = HANDLERS[job.kind]
+    params = json.loads(job.params)
+    # The heartbeat writes from another connection, and on SQLite a
+    # transaction that read before that write can not write anymore
+    db.session.commit()
+
+    heartbeat = Heartbeat(
+        db.engine,
+        job_id,
+        interval=float(current_app.config["JOBS_HEARTBEAT_INTERVAL"]),
+    )
+    try:
+        with heartbeat:
+            result = func(JobContext(job_id), **params)
+            db.session.commit()
+    except JobCancelledError:
+        db.session.rollback()
+        job.status = Job.CANCELLED
+        job.finished_at = datetime.utcnow()
+    except Exception:
+        db.session.rollback()
+        job.error = traceback.format_exc()
+        if job.attempts < job.max_attempts:
+            job.status = Job.QUEUED
+        else:
+            job.status = Job.FAILED
+            job.finished_at = datetime.utcnow()
+    else:
+        job.status = Job.SUCCEEDED
+        job.result = json.dumps(result)
+        job.error = None
+        job.progress = 1
+        job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+def work(poll_interval: float = 1, burst: bool = False, should_stop=None):
+    """Runs queued jobs until stopped
+
+    Parameters
+    ----------
+    poll_interval : float, optional
+        Seconds to wait when the queue is empty, by default 1
+    burst : bool, optional
+        Stops as soon as the queue is empty, by default False
+    should_stop : callable, optional
+        Checked between jobs, by default None
+    """
+    while should_stop is None or not should_stop():
+        job_id = claim_next()
+        if job_id is not None:
+            run_job(job_id)
+            db.session.remove()
+        elif burst:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+def cancel(job: Job) -> bool:
+    """Cancels a queued job or asks a running one to stop
+
+    Returns
+    -------
+    bool
+        False if the job has already finished
+    """
+    cancelled = Job.query.filter(
+        Job.id == job.id, Job.status == Job.QUEUED
+    ).update(
+        {Job.status: Job.CANCELLED, Job.finished_at: datetime.utcnow()},
+        synchronize_session=False,
+    )
+    if not cancelled:
+        cancelled = Job.query.filter(
+            Job.id == job.id, Job.status == Job.RUNNING
+        ).update({Job.cancel_requested: True}, synchronize_session=False)
+    db.session.commit()
+    return bool(cancelled)
+
+
+def retry(job: Job) -> bool:
+    """Puts a failed or cancelled job back in the queue
+
+    Returns
+    -------
+    bool
+        False if the job is not failed nor cancelled
+    """
+    retried = Job.query.filter(
+        Job.id == job.id, Job.status.in_((Job.FAILED, Job.CANCELLED))
+    ).update(
+        {
+            Job.status: Job.QUEUED,
+            Job.attempts: 0,
+            Job.progress: 0,
+            Job.cancel_requested: False,
+            Job.error: None,
+            Job.finished_at: None,
+        },
+        synchronize_session=False,
+    )
+    db.session.commit()
+    return bool(retried)
+
+
+def job_payload(job: Job) -> dict:
+    """Serializes a job for the API"""
+
+    def _datetime(value):
+        return value.isoformat() if value is not None else None
+
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "progress": job.progress,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "cancel_requested": job.cancel_requested,
+        "error": job.error,
+        "result": json.loads(job.result) if job.result else None,
+        "created_at": _datetime(job.created_at),
+        "started_at": _datetime(job.started_at),
+        "finished_at": _datetime(job.finished_at),
+    }
+
+
+@handler("import_lavouras")
+def _import_lavouras(context: JobContext, path: str) -> dict:
+    size = os.path.getsize(path) or 1
+    with open(path, "rb") as raw:
+        result = import_lavouras(
+            io.TextIOWrapper(raw, encoding="utf-8-sig", newline=""),
+            on_chunk=lambda partial: context.progress(raw.tell() / size),
+        )
+    os.remove(path)
+    return result
+
+
+@handler("export_perdas", max_attempts=3)
+def _export_perdas(context: JobContext, format: str = "csv", **filters):
+    filters = parse_filters(**filters)
+    batch_size = int(current_app.config["EXPORT_BATCH_SIZE"])
+    total = perdas_query(**filters).count() or 1
+    mimetype, extension = FORMATS[format]
+    path = context.storage_path(extension)
+
+    with open(path + ".part", "wb") as output:
+        for index, chunk in enumerate(
+            export_perdas(format=format, batch_size=batch_size, **filters)
+        ):
+            output.write(chunk.encode() if isinstance(chunk, str) else chunk)
+            context.progress(index * batch_size / total)
+    os.replace(path + ".part", path)
+
+    return {
+        "file": os.path.basename(path),
+        "mimetype": mimetype,
+        "filename": f"perdas.{extension}",
+    }
+
+
+@handler("build_tiles", max_attempts=3)
+def _build_tiles(context: JobContext, max_zoom: int = None):
+    if max_zoom is None:
+        max_zoom = int(current_app.config["TILE_MAX_ZOOM"])
+    build_tiles(
+        max_zoom=max_zoom,
+        on_zoom=lambda z, tiles: context.progress((z + 1) / (max_zoom + 1)),
+    )
+
+
+@handler("rebuild_summaries", max_attempts=3)
+def _rebuild_summaries(context: JobContext) -> dict:
+    # A single transaction, which holds the SQLite write lock, so there is
+    # no progress to report halfway
+    return rebuild_summaries()
+
+
+@handler("delete_perdas", max_attempts=3)
+def _delete_perdas(context: JobContext, **filters) -> dict:
+    filters = parse_filters(**filters)
+    ids = perdas_query(**filters).with_entities(Perda.id)
+    total = ids.count() or 1
+    deleted = 0
+    while True:
+        batch = [perda_id for (perda_id,) in ids.limit(DELETE_BATCH_SIZE)]
+        if not batch:
+            return {"deleted": deleted}
+        # Through the ORM, so the summaries, tiles and change subscribers
+        # see every loss go. A cancelled job keeps the batches it
+        # committed, and a retry deletes the rest
+        for perda in Perda.query.filter(Perda.id.in_(batch)):
+            db.session.delete(perda)
+        db.session.commit()
+        deleted += len(batch)
+        context.progress(deleted / total)
+
+
+@handler("build_snapshot", max_attempts=3)
+def _build_snapshot(context: JobContext) -> dict:
+    copied = []
+
+    def on_table(model):
+        copied.append(model)
+        context.progress(len(copied) / len(SNAPSHOT_MODELS))
+
+    latest = build_snapshot(on_table=on_table)
+    # Not a "file" of the jobs storage: snapshots are kept with the others
+    # and downloaded from /snapshot
+    return {key: value for key, value in latest.items() if key != "file"}
+
+
+def _worker_process(poll_interval: float, burst: bool):
+    from src.app import create_app
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+
+    with create_app().app_context():
+        work(poll_interval=poll_interval, burst=burst, should_stop=stop.is_set)
+
+
+@jobs_cli.command("worker")
+@click.option(
+    "--processes", type=int, default=1, show_default=True, help="Workers"
+)
+@click.option(
+    "--poll-interval",
+    type=float,
+    default=1,
+    show_default=True,
+    help="Seconds between polls when the queue is empty",
+)
+@click.option("--burst", is_flag=True, help="Stop when the queue is empty")
+def worker_command(processes, poll_interval, burst):
+    """Starts a pool of worker processes"""
+    context = multiprocessing.get_context("spawn")
+    workers = [
+        context.Process(target=_worker_process, args=(poll_interval, burst))
+        for _ in range(processes)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+
+
+def _param_value(value: str):
+    # Numbers, booleans and null as JSON, anything else as text
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+@jobs_cli.command("enqueue")
+@click.argument("kind")
+@click.option(
+    "--param", "-p", multiple=True, help="Handler argument, as key=value"
+)
+def enqueue_command(kind, param):
+    """Adds a job to the queue
+
+    Values that are valid JSON (e.g. max_zoom=2) are passed decoded
+    """
+    try:
+        params = {
+            key: _param_value(value)
+            for key, value in (value.split("=", 1) for value in param)
+        }
+    except ValueError:
+        raise click.BadParameter("Params must be key=value")
+    try:
+        job = enqueue(kind, params)
+    except UnknownJobError as e:
+        raise click.ClickException(
+            f"{e}. Known jobs: " + ", ".join(sorted(HANDLERS))
+        )
+    click.echo(job.id)
+
+
+def init_app(app: Flask):
+    if not app.config.get("JOBS_STORAGE_PATH"):
+        app.config["JOBS_STORAGE_PATH"] = os.path.join(
+            app.instance_path, "jobs"
+        )
+    app.cli.add_command(jobs_cli)
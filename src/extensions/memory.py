@@ -0,0 +1,233 @@
+import os
+import random
+import resource
+import threading
+import tracemalloc
+from collections import deque
+
+from flask import Flask, current_app, request
+
+from src.utils import is_enabled
+
+HEADER = "X-Profile-Memory"
+
+# WSGI environ keys of the profile of a request. Not kept in `g`, batch
+# sub-requests share it with their batch, and their teardown would end
+# the profile of the batch
+PROFILE_ENVIRON = "softfocus.memory_profile"
+STATUS_ENVIRON = "softfocus.memory_profile_status"
+
+_IGNORED_FILES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def current_rss() -> int:
+    """Returns the resident set size of the process in bytes
+
+    Falls back to the peak RSS where /proc is not available
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryProfiler:
+    """Collects per-route memory statistics
+
+    Every request to a profiled app gets its RSS delta recorded. Sampled
+    requests (or the ones carrying the `X-Profile-Memory` header with the
+    `PROFILING_TOKEN`) are also traced with `tracemalloc`, which keeps
+    their allocation peak and top allocation sites. `tracemalloc` is
+    process-wide, so only one request is traced at a time; the others
+    are just not traced. RSS is process-wide too, so deltas of
+    concurrent requests leak into each other and are best read as
+    per-route averages.
+    """
+
+    def __init__(self, sample_rate: float, top: int, frames: int, history):
+        self.sample_rate = sample_rate
+        self.top = top
+        self.frames = frames
+        self.lock = threading.Lock()
+        self.tracing = threading.Lock()
+        self.routes = {}
+        self.recent = deque(maxlen=history)
+
+    def should_trace(self) -> bool:
+        token = current_app.config["PROFILING_TOKEN"]
+        if token and request.headers.get(HEADER) == token:
+            return True
+        return random.random() < self.sample_rate
+
+    def start(self):
+        profile = {"rss": current_rss(), "traced": False}
+        request.environ[PROFILE_ENVIRON] = profile
+        if not self.should_trace() or not self.tracing.acquire(False):
+            return
+
+        profile["traced"] = True
+        if tracemalloc.is_tracing():
+            # Someone else is tracing, compare against what is there now
+            tracemalloc.reset_peak()
+            profile["baseline"] = tracemalloc.take_snapshot()
+        else:
+            tracemalloc.start(self.frames)
+            profile["baseline"] = None
+
+    def finish(self, status_code):
+        # Requests that did not start one (e.g. batch sub-requests) have
+        # none to finish
+        started = request.environ.pop(PROFILE_ENVIRON, None)
+        if started is None:
+            return None
+
+        record = {
+            "route": _route_name(),
+            "status": status_code,
+            "rss_delta": current_rss() - started["rss"],
+        }
+        if started["traced"]:
+            try:
+                record.update(self._tracemalloc_stats(started["baseline"]))
+            finally:
+                if started["baseline"] is None:
+                    tracemalloc.stop()
+                self.tracing.release()
+
+        self._record(record)
+        return record
+
+    def _tracemalloc_stats(self, baseline) -> dict:
+        size, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces(_IGNORED_FILES)
+        key_type = "lineno" if self.frames == 1 else "traceback"
+        if baseline is None:
+            statistics = snapshot.statistics(key_type)
+        else:
+            baseline = baseline.filter_traces(_IGNORED_FILES)
+            statistics = snapshot.compare_to(baseline, key_type)
+        return {
+            "traced_size": size,
+            "traced_peak": peak,
+            "top_allocations": [
+                {
+                    "site": [
+                        f"{frame.filename}:{frame.lineno}"
+                        for frame in statistic.traceback
+                    ],
+                    "size": getattr(statistic, "size_diff", statistic.size),
+                    "count": getattr(statistic, "count_diff", statistic.count),
+                }
+                for statistic in statistics[: self.top]
+            ],
+        }
+
+    def _record(self, record: dict):
+        with self.lock:
+            self.recent.append(record)
+            route = self.routes.setdefault(
+                record["route"],
+                {
+                    "requests": 0,
+                    "rss_delta_total": 0,
+                    "rss_delta_max": 0,
+                    "traced": 0,
+                    "traced_peak_total": 0,
+                    "traced_peak_max": 0,
+                    "top_allocations": [],
+                },
+            )
+            route["requests"] += 1
+            route["rss_delta_total"] += record["rss_delta"]
+            route["rss_delta_max"] = max(
+                route["rss_delta_max"], record["rss_delta"]
+            )
+            if "traced_peak" in record:
+                route["traced"] += 1
+                route["traced_peak_total"] += record["traced_peak"]
+                if record["traced_peak"] >= route["traced_peak_max"]:
+                    route["traced_peak_max"] = record["traced_peak"]
+                    route["top_allocations"] = record["top_allocations"]
+
+    def report(self) -> dict:
+        """Returns the per-route statistics and the most recent requests"""
+        with self.lock:
+            routes = {}
+            for name, route in self.routes.items():
+                routes[name] = dict(
+                    route,
+                    rss_delta_avg=route["rss_delta_total"]
+                    // route["requests"],
+                    traced_peak_avg=(
+                        route["traced_peak_total"] // route["traced"]
+                        if route["traced"]
+                        else None
+                    ),
+                )
+            return {
+                "rss": current_rss(),
+                "sample_rate": self.sample_rate,
+                "routes": routes,
+                "recent": list(self.recent),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.routes.clear()
+            self.recent.clear()
+
+
+def _route_name() -> str:
+    rule = request.url_rule.rule if request.url_rule else request.path
+    return f"{request.method} {rule}"
+
+
+def _format_bytes(size: int) -> str:
+    return f"{size / 1024:+.1f} KiB"
+
+
+def init_app(app: Flask):
+    if not is_enabled(app.config["MEMORY_PROFILING"]):
+        return
+
+    profiler = MemoryProfiler(
+        sample_rate=float(app.config["MEMORY_PROFILING_SAMPLE_RATE"]),
+        top=int(app.config["MEMORY_PROFILING_TOP"]),
+        frames=int(app.config["MEMORY_PROFILING_FRAMES"]),
+        history=int(app.config["MEMORY_PROFILING_HISTORY"]),
+    )
+    app.extensions["memory_profiler"] = profiler
+
+    @app.before_request
+    def start_memory_profile():
+        profiler.start()
+
+    @app.after_request
+    def keep_status_code(response):
+        request.environ[STATUS_ENVIRON] = response.status_code
+        return response
+
+    @app.teardown_request
+    def finish_memory_profile(exception):
+        # Runs after the response is built, so `json_response`
+        # serialization is part of the profile
+        status_code = request.environ.pop(STATUS_ENVIRON, 500)
+        record = profiler.finish(status_code)
+        if record is None or "traced_peak" not in record:
+            return
+        top = record["top_allocations"][:1]
+        app.logger.info(
+            "memory profile %s: status=%s rss_delta=%s peak=%s top=%s",
+            record["route"],
+            status_code,
+            _format_bytes(record["rss_delta"]),
+            _format_bytes(record["traced_peak"]),
+            top[0]["site"][0] if top and top[0]["site"] else None,
+        )
@@ -0,0 +1,163 @@
+import json
+import queue
+import select
+import threading
+import time
+
+from flask import Flask, current_app
+from sqlalchemy import text
+
+from src.extensions import capture
+from src.extensions.database import db
+from src.models import Perda
+
+CHANNEL = "perda_changes"
+
+
+class TooManySubscribersError(Exception):
+    pass
+
+
+class PerdaNotifier:
+    """Fans out committed `Perda` changes to in-process subscribers
+
+    On PostgreSQL, writers `NOTIFY` their changes right before they
+    commit, inside their transaction, and a single `LISTEN` connection
+    per process feeds every subscriber, so changes made by other
+    processes are seen too. Elsewhere, changes are published locally
+    right after the commit.
+
+    Each subscriber is an open stream, which holds a server thread, so
+    there are at most `PERDA_STREAM_MAX_CLIENTS` per process (0 for no
+    limit).
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.listener = None
+        # Set while the LISTEN connection is up
+        self.listening = threading.Event()
+
+    @property
+    def uses_postgresql(self) -> bool:
+        # Not through a new app context, popping it would remove the
+        # session of the current one
+        return db.get_engine(self.app).dialect.name == "postgresql"
+
+    def subscribe(self) -> queue.Queue:
+        """Registers a subscriber
+
+        Returns
+        -------
+        queue.Queue
+            Receives change dicts, or None when the subscriber is dropped
+            for not keeping up
+
+        Raises
+        ------
+        TooManySubscribersError
+            If there are `PERDA_STREAM_MAX_CLIENTS` subscribers already
+        """
+        limit = int(self.app.config["PERDA_STREAM_MAX_CLIENTS"])
+        subscriber = queue.Queue(
+            maxsize=int(self.app.config["PERDA_STREAM_QUEUE_SIZE"])
+        )
+        with self.lock:
+            if limit and len(self.subscribers) >= limit:
+                raise TooManySubscribersError()
+            self.subscribers.add(subscriber)
+            if self.listener is None and self.uses_postgresql:
+                self.listener = threading.Thread(
+                    target=self._listen, name="perda-notifier", daemon=True
+                )
+                self.listener.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, change: dict):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait(change)
+            except queue.Full:
+                # A stuck client must not hold the others back
+                self.unsubscribe(subscriber)
+                with subscriber.mutex:
+                    subscriber.queue.clear()
+                subscriber.put_nowait(None)
+
+    def _listen(self):
+        with self.app.app_context():
+            engine = db.engine
+        while True:
+            connection = None
+            try:
+                connection = engine.raw_connection()
+                # The LISTEN connection stays out of the pool for good
+                connection.detach()
+                raw = connection.connection
+                raw.autocommit = True
+                raw.cursor().execute(f"LISTEN {CHANNEL}")
+                self.listening.set()
+                while True:
+                    readable, _, _ = select.select([raw], [], [], 5)
+                    if not readable:
+                        continue
+                    raw.poll()
+                    while raw.notifies:
+                        self.publish(json.loads(raw.notifies.pop(0).payload))
+            except Exception:
+                self.listening.clear()
+                self.app.logger.exception("Perda notifier connection lost")
+                if connection is not None:
+                    connection.close()
+                time.sleep(5)
+
+
+def _serialize(operation: str, values: dict) -> dict:
+    return {
+        "operation": operation,
+        "id": values["id"],
+        "data": values["data"].isoformat() if values["data"] else None,
+        "evento": values["evento"],
+        "produtor_rural_id": values["produtor_rural_id"],
+        "lavoura_id": values["lavoura_id"],
+    }
+
+
+def _notify_changes(changes: list):
+    connection = db.session.connection()
+    if connection.dialect.name != "postgresql":
+        return
+    # Right before the commit, so PostgreSQL delivers them only if it
+    # succeeds
+    connection.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        [
+            {
+                "channel": CHANNEL,
+                "payload": json.dumps(_serialize(operation, values)),
+            }
+            for _, operation, values in changes
+        ],
+    )
+
+
+def _publish_changes(changes: list):
+    notifier = current_app.extensions["perda_notifier"]
+    if notifier.uses_postgresql:
+        return
+    for _, operation, values in changes:
+        notifier.publish(_serialize(operation, values))
+
+
+def init_app(app: Flask):
+    app.extensions["perda_notifier"] = PerdaNotifier(app)
+    capture.subscribe(app, (Perda,), _notify_changes, before_commit=True)
+    capture.subscribe(app, (Perda,), _publish_changes)
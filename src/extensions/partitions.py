@@ -0,0 +1,145 @@
+import re
+from datetime import date
+
+import click
+from flask import Flask
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+from src.extensions.database import db
+
+PARTITION_NAME = re.compile(r"^perda_y(\d{4})$")
+
+partitions_cli = AppGroup(
+    "perda-partitions", help="Maintains the yearly partitions of perda"
+)
+
+
+class PartitioningNotSupportedError(Exception):
+    pass
+
+
+def _ensure_postgresql():
+    if db.engine.dialect.name != "postgresql":
+        raise PartitioningNotSupportedError(
+            "Only PostgreSQL databases have perda partitions"
+        )
+
+
+def list_partitions() -> list:
+    """Lists the yearly partitions currently attached to `perda`
+
+    Returns
+    -------
+    list[int]
+        The partition years, sorted
+    """
+    _ensure_postgresql()
+    names = db.session.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits"
+            " JOIN pg_class parent ON parent.oid = pg_inherits.inhparent"
+            " JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+            " WHERE parent.relname = 'perda'"
+        )
+    ).fetchall()
+    return sorted(
+        int(match.group(1))
+        for match in (PARTITION_NAME.match(name) for (name,) in names)
+        if match
+    )
+
+
+def create_partition(year: int):
+    """Creates the partition of a year
+
+    Rows of that year that were in the default partition are moved to
+    the new one, since PostgreSQL refuses to create a partition whose
+    rows are already in the default one
+
+    Parameters
+    ----------
+    year : int
+    """
+    _ensure_postgresql()
+    start, end = f"{year}-01-01", f"{year + 1}-01-01"
+    statements = (
+        "LOCK TABLE perda IN ACCESS EXCLUSIVE MODE",
+        "ALTER TABLE perda DETACH PARTITION perda_default",
+        f"CREATE TABLE perda_y{year} PARTITION OF perda"
+        f" FOR VALUES FROM ('{start}') TO ('{end}')",
+        "INSERT INTO perda SELECT * FROM perda_default"
+        " WHERE data >= :start AND data < :end",
+        "DELETE FROM perda_default WHERE data >= :start AND data < :end",
+        "ALTER TABLE perda ATTACH PARTITION perda_default DEFAULT",
+    )
+    for statement in statements:
+        db.session.execute(text(statement), {"start": start, "end": end})
+    db.session.commit()
+
+
+def detach_partition(year: int):
+    """Detaches the partition of a year from `perda`
+
+    Its rows leave every `perda` query, but are kept in the standalone
+    `perda_y<year>` table, that can be archived or dropped
+
+    Parameters
+    ----------
+    year : int
+    """
+    _ensure_postgresql()
+    db.session.execute(
+        text(f"ALTER TABLE perda DETACH PARTITION perda_y{year}")
+    )
+    db.session.commit()
+
+
+@partitions_cli.command("list")
+def list_command():
+    """Lists the yearly partitions"""
+    try:
+        years = list_partitions()
+    except PartitioningNotSupportedError as e:
+        raise click.ClickException(str(e))
+    for year in years:
+        click.echo(f"perda_y{year}")
+
+
+@partitions_cli.command("create")
+@click.option(
+    "--years",
+    type=int,
+    default=1,
+    show_default=True,
+    help="How many years ahead of the current one must exist",
+)
+def create_command(years):
+    """Creates the missing partitions up to some years ahead"""
+    try:
+        existing = set(list_partitions())
+    except PartitioningNotSupportedError as e:
+        raise click.ClickException(str(e))
+
+    current_year = date.today().year
+    for year in range(current_year, current_year + years + 1):
+        if year not in existing:
+            create_partition(year)
+            click.echo(f"Created perda_y{year}")
+
+
+@partitions_cli.command("detach")
+@click.argument("year", type=int)
+def detach_command(year):
+    """Detaches the partition of an old season"""
+    try:
+        if year not in list_partitions():
+            raise click.ClickException(f"There is no perda_y{year}")
+        detach_partition(year)
+    except PartitioningNotSupportedError as e:
+        raise click.ClickException(str(e))
+    click.echo(f"Detached perda_y{year}")
+
+
+def init_app(app: Flask):
+    app.cli.add_command(partitions_cli)
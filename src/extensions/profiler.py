@@ -0,0 +1,254 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, OrderedDict
+from time import perf_counter
+from urllib.parse import urlencode
+from uuid import uuid4
+
+import click
+from flask import Flask, current_app, g, request
+from flask.cli import with_appcontext
+
+from src.extensions.authentication import issue_token
+
+HEADER = "X-Profile-CPU"
+
+
+def _short_path(filename: str) -> str:
+    """Strips the longest `sys.path` prefix from a file name"""
+    prefixes = [
+        path for path in sys.path if path and filename.startswith(path)
+    ]
+    if not prefixes:
+        return filename
+    return os.path.relpath(filename, max(prefixes, key=len))
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({_short_path(code.co_filename)})"
+
+
+class StackSampler(threading.Thread):
+    """Samples the stack of another thread at a fixed interval
+
+    The samples are kept as collapsed stacks (`root;...;leaf` -> count),
+    the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id: int, interval: float):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                if code not in names:
+                    names[code] = _frame_name(code)
+                stack.append(names[code])
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class RouteProfile:
+    """Profiles the calling thread with cProfile and a stack sampler
+
+    cProfile gives exact call counts and times per function, the sampler
+    gives whole stacks for a flamegraph. The sampled times include the
+    cProfile overhead, which weighs more on call-heavy Python code.
+    """
+
+    def __init__(self, interval: float):
+        self.id = uuid4().hex
+        self.profile = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), interval)
+        self.duration = None
+
+    def start(self):
+        self.started = perf_counter()
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+        self.sampler.stop()
+        self.duration = perf_counter() - self.started
+
+    def collapsed(self) -> str:
+        """Returns the sampled stacks in the collapsed-stack format"""
+        return "".join(
+            f"{stack} {count}\n"
+            for stack, count in self.sampler.stacks.most_common()
+        )
+
+    def top(self, limit: int) -> list:
+        """Returns the functions with the greatest cumulative time"""
+        stats = pstats.Stats(self.profile).stats
+        rows = sorted(stats.items(), key=lambda item: item[1][3])
+        return [
+            {
+                "function": f"{name} ({_short_path(filename)}:{lineno})",
+                "calls": calls,
+                "primitive_calls": primitive_calls,
+                "tottime": round(tottime, 6),
+                "cumtime": round(cumtime, 6),
+            }
+            for (filename, lineno, name), (
+                primitive_calls,
+                calls,
+                tottime,
+                cumtime,
+                _,
+            ) in reversed(rows[-limit:])
+        ]
+
+    def report(self, limit: int) -> dict:
+        return {
+            "id": self.id,
+            "duration": round(self.duration, 6),
+            "samples": sum(self.sampler.stacks.values()),
+            "top": self.top(limit),
+            "collapsed": self.collapsed(),
+        }
+
+
+class CpuProfiler:
+    """Keeps the reports of the last profiled requests"""
+
+    def __init__(self, interval: float, top: int, history: int):
+        self.interval = interval
+        self.limit = top
+        self.history = history
+        self.lock = threading.Lock()
+        self.reports = OrderedDict()
+
+    def start(self) -> RouteProfile:
+        profile = RouteProfile(self.interval)
+        profile.start()
+        return profile
+
+    def finish(self, profile: RouteProfile, route: str, status: int):
+        profile.stop()
+        report = dict(profile.report(self.limit), route=route, status=status)
+        with self.lock:
+            self.reports[profile.id] = report
+            while len(self.reports) > self.history:
+                self.reports.popitem(last=False)
+        return report
+
+    def get(self, profile_id: str) -> dict:
+        with self.lock:
+            return self.reports.get(profile_id)
+
+
+@click.command("profile-route")
+@click.argument("method")
+@click.argument("path")
+@click.option("--data", help="JSON request body")
+@click.option(
+    "-H", "--header", "headers", multiple=True, help="'Name: value' header"
+)
+@click.option("--user", help="Username the request is authenticated as")
+@click.option("--repeat", default=1, help="Profiled requests")
+@click.option("--warmup", default=0, help="Requests made before profiling")
+@click.option("--top", type=int, help="Functions in the table")
+@click.option(
+    "--collapsed",
+    type=click.File("w"),
+    help="File the collapsed stacks (flamegraph input) are written to",
+)
+@with_appcontext
+def profile_route_command(
+    method, path, data, headers, user, repeat, warmup, top, collapsed
+):
+    """Replays a request and profiles it"""
+    client = current_app.test_client()
+    arguments = {
+        "method": method.upper(),
+        "headers": [header.split(":", 1) for header in headers],
+    }
+    url = path
+    if user:
+        url += ("&" if "?" in path else "?") + urlencode(
+            {"access_token": issue_token(user)}
+        )
+    if data is not None:
+        arguments["json"] = json.loads(data)
+
+    for _ in range(warmup):
+        client.open(url, **arguments)
+
+    profile = RouteProfile(float(current_app.config["PROFILING_INTERVAL"]))
+    statuses = Counter()
+    profile.start()
+    try:
+        for _ in range(repeat):
+            statuses[client.open(url, **arguments).status_code] += 1
+    finally:
+        profile.stop()
+
+    limit = top or int(current_app.config["PROFILING_TOP"])
+    click.echo(
+        f"{arguments['method']} {path}: {repeat} requests in"
+        f" {profile.duration:.3f}s, statuses {dict(statuses)},"
+        f" {sum(profile.sampler.stacks.values())} samples"
+    )
+    click.echo(f"{'ncalls':>10} {'tottime':>10} {'cumtime':>10}  function")
+    for row in profile.top(limit):
+        click.echo(
+            f"{row['calls']:>10} {row['tottime']:>10.4f}"
+            f" {row['cumtime']:>10.4f}  {row['function']}"
+        )
+    if collapsed:
+        collapsed.write(profile.collapsed())
+
+
+def init_app(app: Flask):
+    app.cli.add_command(profile_route_command)
+    if not app.config["PROFILING_TOKEN"]:
+        return
+
+    profiler = CpuProfiler(
+        interval=float(app.config["PROFILING_INTERVAL"]),
+        top=int(app.config["PROFILING_TOP"]),
+        history=int(app.config["PROFILING_HISTORY"]),
+    )
+    app.extensions["cpu_profiler"] = profiler
+
+    @app.before_request
+    def start_cpu_profile():
+        if request.headers.get(HEADER) == app.config["PROFILING_TOKEN"]:
+            g.cpu_profile = profiler.start()
+
+    @app.after_request
+    def finish_cpu_profile(response):
+        profile = g.pop("cpu_profile", None)
+        if profile is None:
+            return response
+        rule = request.url_rule.rule if request.url_rule else request.path
+        route = f"{request.method} {rule}"
+        report = profiler.finish(profile, route, response.status_code)
+        app.logger.info(
+            "cpu profile %s %s: %.3fs, top %s",
+            report["id"],
+            route,
+            report["duration"],
+            report["top"][0]["function"] if report["top"] else None,
+        )
+        response.headers["X-Profile-Id"] = report["id"]
+        return response
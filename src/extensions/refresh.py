@@ -0,0 +1,160 @@
+import threading
+from time import monotonic
+
+from flask import Flask
+
+from src.extensions import capture, changes
+
+
+class BackgroundRefresh:
+    """Keeps an in-memory copy of some tables fresh, off the request path
+
+    New copies are built in a background thread and swapped in at once,
+    so readers keep using the copy they took meanwhile, and only ever
+    wait for the very first one. A copy gets the changes this process
+    commits as they are committed. The ones of other processes are read
+    from the change log, in the background, every `refresh_interval`
+    seconds. A new copy is built every `rebuild_interval` seconds, when
+    the change log was pruned past the current one, or when the current
+    one asks for it.
+
+    Parameters
+    ----------
+    app : Flask
+    name : str
+        Name of the background thread
+    models : tuple
+        The models copied, all of them in the change log
+    build : callable
+        Returns a new copy, loaded from the database. Copies have an
+        `apply(changes)` method, which takes the (model, operation,
+        values) tuples of `capture` subscribers and returns True once
+        the copy would rather be built again
+    refresh_interval : float
+    rebuild_interval : float
+    """
+
+    def __init__(
+        self,
+        app: Flask,
+        name: str,
+        models: tuple,
+        build: callable,
+        refresh_interval: float,
+        rebuild_interval: float,
+    ):
+        self.app = app
+        self.name = name
+        self.models = tuple(models)
+        self.build = build
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        # Held to swap copies and to apply changes, never during a query
+        self.lock = threading.Lock()
+        # Held by the build or catch-up running
+        self.refresh_lock = threading.Lock()
+        self.copy = None
+        self.cursor = 0
+        self.built_at = self.refreshed_at = monotonic()
+        self.stale = False
+        # Changes committed while a copy is built, applied to it as well
+        self.replay = None
+        self.thread = None
+        capture.subscribe(app, self.models, self.apply)
+
+    @property
+    def built(self) -> bool:
+        return self.copy is not None
+
+    def get(self):
+        """Returns the current copy, refreshed in the background if due
+
+        Builds the first copy, if there is none yet
+        """
+        if self.copy is None:
+            with self.refresh_lock:
+                if self.copy is None:
+                    self._rebuild()
+        elif (
+            self.stale
+            or monotonic() - self.refreshed_at >= self.refresh_interval
+        ):
+            self.refresh()
+        return self.copy
+
+    def refresh(self, rebuild: bool = False) -> threading.Thread:
+        """Catches up the current copy, or builds a new one, in the
+        background
+
+        Returns
+        -------
+        threading.Thread
+            The thread doing it, which may be one that was already
+            running, in which case a rebuild is left for the next one
+        """
+        with self.lock:
+            self.stale = self.stale or rebuild
+            if self.thread is None or not self.thread.is_alive():
+                self.refreshed_at = monotonic()
+                self.thread = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self.thread.start()
+            return self.thread
+
+    def apply(self, changed: list):
+        """Applies the changes committed by this process"""
+        with self.lock:
+            if self.replay is not None:
+                self.replay.append(changed)
+            if self.copy is not None and self.copy.apply(changed):
+                self.stale = True
+
+    def _run(self):
+        with self.app.app_context():
+            try:
+                with self.refresh_lock:
+                    if (
+                        self.copy is None
+                        or self.stale
+                        or monotonic() - self.built_at >= self.rebuild_interval
+                    ):
+                        self._rebuild()
+                    else:
+                        self._catch_up()
+            except Exception as e:
+                # e.g. the tables are not migrated yet
+                self.app.logger.warning(
+                    "%s not refreshed, it will be on next use: %s",
+                    self.name,
+                    e,
+                )
+
+    def _rebuild(self):
+        with self.lock:
+            self.replay = []
+        try:
+            # Read first: whatever commits later is caught up from it
+            cursor = changes.newest_cursor()
+            copy = self.build()
+        except Exception:
+            with self.lock:
+                self.replay = None
+            raise
+        with self.lock:
+            for changed in self.replay:
+                copy.apply(changed)
+            self.copy, self.cursor, self.replay = copy, cursor, None
+            self.stale = False
+            self.built_at = self.refreshed_at = monotonic()
+
+    def _catch_up(self):
+        try:
+            changed, cursor = changes.changed_rows(self.cursor, self.models)
+        except changes.ExpiredCursorError:
+            self._rebuild()
+            return
+        with self.lock:
+            if self.copy.apply(changed):
+                self.stale = True
+            self.cursor = cursor
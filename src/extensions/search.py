@@ -0,0 +1,98 @@
+import re
+
+from sqlalchemy import text
+from sqlalchemy.orm import joinedload
+
+from src.extensions.database import db
+from src.models import ProdutorRural
+
+_POSTGRESQL_QUERY = text("""
+    SELECT id, rank FROM (
+        SELECT
+            id,
+            GREATEST(
+                word_similarity(
+                    f_unaccent(lower(:q)), f_unaccent(lower(nome))
+                ),
+                ts_rank(
+                    to_tsvector('simple', f_unaccent(nome)),
+                    plainto_tsquery('simple', f_unaccent(:q))
+                )
+            ) AS rank
+        FROM produtor_rural
+        WHERE to_tsvector('simple', f_unaccent(nome))
+                @@ plainto_tsquery('simple', f_unaccent(:q))
+            OR f_unaccent(lower(:q)) <% f_unaccent(lower(nome))
+    ) AS matches
+    ORDER BY rank DESC, id
+    LIMIT :limit
+    """)
+
+_SQLITE_QUERY = text("""
+    SELECT rowid AS id, -bm25(produtor_rural_fts) AS rank
+    FROM produtor_rural_fts
+    WHERE produtor_rural_fts MATCH :q
+    ORDER BY bm25(produtor_rural_fts), rowid
+    LIMIT :limit
+    """)
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+def _fts5_query(q: str) -> str:
+    """Turns free text into a FTS5 query where every word is a prefix"""
+    return " ".join(f'"{word}"*' for word in _WORD.findall(q))
+
+
+def search_produtores(q: str, limit: int) -> list:
+    """Searches producers by name, ignoring case and accents
+
+    Uses the text indexes created by migration d5e8a1f04b6c: trigram and
+    tsvector indexes on PostgreSQL (which also match typos) and a FTS5
+    table on SQLite (which matches word prefixes)
+
+    Parameters
+    ----------
+    q : str
+        The searched name
+    limit : int
+        Maximum number of producers
+
+    Returns
+    -------
+    list[tuple]
+        (ProdutorRural, rank) pairs, best matches first, with their loss
+        summaries loaded
+    """
+    produtores = ProdutorRural.query.options(
+        joinedload(ProdutorRural.resumo_perdas)
+    )
+    dialect = db.session.get_bind().dialect.name
+    if dialect == "postgresql":
+        rows = db.session.execute(
+            _POSTGRESQL_QUERY, {"q": q, "limit": limit}
+        ).fetchall()
+    elif dialect == "sqlite":
+        match = _fts5_query(q)
+        if not match:
+            return []
+        rows = db.session.execute(
+            _SQLITE_QUERY, {"q": match, "limit": limit}
+        ).fetchall()
+    else:
+        return [
+            (produtor, None)
+            for produtor in produtores.filter(
+                ProdutorRural.nome.ilike("%" + q + "%")
+            )
+            .order_by(ProdutorRural.nome)
+            .limit(limit)
+        ]
+
+    found = {
+        produtor.id: produtor
+        for produtor in produtores.filter(
+            ProdutorRural.id.in_([row.id for row in rows])
+        )
+    }
+    return [(found[row.id], row.rank) for row in rows if row.id in found]
@@ -0,0 +1,207 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+from datetime import datetime
+
+import click
+from flask import Flask, current_app
+from flask.cli import AppGroup
+from sqlalchemy import MetaData, create_engine, event, func, select
+
+from src.extensions.database import db
+from src.models import ChangeLog, Lavoura, Perda, ProdutorRural
+
+# Copied in this order, so foreign keys always point to copied rows
+MODELS = (ProdutorRural, Lavoura, Perda)
+LATEST = "latest.json"
+
+snapshot_cli = AppGroup("snapshot", help="Builds the offline snapshot")
+
+
+def snapshot_path(filename: str) -> str:
+    """Returns the path of a file in the snapshot directory"""
+    directory = current_app.config["SNAPSHOT_PATH"]
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def latest_snapshot() -> dict:
+    """Returns the description of the last snapshot built, if any
+
+    Returns
+    -------
+    dict | None
+        {"version", "cursor", "created_at", "file", "size", "sha256"}
+    """
+    try:
+        with open(snapshot_path(LATEST)) as latest:
+            return json.load(latest)
+    except FileNotFoundError:
+        return None
+
+
+def _source_connection():
+    connection = db.engine.connect()
+    if connection.dialect.name == "postgresql":
+        # Every table is read from the same database snapshot
+        connection = connection.execution_options(
+            isolation_level="REPEATABLE READ"
+        )
+    return connection
+
+
+def _write_database(path: str, batch_size: int, on_table=None) -> int:
+    """Copies the catalogue into a new SQLite database
+
+    Returns
+    -------
+    int
+        The change log cursor the copy is consistent with
+    """
+    target = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(target, "connect")
+    def fast_writes(connection, record):
+        # The file is only published once complete
+        connection.execute("PRAGMA journal_mode = OFF")
+        connection.execute("PRAGMA synchronous = OFF")
+
+    metadata = MetaData()
+    tables = [model.__table__.tometadata(metadata) for model in MODELS]
+    indexes = [index for table in tables for index in table.indexes]
+    for table in tables:
+        # Indexes are built after the rows are in, which is faster
+        table.indexes = set()
+
+    source = _source_connection()
+    try:
+        with source.begin(), target.begin() as output:
+            cursor = source.execute(select([func.max(ChangeLog.id)])).scalar()
+            for table, model in zip(tables, MODELS):
+                table.create(output)
+                rows = source.execution_options(stream_results=True).execute(
+                    model.__table__.select().order_by(model.__table__.c.id)
+                )
+                while True:
+                    batch = rows.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    output.execute(
+                        table.insert(), [dict(row) for row in batch]
+                    )
+                if on_table is not None:
+                    on_table(model)
+            for index in indexes:
+                index.create(output)
+            output.execute(
+                "CREATE TABLE snapshot"
+                " (version TEXT NOT NULL, cursor INTEGER NOT NULL,"
+                " created_at TEXT NOT NULL)"
+            )
+    finally:
+        source.close()
+    target.dispose()
+    return cursor or 0
+
+
+def build_snapshot(on_table=None) -> dict:
+    """Writes the producers, crops and losses to a gzipped SQLite file
+
+    The file also has a `snapshot` table with its version and the
+    `/changes` cursor it is consistent with, so clients can download it
+    once and then follow the change feed. It is built aside and then
+    published by replacing `latest.json`, and the last `SNAPSHOT_KEEP`
+    files are kept for downloads in progress.
+
+    Parameters
+    ----------
+    on_table : callable, optional
+        Called with each model once its rows are copied
+
+    Returns
+    -------
+    dict
+        The new `latest_snapshot()`
+    """
+    created_at = datetime.utcnow()
+    database_path = snapshot_path(f"build-{os.getpid()}.sqlite")
+    try:
+        cursor = _write_database(
+            database_path,
+            batch_size=int(current_app.config["EXPORT_BATCH_SIZE"]),
+            on_table=on_table,
+        )
+        version = f"{created_at:%Y%m%d%H%M%S}-{cursor}"
+        target = create_engine(f"sqlite:///{database_path}")
+        with target.begin() as connection:
+            connection.execute(
+                "INSERT INTO snapshot VALUES (?, ?, ?)",
+                (version, cursor, created_at.isoformat()),
+            )
+        target.dispose()
+
+        filename = f"snapshot-{version}.sqlite.gz"
+        digest = hashlib.sha256()
+        with open(database_path, "rb") as database, gzip.open(
+            snapshot_path(filename + ".part"),
+            "wb",
+            compresslevel=int(current_app.config["SNAPSHOT_COMPRESSION"]),
+        ) as compressed:
+            shutil.copyfileobj(database, compressed)
+        with open(snapshot_path(filename + ".part"), "rb") as compressed:
+            for block in iter(lambda: compressed.read(1 << 20), b""):
+                digest.update(block)
+        os.replace(snapshot_path(filename + ".part"), snapshot_path(filename))
+    finally:
+        if os.path.exists(database_path):
+            os.remove(database_path)
+
+    latest = {
+        "version": version,
+        "cursor": cursor,
+        "created_at": created_at.isoformat(),
+        "file": filename,
+        "size": os.path.getsize(snapshot_path(filename)),
+        "sha256": digest.hexdigest(),
+    }
+    with open(snapshot_path(LATEST + ".part"), "w") as output:
+        json.dump(latest, output)
+    os.replace(snapshot_path(LATEST + ".part"), snapshot_path(LATEST))
+
+    _remove_old_snapshots(int(current_app.config["SNAPSHOT_KEEP"]))
+    return latest
+
+
+def _remove_old_snapshots(keep: int):
+    directory = current_app.config["SNAPSHOT_PATH"]
+    snapshots = sorted(
+        name
+        for name in os.listdir(directory)
+        if name.startswith("snapshot-") and name.endswith(".sqlite.gz")
+    )
+    # Versions start with the build time, so names sort by age
+    for name in snapshots[: -max(keep, 1)]:
+        os.remove(os.path.join(directory, name))
+
+
+@snapshot_cli.command("build")
+def build_command():
+    """Builds and publishes a new snapshot"""
+    latest = build_snapshot(
+        on_table=lambda model: click.echo(
+            f"{model.__tablename__} copied", err=True
+        )
+    )
+    click.echo(
+        f"snapshot {latest['version']}: {latest['size']} bytes", err=True
+    )
+
+
+def init_app(app: Flask):
+    if not app.config.get("SNAPSHOT_PATH"):
+        app.config["SNAPSHOT_PATH"] = os.path.join(
+            app.instance_path, "snapshots"
+        )
+    app.cli.add_command(snapshot_cli)
@@ -0,0 +1,256 @@
+import threading
+
+import numpy as np
+from flask import Flask, current_app
+from scipy.spatial import cKDTree
+
+from src.extensions import capture
+from src.extensions.database import db
+from src.extensions.refresh import BackgroundRefresh
+from src.models import Lavoura, Perda
+from src.utils import is_enabled
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _unit_vectors(latitudes, longitudes) -> np.ndarray:
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_latitudes = np.cos(latitudes)
+    return np.column_stack(
+        (
+            cos_latitudes * np.cos(longitudes),
+            cos_latitudes * np.sin(longitudes),
+            np.sin(latitudes),
+        )
+    )
+
+
+class SpatialIndex:
+    """In-memory index of crop coordinates and loss dates
+
+    Crops are kept in a KD-tree over unit vectors, so a radius on the
+    earth surface becomes an euclidean (chord) radius. Losses are kept
+    sorted by date, so a time window is two binary searches.
+
+    The tree and the sorted losses are never changed once built: changes
+    go to small delta structures, searched along with them, until there
+    are `rebuild_threshold` of them and a new index is built (in the
+    background, see `BackgroundRefresh`).
+    """
+
+    def __init__(
+        self,
+        lavoura_ids: np.ndarray,
+        coordinates: np.ndarray,
+        perda_rows: np.ndarray,
+        rebuild_threshold: int = 10000,
+    ):
+        self.rebuild_threshold = rebuild_threshold
+        self.lock = threading.Lock()
+
+        self.lavoura_ids = lavoura_ids
+        self.coordinates = coordinates
+        self.tree = cKDTree(
+            _unit_vectors(coordinates[:, 0], coordinates[:, 1])
+        )
+        self.lavoura_delta = {}
+        self.removed_lavouras = set()
+
+        self.perda_rows = perda_rows[
+            np.argsort(perda_rows[:, 1], kind="stable")
+        ]
+        self.perda_delta = {}
+        self.removed_perdas = set()
+
+    @classmethod
+    def load(cls, rebuild_threshold: int = 10000) -> "SpatialIndex":
+        """Builds an index of every crop and loss in the database"""
+        lavouras = np.array(
+            db.session.query(
+                Lavoura.id, Lavoura.latitude, Lavoura.longitude
+            ).all(),
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        perdas = np.array(
+            [
+                (perda_id, data.toordinal(), evento, lavoura_id, produtor_id)
+                for perda_id, data, evento, lavoura_id, produtor_id in (
+                    db.session.query(
+                        Perda.id,
+                        Perda.data,
+                        Perda.evento,
+                        Perda.lavoura_id,
+                        Perda.produtor_rural_id,
+                    )
+                )
+            ],
+            dtype=np.int64,
+        ).reshape(-1, 5)
+        return cls(
+            lavouras[:, 0].astype(np.int64),
+            lavouras[:, 1:],
+            perdas,
+            rebuild_threshold=rebuild_threshold,
+        )
+
+    def apply(self, changes: list) -> bool:
+        """Applies committed changes
+
+        Parameters
+        ----------
+        changes : list
+            (model, operation, values) tuples, see `capture.subscribe`
+
+        Returns
+        -------
+        bool
+            True once there are `rebuild_threshold` changes
+        """
+        lavouras, perdas = {}, {}
+        for model, operation, values in changes:
+            deleted = operation == capture.DELETE
+            if model is Lavoura:
+                lavouras[values["id"]] = (
+                    None
+                    if deleted
+                    else (values["latitude"], values["longitude"])
+                )
+            else:
+                perdas[values["id"]] = (
+                    None
+                    if deleted
+                    else (
+                        values["id"],
+                        values["data"].toordinal(),
+                        values["evento"],
+                        values["lavoura_id"],
+                        values["produtor_rural_id"],
+                    )
+                )
+
+        with self.lock:
+            # An update is a removal from the base arrays plus a delta row
+            for lavoura_id, coordinates in lavouras.items():
+                self.removed_lavouras.add(lavoura_id)
+                self.lavoura_delta.pop(lavoura_id, None)
+                if coordinates is not None:
+                    self.lavoura_delta[lavoura_id] = coordinates
+            for perda_id, row in perdas.items():
+                self.removed_perdas.add(perda_id)
+                self.perda_delta.pop(perda_id, None)
+                if row is not None:
+                    self.perda_delta[perda_id] = row
+
+            pending = (
+                len(self.removed_lavouras)
+                + len(self.lavoura_delta)
+                + len(self.removed_perdas)
+                + len(self.perda_delta)
+            )
+        return pending >= self.rebuild_threshold
+
+    def lavouras_within(
+        self, latitude: float, longitude: float, radius_km: float
+    ) -> tuple:
+        """Finds the crops within a radius of a point
+
+        Returns
+        -------
+        tuple
+            (ids, distances in km), sorted by distance
+        """
+        point = _unit_vectors([latitude], [longitude])[0]
+        chord = 2 * np.sin(min(radius_km / EARTH_RADIUS_KM, np.pi) / 2)
+
+        with self.lock:
+            indexes = np.array(
+                self.tree.query_ball_point(point, chord), dtype=np.int64
+            )
+            ids = self.lavoura_ids[indexes]
+            coordinates = self.coordinates[indexes]
+            if self.removed_lavouras:
+                keep = ~np.isin(ids, list(self.removed_lavouras))
+                ids, coordinates = ids[keep], coordinates[keep]
+            if self.lavoura_delta:
+                ids = np.concatenate(
+                    (ids, np.fromiter(self.lavoura_delta, dtype=np.int64))
+                )
+                coordinates = np.concatenate(
+                    (
+                        coordinates,
+                        np.array(
+                            list(self.lavoura_delta.values()),
+                            dtype=np.float64,
+                        ),
+                    )
+                )
+
+        chords = np.linalg.norm(
+            _unit_vectors(coordinates[:, 0], coordinates[:, 1]) - point,
+            axis=1,
+        )
+        near = chords <= chord
+        ids, chords = ids[near], chords[near]
+        distances = 2 * EARTH_RADIUS_KM * np.arcsin(np.minimum(chords / 2, 1))
+        order = np.argsort(distances, kind="stable")
+        return ids[order], distances[order]
+
+    def perdas_between(
+        self, lavoura_ids: np.ndarray, first_day: int, last_day: int
+    ) -> np.ndarray:
+        """Finds the losses of some crops in a date window
+
+        Parameters
+        ----------
+        lavoura_ids : np.ndarray
+        first_day : int
+            Date ordinal, inclusive
+        last_day : int
+            Date ordinal, inclusive
+
+        Returns
+        -------
+        np.ndarray
+            (id, date ordinal, evento, lavoura_id, produtor_id) rows,
+            sorted by date
+        """
+        with self.lock:
+            rows = self.perda_rows
+            start = np.searchsorted(rows[:, 1], first_day, side="left")
+            end = np.searchsorted(rows[:, 1], last_day, side="right")
+            rows = rows[start:end]
+            if self.removed_perdas:
+                rows = rows[~np.isin(rows[:, 0], list(self.removed_perdas))]
+            if self.perda_delta:
+                delta = np.array(
+                    list(self.perda_delta.values()), dtype=np.int64
+                )
+                in_window = (delta[:, 1] >= first_day) & (
+                    delta[:, 1] <= last_day
+                )
+                rows = np.concatenate((rows, delta[in_window]))
+
+        rows = rows[np.isin(rows[:, 3], lavoura_ids)]
+        return rows[np.argsort(rows[:, 1], kind="stable")]
+
+
+def get_index() -> SpatialIndex:
+    """Returns the app spatial index, refreshed if it is due"""
+    return current_app.extensions["spatial_index"].get()
+
+
+def init_app(app: Flask):
+    rebuild_threshold = int(app.config["SPATIAL_REBUILD_THRESHOLD"])
+    index = app.extensions["spatial_index"] = BackgroundRefresh(
+        app,
+        "spatial-index",
+        (Lavoura, Perda),
+        lambda: SpatialIndex.load(rebuild_threshold),
+        refresh_interval=float(app.config["SPATIAL_REFRESH_INTERVAL"]),
+        rebuild_interval=float(app.config["SPATIAL_REBUILD_INTERVAL"]),
+    )
+    if is_enabled(app.config["SPATIAL_BUILD_ON_STARTUP"]):
+        # Only servers take requests, CLI commands and job workers never
+        # build an index they do not query
+        app.before_first_request(index.refresh)
@@ -0,0 +1,174 @@
+from itertools import chain
+
+import click
+from flask import Flask
+from flask.cli import AppGroup
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session, attributes
+
+from src.extensions.database import db
+from src.models import (
+    EVENTOS,
+    Lavoura,
+    LavouraPerdaResumo,
+    Perda,
+    ProdutorPerdaResumo,
+    ProdutorRural,
+)
+
+# Keeps IN lists (and the rows locked at once) small
+CHUNK_SIZE = 500
+
+# (summarized model, summary model, `Perda` column)
+SUMMARIES = (
+    (ProdutorRural, ProdutorPerdaResumo, "produtor_rural_id"),
+    (Lavoura, LavouraPerdaResumo, "lavoura_id"),
+)
+
+summaries_cli = AppGroup(
+    "perda-summaries", help="Maintains the loss summary tables"
+)
+
+
+def summary_rows(column: str, ids: list = None):
+    """Aggregates `perda` into summary rows
+
+    Parameters
+    ----------
+    column : str
+        "produtor_rural_id" or "lavoura_id"
+    ids : list, optional
+        Only summarize these, by default everything
+
+    Returns
+    -------
+    Select
+        (id, perdas, ultima_perda, evento_frequente) rows
+    """
+    perda = Perda.__table__
+    frequente = perda.alias("frequente")
+    # Ties go to the lowest evento code
+    evento_frequente = (
+        select([frequente.c.evento])
+        .where(frequente.c[column] == perda.c[column])
+        .group_by(frequente.c.evento)
+        .order_by(func.count().desc(), frequente.c.evento)
+        .limit(1)
+        .as_scalar()
+    )
+    rows = select(
+        [
+            perda.c[column],
+            func.count(),
+            func.max(perda.c.data),
+            evento_frequente,
+        ]
+    ).group_by(perda.c[column])
+    if ids is not None:
+        rows = rows.where(perda.c[column].in_(ids))
+    return rows
+
+
+def refresh_summaries(
+    session: Session, produtor_ids: set = (), lavoura_ids: set = ()
+):
+    """Recomputes the summaries of some producers and crops
+
+    Runs in the session transaction. The summarized rows are locked
+    first, so concurrent writers of the same producer or crop take turns
+    and the last one sees the losses of the others. Bulk `Perda` writers
+    that skip the ORM must call it themselves
+
+    Parameters
+    ----------
+    session : Session
+    produtor_ids : set, optional
+    lavoura_ids : set, optional
+    """
+    for (model, summary, column), ids in zip(
+        SUMMARIES, (produtor_ids, lavoura_ids)
+    ):
+        ids = sorted(set(ids) - {None})
+        table = summary.__table__
+        for start in range(0, len(ids), CHUNK_SIZE):
+            end = start + CHUNK_SIZE
+            chunk = ids[start:end]
+            session.execute(
+                select([model.id])
+                .where(model.id.in_(chunk))
+                .order_by(model.id)
+                .with_for_update()
+            )
+            session.execute(table.delete().where(table.c[column].in_(chunk)))
+            session.execute(
+                table.insert().from_select(
+                    [column, "perdas", "ultima_perda", "evento_frequente"],
+                    summary_rows(column, chunk),
+                )
+            )
+
+
+def summary_payload(summary) -> dict:
+    """Serializes a summary the way the API sends it"""
+    if summary is None:
+        return {"perdas": 0, "ultima_perda": None, "evento_frequente": None}
+    return {
+        "perdas": summary.perdas,
+        "ultima_perda": summary.ultima_perda.isoformat(),
+        "evento_frequente": EVENTOS.get(
+            summary.evento_frequente, summary.evento_frequente
+        ),
+    }
+
+
+def _refresh_after_flush(session: Session, flush_context):
+    produtor_ids, lavoura_ids = set(), set()
+    for instance in chain(session.new, session.dirty, session.deleted):
+        if not isinstance(instance, Perda):
+            continue
+        # Both the old and new ids, for losses moved to another row
+        produtor_ids.update(
+            attributes.get_history(instance, "produtor_rural_id").sum()
+        )
+        lavoura_ids.update(
+            attributes.get_history(instance, "lavoura_id").sum()
+        )
+    if produtor_ids or lavoura_ids:
+        refresh_summaries(session, produtor_ids, lavoura_ids)
+
+
+def rebuild_summaries() -> dict:
+    """Rebuilds every summary from `perda`, in one transaction
+
+    Returns
+    -------
+    dict
+        The number of rows of each summary table
+    """
+    for _, summary, column in SUMMARIES:
+        table = summary.__table__
+        db.session.execute(table.delete())
+        db.session.execute(
+            table.insert().from_select(
+                [column, "perdas", "ultima_perda", "evento_frequente"],
+                summary_rows(column),
+            )
+        )
+    db.session.commit()
+    return {
+        summary.__tablename__: summary.query.count()
+        for _, summary, _ in SUMMARIES
+    }
+
+
+@summaries_cli.command("reconcile")
+def reconcile_command():
+    """Rebuilds every summary from `perda`"""
+    for tablename, count in rebuild_summaries().items():
+        click.echo(f"{count} {tablename} rows", err=True)
+
+
+def init_app(app: Flask):
+    if not event.contains(db.session, "after_flush", _refresh_after_flush):
+        event.listen(db.session, "after_flush", _refresh_after_flush)
+    app.cli.add_command(summaries_cli)
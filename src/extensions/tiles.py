@@ -0,0 +1,625 @@
+import math
+
+import click
+import numpy as np
+from flask import Flask, current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, event, func, inspect, or_, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from src.extensions.database import db
+from src.models import EVENTOS, Lavoura, Perda, TileCache, TileCell
+
+# Web Mercator can't represent the poles
+MAX_LATITUDE = 85.0511287798
+
+# Counter of the crops of a grid cell, with the sums of their coordinates
+LAVOURAS = "lavouras"
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple:
+    """Returns the (west, south, east, north) bounds of a tile, in degrees"""
+    n = 2**z
+
+    def _latitude(tile_y):
+        return math.degrees(
+            math.atan(math.sinh(math.pi * (1 - 2 * tile_y / n)))
+        )
+
+    west = x / n * 360 - 180
+    east = (x + 1) / n * 360 - 180
+    north = 90 if y == 0 else _latitude(y)
+    south = -90 if y == n - 1 else _latitude(y + 1)
+    return west, south, east, north
+
+
+def point_tiles(
+    latitudes: np.ndarray, longitudes: np.ndarray, z: int
+) -> tuple:
+    """Finds the tiles of many points at a zoom level
+
+    Parameters
+    ----------
+    latitudes : np.ndarray
+    longitudes : np.ndarray
+    z : int
+
+    Returns
+    -------
+    tuple
+        (x, y) fractional tile coordinates, as float arrays. The integer
+        part is the tile and the fractional part is the position in it
+    """
+    n = 2**z
+    latitudes = np.radians(
+        np.clip(
+            np.asarray(latitudes, dtype=np.float64),
+            -MAX_LATITUDE,
+            MAX_LATITUDE,
+        )
+    )
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    x = (longitudes + 180) / 360 * n
+    y = (1 - np.arcsinh(np.tan(latitudes)) / np.pi) / 2 * n
+    # Points on the east/south edges belong to the last tile
+    limit = np.nextafter(n, 0)
+    return np.clip(x, 0, limit), np.clip(y, 0, limit)
+
+
+def build_tile(z: int, x: int, y: int) -> list:
+    """Aggregates the crops and losses of a tile into grid clusters
+
+    Parameters
+    ----------
+    z : int
+    x : int
+    y : int
+
+    Returns
+    -------
+    list[dict]
+        One cluster per non empty grid cell, with the number of crops,
+        their centroid, the dominant `tipo`, the crops by `tipo` and the
+        losses by `evento`
+    """
+    grid = int(current_app.config["TILE_GRID_SIZE"])
+    west, south, east, north = tile_bounds(z, x, y)
+    in_tile = and_(
+        Lavoura.latitude >= south,
+        Lavoura.latitude <= north,
+        Lavoura.longitude >= west,
+        Lavoura.longitude <= east,
+    )
+
+    lavouras = (
+        db.session.query(
+            Lavoura.id, Lavoura.latitude, Lavoura.longitude, Lavoura.tipo
+        )
+        .filter(in_tile)
+        .order_by(Lavoura.id)
+        .all()
+    )
+    if not lavouras:
+        return []
+    ids, latitudes, longitudes, tipos = (np.array(c) for c in zip(*lavouras))
+    latitudes = latitudes.astype(np.float64)
+    longitudes = longitudes.astype(np.float64)
+
+    tile_x, tile_y = point_tiles(latitudes, longitudes, z)
+    # Bounds are inclusive, so drop the points that belong to a neighbour
+    inside = (np.floor(tile_x) == x) & (np.floor(tile_y) == y)
+    ids, latitudes, longitudes, tipos = (
+        ids[inside],
+        latitudes[inside],
+        longitudes[inside],
+        tipos[inside],
+    )
+    if not len(ids):
+        return []
+    cell_x = ((tile_x[inside] - x) * grid).astype(np.int64)
+    cell_y = ((tile_y[inside] - y) * grid).astype(np.int64)
+    cells = cell_y * grid + cell_x
+    size = grid * grid
+
+    counts = np.bincount(cells, minlength=size)
+    latitude_sums = np.bincount(cells, weights=latitudes, minlength=size)
+    longitude_sums = np.bincount(cells, weights=longitudes, minlength=size)
+
+    tipo_names, tipo_codes = np.unique(tipos, return_inverse=True)
+    tipo_counts = np.bincount(
+        cells * len(tipo_names) + tipo_codes,
+        minlength=size * len(tipo_names),
+    ).reshape(size, len(tipo_names))
+    dominant_tipos = tipo_counts.argmax(axis=1)
+
+    perdas = (
+        db.session.query(Perda.lavoura_id, Perda.evento, func.count(Perda.id))
+        .join(Lavoura, Perda.lavoura_id == Lavoura.id)
+        .filter(in_tile)
+        .group_by(Perda.lavoura_id, Perda.evento)
+        .all()
+    )
+    slots = max(EVENTOS) + 1
+    perda_counts = np.zeros((size, slots), dtype=np.int64)
+    if perdas:
+        lavoura_ids, eventos, totals = (np.array(c) for c in zip(*perdas))
+        positions = np.searchsorted(ids, lavoura_ids)
+        positions = np.minimum(positions, len(ids) - 1)
+        known = (ids[positions] == lavoura_ids) & np.isin(
+            eventos, list(EVENTOS)
+        )
+        np.add.at(
+            perda_counts,
+            (cells[positions[known]], eventos[known]),
+            totals[known],
+        )
+
+    clusters = []
+    for cell in np.flatnonzero(counts).tolist():
+        clusters.append(
+            {
+                "cell_x": cell % grid,
+                "cell_y": cell // grid,
+                "latitude": latitude_sums[cell] / counts[cell],
+                "longitude": longitude_sums[cell] / counts[cell],
+                "lavouras": int(counts[cell]),
+                "tipo": str(tipo_names[dominant_tipos[cell]]),
+                "tipos": {
+                    str(name): int(count)
+                    for name, count in zip(tipo_names, tipo_counts[cell])
+                    if count
+                },
+                "perdas": {
+                    name: int(perda_counts[cell, code])
+                    for code, name in EVENTOS.items()
+                    if perda_counts[cell, code]
+                },
+            }
+        )
+    return clusters
+
+
+def cached_tile(z: int, x: int, y: int) -> list:
+    """Returns the clusters of a cached tile
+
+    Returns
+    -------
+    list[dict] | None
+        The clusters, as `build_tile` returns them, or None if the tile
+        is not cached
+    """
+    cached = db.session.query(TileCache.z).filter_by(z=z, x=x, y=y).scalar()
+    if cached is None:
+        return None
+
+    table = TileCell.__table__
+    cells = {}
+    for (
+        cell_x,
+        cell_y,
+        counter,
+        count,
+        latitude,
+        longitude,
+    ) in db.session.execute(
+        select(
+            [
+                table.c.cell_x,
+                table.c.cell_y,
+                table.c.counter,
+                table.c.count,
+                table.c.latitude,
+                table.c.longitude,
+            ]
+        ).where(
+            and_(
+                table.c.z == z,
+                table.c.x == x,
+                table.c.y == y,
+                table.c.count > 0,
+            )
+        )
+    ):
+        cell = cells.setdefault((cell_y, cell_x), {"tipos": {}, "perdas": {}})
+        kind, _, name = counter.partition(":")
+        if kind == LAVOURAS:
+            cell.update(
+                lavouras=count,
+                latitude=latitude / count,
+                longitude=longitude / count,
+            )
+        elif kind == "tipo":
+            cell["tipos"][name] = count
+        else:
+            cell["perdas"][int(name)] = count
+
+    clusters = []
+    for (cell_y, cell_x), cell in sorted(cells.items()):
+        if "lavouras" not in cell:
+            continue
+        tipos = dict(sorted(cell["tipos"].items()))
+        clusters.append(
+            {
+                "cell_x": cell_x,
+                "cell_y": cell_y,
+                "latitude": cell["latitude"],
+                "longitude": cell["longitude"],
+                "lavouras": cell["lavouras"],
+                # Same tie break as `build_tile`: the first tipo by name
+                "tipo": min(tipos, key=lambda tipo: (-tipos[tipo], tipo)),
+                "tipos": tipos,
+                "perdas": {
+                    EVENTOS[code]: count
+                    for code, count in sorted(cell["perdas"].items())
+                },
+            }
+        )
+    return clusters
+
+
+def _store_tile(session: Session, z: int, x: int, y: int, clusters: list):
+    """Caches the clusters of a tile
+
+    Raises
+    ------
+    IntegrityError
+        If the tile is cached already
+    """
+    session.execute(TileCache.__table__.insert(), {"z": z, "x": x, "y": y})
+    table = TileCell.__table__
+    # Left over by writers that added to the tile while it was invalidated
+    session.execute(
+        table.delete().where(
+            and_(table.c.z == z, table.c.x == x, table.c.y == y)
+        )
+    )
+    codes = {name: code for code, name in EVENTOS.items()}
+    rows = []
+    for cluster in clusters:
+        key = {
+            "z": z,
+            "x": x,
+            "y": y,
+            "cell_x": cluster["cell_x"],
+            "cell_y": cluster["cell_y"],
+            "latitude": 0,
+            "longitude": 0,
+        }
+        rows.append(
+            dict(
+                key,
+                counter=LAVOURAS,
+                count=cluster["lavouras"],
+                latitude=float(cluster["latitude"] * cluster["lavouras"]),
+                longitude=float(cluster["longitude"] * cluster["lavouras"]),
+            )
+        )
+        rows.extend(
+            dict(key, counter=f"tipo:{tipo}", count=count)
+            for tipo, count in cluster["tipos"].items()
+        )
+        rows.extend(
+            dict(key, counter=f"evento:{codes[name]}", count=count)
+            for name, count in cluster["perdas"].items()
+        )
+    if rows:
+        session.execute(table.insert(), rows)
+
+
+def get_tile(z: int, x: int, y: int) -> list:
+    """Returns the clusters of a tile, building and caching it if needed"""
+    clusters = cached_tile(z, x, y)
+    if clusters is not None:
+        return clusters
+
+    clusters = build_tile(z, x, y)
+    try:
+        _store_tile(db.session, z, x, y, clusters)
+        db.session.commit()
+    except IntegrityError:
+        # Another worker has just cached it
+        db.session.rollback()
+    return clusters
+
+
+def _tiles_condition(table, latitudes: np.ndarray, longitudes: np.ndarray):
+    """Matches the rows of the cached tiles, of every zoom, that contain
+    some points"""
+    max_keys = int(current_app.config["TILE_INVALIDATION_MAX_KEYS"])
+    conditions = []
+    for z in range(int(current_app.config["TILE_MAX_ZOOM"]) + 1):
+        tile_x, tile_y = point_tiles(latitudes, longitudes, z)
+        tiles = np.unique(
+            np.stack([tile_x.astype(np.int64), tile_y.astype(np.int64)]),
+            axis=1,
+        )
+        if tiles.shape[1] <= max_keys:
+            condition = or_(
+                *(
+                    and_(table.c.x == tx, table.c.y == ty)
+                    for tx, ty in tiles.T.tolist()
+                )
+            )
+        else:
+            # Too many tiles, so match their bounding box instead
+            condition = and_(
+                table.c.x.between(int(tiles[0].min()), int(tiles[0].max())),
+                table.c.y.between(int(tiles[1].min()), int(tiles[1].max())),
+            )
+        conditions.append(and_(table.c.z == z, condition))
+    return or_(*conditions)
+
+
+def invalidate_points(
+    session: Session, latitudes: np.ndarray, longitudes: np.ndarray
+):
+    """Drops the cached tiles that contain any of the given points
+
+    Runs inside the caller transaction, so the cache is invalidated only
+    if the change is committed
+
+    Parameters
+    ----------
+    session : Session
+    latitudes : np.ndarray
+    longitudes : np.ndarray
+    """
+    if not len(latitudes):
+        return
+    for table in (TileCache.__table__, TileCell.__table__):
+        session.execute(
+            table.delete().where(
+                _tiles_condition(table, latitudes, longitudes)
+            )
+        )
+
+
+def _cell_deltas(lavouras: list, perdas: list, max_tiles: int) -> dict:
+    """Sums the changes of each counter of each grid cell, at every zoom
+
+    Returns
+    -------
+    dict | None
+        {(z, x, y, cell_x, cell_y, counter): [count, latitude sum,
+        longitude sum]}, or None when the changes touch more than
+        `max_tiles` tiles
+    """
+    grid = int(current_app.config["TILE_GRID_SIZE"])
+    changes = [
+        (latitude, longitude, sign, f"tipo:{tipo}")
+        for latitude, longitude, tipo, sign in lavouras
+    ] + [
+        (latitude, longitude, sign, f"evento:{evento}")
+        for latitude, longitude, evento, sign in perdas
+    ]
+    latitudes, longitudes = np.array(
+        [change[:2] for change in changes], dtype=np.float64
+    ).T
+
+    zooms = []
+    tiles = 0
+    for z in range(int(current_app.config["TILE_MAX_ZOOM"]) + 1):
+        tile_x, tile_y = point_tiles(latitudes, longitudes, z)
+        xs, ys = tile_x.astype(np.int64), tile_y.astype(np.int64)
+        tiles += len(np.unique(xs * 2**z + ys))
+        if tiles > max_tiles:
+            return None
+        zooms.append((z, tile_x, tile_y, xs, ys))
+
+    deltas = {}
+    for z, tile_x, tile_y, xs, ys in zooms:
+        cell_xs = ((tile_x - xs) * grid).astype(np.int64).tolist()
+        cell_ys = ((tile_y - ys) * grid).astype(np.int64).tolist()
+        for index, (latitude, longitude, sign, counter) in enumerate(changes):
+            cell = (z, int(xs[index]), int(ys[index]))
+            cell += (cell_xs[index], cell_ys[index])
+            deltas.setdefault(cell + (counter,), [0, 0.0, 0.0])[0] += sign
+            if counter.startswith("tipo:"):
+                delta = deltas.setdefault(cell + (LAVOURAS,), [0, 0.0, 0.0])
+                delta[0] += sign
+                delta[1] += sign * latitude
+                delta[2] += sign * longitude
+    return deltas
+
+
+# Adds to a counter of a cached tile, creating it if needed. Writers of
+# the same counter take turns, the others do not wait for each other
+_ADD_TO_COUNTER = text(
+    "INSERT INTO tile_cell"
+    " (z, x, y, cell_x, cell_y, counter, count, latitude, longitude)"
+    " SELECT :z, :x, :y, :cell_x, :cell_y, :counter, :count, :latitude,"
+    " :longitude"
+    " WHERE EXISTS (SELECT 1 FROM tile_cache"
+    " WHERE z = :z AND x = :x AND y = :y)"
+    " ON CONFLICT (z, x, y, cell_x, cell_y, counter) DO UPDATE SET"
+    " count = tile_cell.count + excluded.count,"
+    " latitude = tile_cell.latitude + excluded.latitude,"
+    " longitude = tile_cell.longitude + excluded.longitude"
+)
+
+
+def update_tiles(session: Session, lavouras: list = (), perdas: list = ()):
+    """Applies crop and loss changes to the cached tiles in place
+
+    The tiles that are not cached are left alone, they are built with
+    the changes on the next read. Runs inside the caller transaction, as
+    atomic additions to the counters of the cached tiles (in a fixed
+    order, so writers can not deadlock), so the cache changes only if
+    the change is committed.
+
+    Parameters
+    ----------
+    session : Session
+    lavouras : list, optional
+        (latitude, longitude, tipo, sign) of the crops added (sign 1) or
+        removed (sign -1)
+    perdas : list, optional
+        (latitude, longitude of the crop, evento, sign) of the losses
+        added or removed
+    """
+    perdas = [perda for perda in perdas if perda[2] in EVENTOS]
+    if not lavouras and not perdas:
+        return
+
+    deltas = _cell_deltas(
+        lavouras,
+        perdas,
+        max_tiles=int(current_app.config["TILE_INVALIDATION_MAX_KEYS"]),
+    )
+    if deltas is None:
+        # Cheaper to rebuild the few cached ones when they are read
+        latitudes, longitudes = np.array(
+            [change[:2] for change in (*lavouras, *perdas)], dtype=np.float64
+        ).T
+        invalidate_points(session, latitudes, longitudes)
+        return
+
+    additions = [
+        {
+            "z": z,
+            "x": x,
+            "y": y,
+            "cell_x": cell_x,
+            "cell_y": cell_y,
+            "counter": counter,
+            "count": count,
+            "latitude": float(latitude),
+            "longitude": float(longitude),
+        }
+        for (z, x, y, cell_x, cell_y, counter), (
+            count,
+            latitude,
+            longitude,
+        ) in sorted(deltas.items())
+        if count or latitude or longitude
+    ]
+    if additions:
+        session.execute(_ADD_TO_COUNTER, additions)
+
+
+def _update_after_flush(session: Session, flush_context):
+    """Applies the `Lavoura`/`Perda` changes to the cached tiles"""
+    lavouras = []
+    perdas = []
+    moved = []
+    coordinates = {}
+
+    for instances, sign in (
+        (session.new, 1),
+        (session.deleted, -1),
+        (session.dirty, 0),
+    ):
+        for instance in instances:
+            state = inspect(instance)
+            if isinstance(instance, Lavoura):
+                point = (instance.latitude, instance.longitude)
+                coordinates[instance.id] = point
+                old_latitudes = state.attrs.latitude.history.deleted
+                old_longitudes = state.attrs.longitude.history.deleted
+                old_tipos = state.attrs.tipo.history.deleted
+                if sign:
+                    lavouras.append((*point, instance.tipo, sign))
+                elif old_latitudes or old_longitudes:
+                    # Its losses move too, so its tiles are rebuilt
+                    moved.append(point)
+                    moved.append(
+                        (
+                            (old_latitudes or [instance.latitude])[0],
+                            (old_longitudes or [instance.longitude])[0],
+                        )
+                    )
+                elif old_tipos:
+                    lavouras.append((*point, old_tipos[0], -1))
+                    lavouras.append((*point, instance.tipo, 1))
+            elif isinstance(instance, Perda):
+                if sign:
+                    perdas.append((instance.lavoura_id, instance.evento, sign))
+                    continue
+                old_lavouras = state.attrs.lavoura_id.history.deleted
+                old_eventos = state.attrs.evento.history.deleted
+                if old_lavouras or old_eventos:
+                    perdas.append(
+                        (
+                            (old_lavouras or [instance.lavoura_id])[0],
+                            (old_eventos or [instance.evento])[0],
+                            -1,
+                        )
+                    )
+                    perdas.append((instance.lavoura_id, instance.evento, 1))
+
+    unknown = {perda[0] for perda in perdas} - set(coordinates) - {None}
+    if unknown:
+        coordinates.update(
+            (lavoura_id, (latitude, longitude))
+            for lavoura_id, latitude, longitude in session.query(
+                Lavoura.id, Lavoura.latitude, Lavoura.longitude
+            ).filter(Lavoura.id.in_(unknown))
+        )
+
+    moved = [point for point in moved if None not in point]
+    if moved:
+        latitudes, longitudes = np.array(moved, dtype=np.float64).T
+        invalidate_points(session, latitudes, longitudes)
+    update_tiles(
+        session,
+        lavouras=[lavoura for lavoura in lavouras if None not in lavoura[:2]],
+        perdas=[
+            (*coordinates[lavoura_id], evento, sign)
+            for lavoura_id, evento, sign in perdas
+            if lavoura_id in coordinates
+        ],
+    )
+
+
+def build_tiles(max_zoom: int = None, on_zoom: callable = None):
+    """Builds the tile cache of every non empty tile up to a zoom level
+
+    Parameters
+    ----------
+    max_zoom : int, optional
+        Last zoom level to build, by default TILE_MAX_ZOOM
+    on_zoom : callable, optional
+        Called with (zoom, number of tiles) after each zoom level is
+        committed, by default None
+    """
+    if max_zoom is None:
+        max_zoom = int(current_app.config["TILE_MAX_ZOOM"])
+
+    coordinates = np.array(
+        db.session.query(Lavoura.latitude, Lavoura.longitude).all(),
+        dtype=np.float64,
+    ).reshape(-1, 2)
+
+    for z in range(max_zoom + 1):
+        tile_x, tile_y = point_tiles(coordinates[:, 0], coordinates[:, 1], z)
+        tiles = np.unique(
+            np.stack([tile_x.astype(np.int64), tile_y.astype(np.int64)]),
+            axis=1,
+        )
+        for table in (TileCache.__table__, TileCell.__table__):
+            db.session.execute(table.delete().where(table.c.z == z))
+        for x, y in tiles.T.tolist():
+            _store_tile(db.session, z, x, y, build_tile(z, x, y))
+        db.session.commit()
+        if on_zoom is not None:
+            on_zoom(z, tiles.shape[1])
+
+
+@click.command("build-tiles")
+@click.option("--max-zoom", type=int, help="Last zoom level to build")
+@with_appcontext
+def build_tiles_command(max_zoom):
+    """Builds the tile cache of every non empty tile up to a zoom level"""
+    build_tiles(
+        max_zoom=max_zoom,
+        on_zoom=lambda z, tiles: click.echo(
+            f"Zoom {z}: {tiles} tiles", err=True
+        ),
+    )
+
+
+def init_app(app: Flask):
+    if not event.contains(db.session, "after_flush", _update_after_flush):
+        event.listen(db.session, "after_flush", _update_after_flush)
+    app.cli.add_command(build_tiles_command)
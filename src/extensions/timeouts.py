@@ -0,0 +1,186 @@
+import json
+import threading
+from time import monotonic
+
+from flask import Flask, current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError
+
+from src.extensions.database import db
+from src.utils import json_response
+
+# SQLite calls the progress handler every this many VM instructions
+SQLITE_PROGRESS_STEPS = 1000
+
+# PostgreSQL "query_canceled", raised when statement_timeout is reached
+POSTGRESQL_QUERY_CANCELED = "57014"
+
+
+class StatementTimeouts:
+    """Per-route statement time budgets and their cancellation counts
+
+    Budgets come from `STATEMENT_TIMEOUTS`, keyed by "METHOD /rule" or
+    "/rule", in milliseconds, falling back to `STATEMENT_TIMEOUT_DEFAULT`.
+    0 means no budget. Streamed reads are bounded per FETCH on PostgreSQL
+    and only until their first row on SQLite, never by the download.
+    """
+
+    def __init__(self, budgets: dict, default: int):
+        self.budgets = budgets
+        self.default = default
+        self.lock = threading.Lock()
+        self.cancelled = {}
+
+    def budget(self, method: str, rule: str) -> int:
+        for key in (f"{method} {rule}", rule):
+            if key in self.budgets:
+                return int(self.budgets[key])
+        return self.default
+
+    def count(self, route: str):
+        with self.lock:
+            self.cancelled[route] = self.cancelled.get(route, 0) + 1
+
+    def report(self) -> dict:
+        with self.lock:
+            cancelled = dict(self.cancelled)
+        return {
+            "default_ms": self.default,
+            "budgets_ms": self.budgets,
+            "cancelled": cancelled,
+            "cancelled_total": sum(cancelled.values()),
+        }
+
+
+def is_timeout(error: Exception) -> bool:
+    """Tells if a database error was raised by a statement budget"""
+    original = getattr(error, "orig", error)
+    if getattr(original, "pgcode", None) == POSTGRESQL_QUERY_CANCELED:
+        return True
+    return str(original) == "interrupted"
+
+
+def timeout_response(error: Exception):
+    """Builds the response of a request whose query ran out of time
+
+    Returns
+    -------
+    Response | None
+        None when `error` was not raised by a statement budget
+    """
+    if not is_timeout(error):
+        return None
+    # Ends the aborted transaction, so the connection goes back to the
+    # pool clean
+    db.session.rollback()
+    return json_response(
+        status_code=503,
+        message=(
+            "The request took longer than the"
+            f" {_request_budget()} ms allowed for its queries"
+        ),
+    )
+
+
+def _rule() -> str:
+    return request.url_rule.rule if request.url_rule else request.path
+
+
+def _request_budget() -> int:
+    # Not kept in `g`, batch sub-requests share it with their batch
+    if not has_request_context():
+        return 0
+    timeouts = current_app.extensions["statement_timeouts"]
+    return timeouts.budget(request.method, _rule())
+
+
+def _set_postgresql_budget(connection, budget: int):
+    # LOCAL: it ends with the transaction, so the connection goes back to
+    # the pool without it
+    if budget:
+        connection.execute(f"SET LOCAL statement_timeout = {int(budget)}")
+    else:
+        connection.execute("SET LOCAL statement_timeout TO DEFAULT")
+
+
+def apply_request_budget():
+    """Sets the budget of the current request on the open transaction
+
+    PostgreSQL transactions get the budget of the request they begin in,
+    so a request that shares the transaction of another one (a batch
+    sub-request) must set its own. SQLite budgets are set per statement
+    already.
+    """
+    if db.session.get_bind().dialect.name == "postgresql":
+        _set_postgresql_budget(db.session.connection(), _request_budget())
+
+
+def _set_postgresql_timeout(session, transaction, connection):
+    if connection.dialect.name != "postgresql":
+        return
+    budget = _request_budget()
+    if budget:
+        _set_postgresql_budget(connection, budget)
+
+
+def _set_sqlite_deadline(
+    connection, cursor, statement, parameters, context, executemany
+):
+    if connection.dialect.name != "sqlite":
+        return
+    budget = _request_budget()
+    # Set on every statement, so a pooled connection never keeps the
+    # deadline of a previous request
+    if not budget:
+        connection.connection.set_progress_handler(None, 0)
+        return
+    deadline = monotonic() + budget / 1000
+    connection.connection.set_progress_handler(
+        lambda: monotonic() > deadline, SQLITE_PROGRESS_STEPS
+    )
+
+
+def _clear_sqlite_streaming_deadline(
+    connection, cursor, statement, parameters, context, executemany
+):
+    if connection.dialect.name != "sqlite" or not context:
+        return
+    if context.execution_options.get("stream_results", False):
+        # The rows of a streamed read (e.g. an export) are fetched as the
+        # client downloads them, so its budget ends with its execution,
+        # as each FETCH has its own one on PostgreSQL
+        connection.connection.set_progress_handler(None, 0)
+
+
+def _count_timeouts(context):
+    if has_request_context() and is_timeout(context.original_exception):
+        current_app.extensions["statement_timeouts"].count(
+            f"{request.method} {_rule()}"
+        )
+
+
+def init_app(app: Flask):
+    budgets = app.config["STATEMENT_TIMEOUTS"]
+    if isinstance(budgets, str):
+        budgets = json.loads(budgets)
+    app.extensions["statement_timeouts"] = StatementTimeouts(
+        budgets=budgets,
+        default=int(app.config["STATEMENT_TIMEOUT_DEFAULT"]),
+    )
+
+    for target, name, listener in (
+        (db.session, "after_begin", _set_postgresql_timeout),
+        (Engine, "before_cursor_execute", _set_sqlite_deadline),
+        (Engine, "after_cursor_execute", _clear_sqlite_streaming_deadline),
+        (Engine, "handle_error", _count_timeouts),
+    ):
+        if not event.contains(target, name, listener):
+            event.listen(target, name, listener)
+
+    @app.errorhandler(DBAPIError)
+    def statement_timeout(e):
+        response = timeout_response(e)
+        if response is None:
+            raise e
+        return response
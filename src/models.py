@@ -1,8 +1,30 @@
-from sqlalchemy import Column, Integer, String, Float, Date, ForeignKey
+from datetime import datetime
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    Integer,
+    String,
+    Float,
+    Date,
+    ForeignKey,
+    Index,
+    Text,
+)
 from src.extensions.database import db
 
 STRING_BASE_LENGTH = 200
 
+EVENTOS = {
+    1: "CHUVA EXCESSIVA",
+    2: "GEADA",
+    3: "GRANIZO",
+    4: "SECA",
+    5: "VENDAVAL",
+    6: "RAIO",
+}
+
 
 class User(db.Model):
     id = Column(Integer, primary_key=True)
@@ -30,6 +52,10 @@ class Lavoura(db.Model):
     longitude = Column(Float(precision=32), nullable=False)
     tipo = Column(String(STRING_BASE_LENGTH), nullable=False)
 
+    __table_args__ = (
+        Index("ix_lavoura_latitude_longitude", "latitude", "longitude"),
+    )
+
     def __repr__(self) -> str:
         return "<Lavoura %r>" % self.id
 
@@ -47,15 +73,172 @@ class Perda(db.Model):
     evento = Column(Integer, nullable=False)
 
     produtor_rural_id = Column(
-        Integer, ForeignKey("produtor_rural.id"), nullable=False
+        Integer, ForeignKey("produtor_rural.id"), nullable=False, index=True
     )
     produtor_rural = db.relationship(
         "ProdutorRural", backref=db.backref("perdas", lazy=True)
     )
-    lavoura_id = Column(Integer, ForeignKey("lavoura.id"), nullable=False)
+    lavoura_id = Column(
+        Integer, ForeignKey("lavoura.id"), nullable=False, index=True
+    )
     lavoura = db.relationship(
         "Lavoura", backref=db.backref("perdas", lazy=True)
     )
 
+    # On PostgreSQL the table is also range partitioned by `data`, one
+    # partition per year, and has a BRIN index on `data`. Its primary key
+    # there is (id, data), so a trigger keeps `id` unique. See migration
+    # 9b2e4f6c1d38 and the `perda-partitions` command
+    __table_args__ = (Index("ix_perda_data_evento", "data", "evento"),)
+
     def __repr__(self) -> str:
         return "<Perda %r>" % self.id
+
+
+class ProdutorPerdaResumo(db.Model):
+    """Loss summary of a producer, kept up to date with `Perda`
+
+    Producers without losses have no row. See the `perda-summaries`
+    extension
+    """
+
+    produtor_rural_id = Column(
+        Integer,
+        ForeignKey("produtor_rural.id", ondelete="CASCADE"),
+        primary_key=True,
+        autoincrement=False,
+    )
+    produtor_rural = db.relationship(
+        "ProdutorRural",
+        backref=db.backref(
+            "resumo_perdas", lazy=True, uselist=False, passive_deletes=True
+        ),
+    )
+    perdas = Column(Integer, nullable=False)
+    ultima_perda = Column(Date, nullable=False)
+    evento_frequente = Column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return "<ProdutorPerdaResumo %r>" % self.produtor_rural_id
+
+
+class LavouraPerdaResumo(db.Model):
+    """Loss summary of a crop, kept up to date with `Perda`
+
+    Crops without losses have no row. See the `perda-summaries`
+    extension
+    """
+
+    lavoura_id = Column(
+        Integer,
+        ForeignKey("lavoura.id", ondelete="CASCADE"),
+        primary_key=True,
+        autoincrement=False,
+    )
+    lavoura = db.relationship(
+        "Lavoura",
+        backref=db.backref(
+            "resumo_perdas", lazy=True, uselist=False, passive_deletes=True
+        ),
+    )
+    perdas = Column(Integer, nullable=False)
+    ultima_perda = Column(Date, nullable=False)
+    evento_frequente = Column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return "<LavouraPerdaResumo %r>" % self.lavoura_id
+
+
+class TileCache(db.Model):
+    """A cached tile, whose grid clusters are kept in `TileCell`"""
+
+    z = Column(Integer, primary_key=True, autoincrement=False)
+    x = Column(Integer, primary_key=True, autoincrement=False)
+    y = Column(Integer, primary_key=True, autoincrement=False)
+
+    def __repr__(self) -> str:
+        return "<TileCache %r/%r/%r>" % (self.z, self.x, self.y)
+
+
+class TileCell(db.Model):
+    """One counter of a grid cell of a cached tile
+
+    Each counter has its own row, so writers add to it with an atomic
+    UPDATE instead of rewriting (and locking) the whole tile
+    """
+
+    z = Column(Integer, primary_key=True, autoincrement=False)
+    x = Column(Integer, primary_key=True, autoincrement=False)
+    y = Column(Integer, primary_key=True, autoincrement=False)
+    cell_x = Column(Integer, primary_key=True, autoincrement=False)
+    cell_y = Column(Integer, primary_key=True, autoincrement=False)
+    # "lavouras", "tipo:<tipo>" or "evento:<code>"
+    counter = Column(String(STRING_BASE_LENGTH + 10), primary_key=True)
+    count = Column(Integer, nullable=False)
+    # Sums of the crop coordinates, in the "lavouras" counter only
+    latitude = Column(Float, nullable=False, default=0)
+    longitude = Column(Float, nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return "<TileCell %r/%r/%r %r,%r %r>" % (
+            self.z,
+            self.x,
+            self.y,
+            self.cell_x,
+            self.cell_y,
+            self.counter,
+        )
+
+
+class Job(db.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    status = Column(String(20), nullable=False, default=QUEUED, index=True)
+    # JSON encoded handler arguments and return value
+    params = Column(Text, nullable=False, default="{}")
+    result = Column(Text)
+    error = Column(Text)
+    progress = Column(Float, nullable=False, default=0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=1)
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    # Username of who enqueued it, the only user that can see it
+    owner = Column(String(STRING_BASE_LENGTH), index=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    def __repr__(self) -> str:
+        return "<Job %r %r>" % (self.id, self.kind)
+
+
+class ChangeLog(db.Model):
+    """One row per committed write to a synced entity or a loss
+
+    The id is the cursor of the `/changes` feed. Rows are inserted when
+    the transaction commits, so ids follow the commit order, and are never
+    handed out again once pruned
+    """
+
+    INSERT = "insert"
+    UPDATE = "update"
+    DELETE = "delete"
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String(20), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    operation = Column(String(10), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    # Without it SQLite takes max(id) + 1, reusing the ids of pruned rows
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    def __repr__(self) -> str:
+        return "<ChangeLog %r>" % self.id
@@ -140,3 +140,18 @@ def json_response(
         response["payload"] = payload
 
     return response, status_code
+
+
+def is_enabled(value) -> bool:
+    """Reads a boolean setting that may come from the environment
+
+    Parameters
+    ----------
+    value : bool | str
+        The setting, e.g. `True` or "true" / "1" when set by an env var
+
+    Returns
+    -------
+    bool
+    """
+    return str(value).lower() in ("1", "true", "yes", "on")
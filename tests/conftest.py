@@ -0,0 +1,76 @@
+import os
+from datetime import date
+
+import pytest
+
+os.environ["FLASK_ENV"] = "testing"
+os.environ["SECRET_KEY"] = "testing"
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "env(**variables): environment the app is created with"
+    )
+
+
+@pytest.fixture
+def app(request, tmp_path, monkeypatch):
+    monkeypatch.setenv(
+        "SQLALCHEMY_DATABASE_URI", f"sqlite:///{tmp_path / 'test.sqlite'}"
+    )
+    monkeypatch.setenv("JOBS_STORAGE_PATH", str(tmp_path / "jobs"))
+    monkeypatch.setenv("SNAPSHOT_PATH", str(tmp_path / "snapshots"))
+    # The tables are only created below
+    monkeypatch.setenv("SPATIAL_BUILD_ON_STARTUP", "false")
+    marker = request.node.get_closest_marker("env")
+    for key, value in (marker.kwargs if marker else {}).items():
+        monkeypatch.setenv(key, str(value))
+
+    from src.app import create_app
+    from src.extensions.database import db
+
+    app = create_app()
+    with app.app_context():
+        db.create_all()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+        db.engine.dispose()
+
+
+# pytest-flask keeps a request context (and so an app context) pushed
+# during each test, so the fixtures below run inside it
+
+
+@pytest.fixture
+def token(app):
+    from src.extensions.authentication import create_user, generate_token
+
+    create_user("tester", "secret")
+    return generate_token("tester", "secret")
+
+
+@pytest.fixture
+def seed(app):
+    """A producer, a crop and a loss, returned as their ids"""
+    from src.extensions.database import db
+    from src.models import Lavoura, Perda, ProdutorRural
+
+    produtor = ProdutorRural(nome="Produtor", email="p@x", cpf="1" * 11)
+    lavoura = Lavoura(latitude=-23.5, longitude=-51.2, tipo="SOJA")
+    db.session.add_all((produtor, lavoura))
+    db.session.flush()
+    perda = Perda(
+        data=date(2021, 4, 1),
+        evento=2,
+        produtor_rural_id=produtor.id,
+        lavoura_id=lavoura.id,
+    )
+    db.session.add(perda)
+    db.session.commit()
+    return {
+        "produtor": produtor.id,
+        "lavoura": lavoura.id,
+        "perda": perda.id,
+    }
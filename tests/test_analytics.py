@@ -0,0 +1,162 @@
+from datetime import date
+
+import pytest
+
+from src.extensions.analytics import parse_params, perda_statistics
+from src.extensions.database import db
+from src.models import Lavoura, Perda, ProdutorRural
+
+
+@pytest.fixture
+def perdas(app):
+    """Two SOJA crops in the same cell, with 3 losses on the first, and a
+    MILHO crop far away with 1"""
+    produtor = ProdutorRural(nome="Produtor", email="p@x", cpf="1" * 11)
+    lavouras = [
+        Lavoura(latitude=-23.55, longitude=-51.25, tipo="SOJA"),
+        Lavoura(latitude=-23.56, longitude=-51.26, tipo="SOJA"),
+        Lavoura(latitude=-10.05, longitude=-40.05, tipo="MILHO"),
+    ]
+    db.session.add_all((produtor, *lavouras))
+    db.session.flush()
+    db.session.add_all(
+        Perda(
+            data=data,
+            evento=evento,
+            produtor_rural_id=produtor.id,
+            lavoura_id=lavouras[index].id,
+        )
+        for index, data, evento in (
+            (0, date(2021, 4, 1), 2),
+            (0, date(2021, 4, 15), 2),
+            (0, date(2021, 5, 3), 3),
+            (2, date(2021, 4, 20), 2),
+        )
+    )
+    db.session.commit()
+    return produtor.id, [lavoura.id for lavoura in lavouras]
+
+
+def _groups(result, *names):
+    return [
+        (*(group[name] for name in names), group["perdas"], group["lavouras"])
+        for group in result["grupos"]
+    ]
+
+
+def test_valid_params_are_parsed(app):
+    assert parse_params(
+        agrupar="evento,mes", inicio="2021-04-01", percentis="50,90"
+    ) == {
+        "inicio": date(2021, 4, 1),
+        "agrupar": ["evento", "mes"],
+        "celula": 0.1,
+        "percentis": [50, 90],
+    }
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"agrupar": "evento,lavoura"},
+        {"agrupar": "evento,evento"},
+        {"celula": "0"},
+        {"celula": "x"},
+        {"percentis": "50,101"},
+        {"percentis": "p50"},
+        {"evento": "9"},
+        {"inicio": "2021-13-01"},
+    ],
+)
+def test_invalid_params_are_rejected(app, params):
+    with pytest.raises(ValueError):
+        parse_params(**params)
+
+
+def test_losses_are_counted_per_group(perdas):
+    result = perda_statistics(agrupar=["evento", "tipo"])
+
+    assert (result["perdas"], result["lavouras"]) == (4, 3)
+    assert _groups(result, "evento", "tipo") == [
+        ("GEADA", "SOJA", 2, 2),
+        ("GEADA", "MILHO", 1, 1),
+        ("GRANIZO", "SOJA", 1, 2),
+    ]
+    assert [group["taxa"] for group in result["grupos"]] == [1, 1, 0.5]
+
+
+def test_losses_are_counted_per_cell_and_month(perdas):
+    result = perda_statistics(
+        agrupar=["celula", "mes"], inicio=date(2021, 4, 10)
+    )
+
+    assert _groups(result, "celula", "mes") == [
+        ({"latitude": -23.6, "longitude": -51.3}, "2021-04", 1, 2),
+        ({"latitude": -23.6, "longitude": -51.3}, "2021-05", 1, 2),
+        ({"latitude": -10.1, "longitude": -40.1}, "2021-04", 1, 1),
+    ]
+
+
+def test_percentiles_count_crops_without_losses(perdas):
+    result = perda_statistics(agrupar=["tipo"], percentis=[0, 50, 100])
+
+    # SOJA crops have 3 and 0 losses, the MILHO one has 1
+    assert [
+        (group["tipo"], group["percentis"]) for group in result["grupos"]
+    ] == [
+        ("SOJA", {"0": 0, "50": 0, "100": 3}),
+        ("MILHO", {"0": 1, "50": 1, "100": 1}),
+    ]
+
+
+def test_nothing_selected_is_an_empty_result(perdas):
+    assert perda_statistics(agrupar=["evento"], evento=5) == {
+        "grupos": [],
+        "perdas": 0,
+        "lavouras": 3,
+        "truncado": False,
+    }
+    result = perda_statistics(agrupar=["evento"], tipo="ARROZ")
+    assert (result["perdas"], result["lavouras"]) == (0, 0)
+
+
+@pytest.mark.env(ANALYTICS_MAX_GROUPS=1)
+def test_only_the_largest_groups_are_kept(perdas):
+    result = perda_statistics(agrupar=["evento"])
+    assert result["truncado"]
+    assert _groups(result, "evento") == [("GEADA", 3, 3)]
+
+
+def test_committed_losses_are_counted_at_once(perdas):
+    produtor_id, lavoura_ids = perdas
+    assert perda_statistics(agrupar=[])["perdas"] == 4
+
+    db.session.add(
+        Perda(
+            data=date(2021, 6, 1),
+            evento=4,
+            produtor_rural_id=produtor_id,
+            lavoura_id=lavoura_ids[1],
+        )
+    )
+    db.session.commit()
+    result = perda_statistics(agrupar=["evento"])
+    assert _groups(result, "evento")[-1] == ("SECA", 1, 3)
+
+
+def test_endpoint_answers_the_statistics(client, token, perdas):
+    response = client.get(
+        "/api/v1/analytics/perdas",
+        query_string={"access_token": token, "agrupar": "tipo"},
+    )
+    assert response.status_code == 200
+    assert _groups(response.get_json()["payload"], "tipo") == [
+        ("SOJA", 3, 2),
+        ("MILHO", 1, 1),
+    ]
+
+    response = client.get(
+        "/api/v1/analytics/perdas",
+        query_string={"access_token": token, "agrupar": "produtor"},
+    )
+    assert response.status_code == 400
@@ -0,0 +1,54 @@
+def test_token_is_required(client):
+    response = client.get("/api/v1/produtores/")
+    assert response.status_code == 401
+
+
+def test_token_is_not_reused_by_later_requests(client, token):
+    response = client.get(
+        "/api/v1/produtores/", query_string={"access_token": token}
+    )
+    assert response.status_code == 200
+
+    # Same app context (pytest-flask keeps one pushed), no token
+    response = client.get("/api/v1/produtores/")
+    assert response.status_code == 401
+
+
+def test_invalid_token(client):
+    response = client.get(
+        "/api/v1/produtores/", query_string={"access_token": "invalid"}
+    )
+    assert response.status_code == 403
+
+
+def test_batch_sub_requests_use_the_batch_token(client, token):
+    response = client.post(
+        "/api/v1/batch",
+        json={
+            "access_token": token,
+            "requests": [{"path": "/api/v1/produtores/"}],
+        },
+    )
+    assert response.get_json()["payload"]["responses"][0]["status"] == 200
+
+    response = client.get("/api/v1/produtores/")
+    assert response.status_code == 401
+
+
+def test_parallel_sub_requests_use_the_batch_token(client, token):
+    response = client.post(
+        "/api/v1/batch",
+        json={
+            "access_token": token,
+            "parallel": True,
+            "requests": [
+                {"path": "/api/v1/produtores/"},
+                {"path": "/api/v1/lavouras/"},
+            ],
+        },
+    )
+    statuses = [
+        sub_response["status"]
+        for sub_response in response.get_json()["payload"]["responses"]
+    ]
+    assert statuses == [200, 200]
@@ -0,0 +1,125 @@
+import pytest
+from sqlalchemy import create_engine
+
+from src.extensions.database import db
+from src.models import Perda
+
+
+def _perda(seed, **fields):
+    return dict(
+        {
+            "data": "2021-04-02",
+            "evento": 1,
+            "produtor_rural_id": seed["produtor"],
+            "lavoura_id": seed["lavoura"],
+        },
+        **fields,
+    )
+
+
+def _atomic(client, token, *bodies):
+    return client.post(
+        "/api/v1/batch",
+        json={
+            "access_token": token,
+            "atomic": True,
+            "requests": [
+                {"method": "POST", "path": "/api/v1/perdas/", "body": body}
+                for body in bodies
+            ],
+        },
+    )
+
+
+def test_atomic_batch_commits_everything(client, seed, token):
+    response = _atomic(client, token, _perda(seed), _perda(seed, evento=2))
+    statuses = [
+        sub_response["status"]
+        for sub_response in response.get_json()["payload"]["responses"]
+    ]
+    assert statuses == [201, 201]
+    assert Perda.query.count() == 3
+
+
+def test_atomic_batch_rolls_back_on_failure(client, seed, token):
+    response = _atomic(client, token, _perda(seed), _perda(seed, evento=9))
+    statuses = [
+        sub_response["status"]
+        for sub_response in response.get_json()["payload"]["responses"]
+    ]
+    assert statuses == [201, 400]
+    assert Perda.query.count() == 1
+
+
+@pytest.mark.env(INGEST_GROUP_COMMIT=True)
+def test_atomic_batch_bypasses_group_commit(client, seed, token):
+    assert "group_committer" in client.application.extensions
+    response = _atomic(client, token, _perda(seed), _perda(seed, evento=9))
+    statuses = [
+        sub_response["status"]
+        for sub_response in response.get_json()["payload"]["responses"]
+    ]
+    assert statuses == [201, 400]
+    assert Perda.query.count() == 1
+
+
+def test_failed_sub_request_does_not_stop_the_batch(client, seed, token):
+    response = client.post(
+        "/api/v1/batch",
+        json={
+            "access_token": token,
+            "requests": [
+                {"method": "POST", "path": "/api/v1/perdas/", "body": {}},
+                {
+                    "method": "POST",
+                    "path": "/api/v1/perdas/",
+                    "body": _perda(seed),
+                },
+            ],
+        },
+    )
+    statuses = [
+        sub_response["status"]
+        for sub_response in response.get_json()["payload"]["responses"]
+    ]
+    assert statuses == [400, 201]
+    assert Perda.query.count() == 2
+
+
+@pytest.mark.parametrize(
+    "sub_request",
+    [
+        {"method": 5, "path": "/api/v1/produtores/"},
+        {"path": 7},
+        {"path": "http://evil/api/v1/produtores/"},
+        {"path": "//evil/api/v1/produtores/"},
+        {"path": "/api/v1/produtores/", "query": 3},
+    ],
+)
+@pytest.mark.parametrize("parallel", [False, True])
+def test_malformed_sub_request_is_a_400(client, token, sub_request, parallel):
+    response = client.post(
+        "/api/v1/batch",
+        json={
+            "access_token": token,
+            "parallel": parallel,
+            "requests": [sub_request, {"path": "/api/v1/produtores/"}],
+        },
+    )
+    assert response.status_code == 200
+    statuses = [
+        sub_response["status"]
+        for sub_response in response.get_json()["payload"]["responses"]
+    ]
+    assert statuses == [400, 200]
+
+
+def test_only_the_app_engine_is_reconfigured(app, tmp_path):
+    with db.engine.connect() as connection:
+        assert connection.execute("PRAGMA journal_mode").scalar() == "wal"
+
+    other = create_engine(f"sqlite:///{tmp_path / 'other.sqlite'}")
+    with other.connect() as connection:
+        assert connection.execute("PRAGMA journal_mode").scalar() == "delete"
+        assert connection.connection.isolation_level == ""
+    other.dispose()
@@ -0,0 +1,114 @@
+from datetime import date
+
+import pytest
+
+from src.extensions import capture
+from src.extensions.database import db
+from src.models import Perda
+
+
+@pytest.fixture
+def captured(app):
+    delivered = []
+    capture.subscribe(app, (Perda,), delivered.extend)
+    return delivered
+
+
+def _perda(seed, evento=1):
+    return Perda(
+        data=date(2021, 4, 2),
+        evento=evento,
+        produtor_rural_id=seed["produtor"],
+        lavoura_id=seed["lavoura"],
+    )
+
+
+def test_changes_are_delivered_on_commit(app, seed, captured):
+    db.session.add(_perda(seed))
+    db.session.flush()
+    assert captured == []
+
+    db.session.commit()
+    assert [change[1] for change in captured] == [capture.INSERT]
+
+
+def test_rolled_back_changes_are_discarded(app, seed, captured):
+    db.session.add(_perda(seed))
+    db.session.flush()
+    db.session.rollback()
+    db.session.commit()
+    assert captured == []
+
+
+def test_released_savepoint_waits_for_the_outer_commit(app, seed, captured):
+    db.session.begin_nested()
+    db.session.add(_perda(seed))
+    # Releases the savepoint only
+    db.session.commit()
+    assert captured == []
+
+    db.session.rollback()
+    db.session.commit()
+    assert captured == []
+
+
+def test_rolled_back_savepoint_keeps_the_outer_changes(app, seed, captured):
+    db.session.add(_perda(seed, evento=1))
+    db.session.flush()
+    db.session.begin_nested()
+    db.session.add(_perda(seed, evento=2))
+    db.session.flush()
+    db.session.rollback()
+
+    db.session.commit()
+    assert [change[2]["evento"] for change in captured] == [1]
+
+
+def test_tracked_bulk_inserts_are_delivered_on_commit(app, seed, captured):
+    values = {
+        "id": 100,
+        "data": date(2021, 4, 2),
+        "evento": 1,
+        "produtor_rural_id": seed["produtor"],
+        "lavoura_id": seed["lavoura"],
+    }
+    db.session.execute(Perda.__table__.insert(), values)
+    capture.track(db.session, Perda, [values])
+    assert captured == []
+
+    db.session.commit()
+    assert captured == [(Perda, capture.INSERT, values)]
+
+
+def test_failed_atomic_batch_reaches_no_subscriber(client, seed, token):
+    perda = {
+        "data": "2021-04-02",
+        "evento": 1,
+        "produtor_rural_id": seed["produtor"],
+        "lavoura_id": seed["lavoura"],
+    }
+    subscriber = client.application.extensions["perda_notifier"].subscribe()
+    # Builds the columns, so later losses only arrive as captured changes
+    analytics = client.get(
+        "/api/v1/analytics/perdas", query_string={"access_token": token}
+    )
+    assert analytics.get_json()["payload"]["perdas"] == 1
+
+    response = client.post(
+        "/api/v1/batch",
+        json={
+            "access_token": token,
+            "atomic": True,
+            "requests": [
+                {"method": "POST", "path": "/api/v1/perdas/", "body": perda},
+                {"method": "POST", "path": "/api/v1/perdas/", "body": {}},
+            ],
+        },
+    )
+    assert response.status_code == 200
+    assert subscriber.empty()
+
+    analytics = client.get(
+        "/api/v1/analytics/perdas", query_string={"access_token": token}
+    )
+    assert analytics.get_json()["payload"]["perdas"] == 1
@@ -0,0 +1,140 @@
+import pytest
+
+from src.extensions.database import db
+from src.extensions.snapshot import build_snapshot
+from src.models import ChangeLog, Lavoura
+
+
+def _changes(client, token, since, **query):
+    return client.get(
+        "/api/v1/changes",
+        query_string={"access_token": token, "since": since, **query},
+    )
+
+
+def _lavoura(tipo="MILHO"):
+    return Lavoura(latitude=-23.6, longitude=-51.3, tipo=tipo)
+
+
+def test_changes_are_logged_when_committed(app):
+    db.session.add(_lavoura())
+    db.session.flush()
+    # The id, and so the cursor, is only taken at commit time
+    assert ChangeLog.query.count() == 0
+
+    db.session.commit()
+    assert [(log.entity, log.operation) for log in ChangeLog.query.all()] == [
+        ("lavoura", ChangeLog.INSERT)
+    ]
+
+
+def test_rolled_back_savepoints_are_not_logged(app):
+    db.session.add(_lavoura("SOJA"))
+    db.session.begin_nested()
+    db.session.add(_lavoura("MILHO"))
+    db.session.rollback()
+    db.session.commit()
+
+    lavoura = Lavoura.query.one()
+    assert [log.entity_id for log in ChangeLog.query.all()] == [lavoura.id]
+
+
+def test_expired_cursor_points_to_the_snapshot(client, token, seed):
+    snapshot = build_snapshot()
+    db.session.add(_lavoura())
+    db.session.commit()
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(args=["changes", "prune", "--keep-days", "0"])
+    assert result.exit_code == 0, result.output
+
+    response = _changes(client, token, 0)
+    assert response.status_code == 410
+    assert response.get_json()["payload"]["snapshot"] == snapshot
+
+    response = _changes(client, token, snapshot["cursor"])
+    assert response.status_code == 200
+    assert [
+        (change["entity"], change["data"]["tipo"])
+        for change in response.get_json()["payload"]["changes"]
+    ] == [("lavoura", "MILHO")]
+
+
+def test_pruned_ids_are_not_handed_out_again(client, token, seed):
+    snapshot = build_snapshot()
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(args=["changes", "prune", "--keep-days", "0"])
+    assert result.exit_code == 0, result.output
+    # The newest change is kept, so older cursors are still seen expired
+    assert [log.id for log in ChangeLog.query] == [snapshot["cursor"]]
+    assert _changes(client, token, 0).status_code == 410
+
+    # Not even once the whole log is gone
+    ChangeLog.query.delete()
+    db.session.commit()
+    db.session.add(_lavoura())
+    db.session.commit()
+
+    response = _changes(client, token, snapshot["cursor"])
+    assert [
+        change["cursor"]
+        for change in response.get_json()["payload"]["changes"]
+    ] == [snapshot["cursor"] + 1]
+
+
+def test_prune_keeps_everything_without_a_snapshot(client, seed):
+    runner = client.application.test_cli_runner()
+    result = runner.invoke(args=["changes", "prune", "--keep-days", "0"])
+    assert result.exit_code != 0
+    # The loss is logged too, though not part of the feed
+    assert ChangeLog.query.count() == 3
+
+
+def test_pages_resume_from_their_cursor(client, token, seed):
+    pages = []
+    cursor = 0
+    for _ in range(3):
+        payload = _changes(client, token, cursor, limit=1).get_json()
+        payload = payload["payload"]
+        pages.append(
+            ([change["entity"] for change in payload["changes"]], payload)
+        )
+        cursor = payload["cursor"]
+
+    assert [entities for entities, _ in pages] == [
+        ["produtor"],
+        ["lavoura"],
+        [],
+    ]
+    assert [payload["has_more"] for _, payload in pages] == [
+        True,
+        False,
+        False,
+    ]
+    # An empty page keeps the cursor
+    assert pages[2][1]["cursor"] == pages[1][1]["cursor"]
+
+
+def test_row_deleted_in_a_later_page_is_reported_deleted(client, token, seed):
+    cursor = _changes(client, token, 0).get_json()["payload"]["cursor"]
+    lavoura = _lavoura()
+    db.session.add(lavoura)
+    db.session.commit()
+    db.session.delete(lavoura)
+    db.session.commit()
+
+    payload = _changes(client, token, cursor, limit=1).get_json()["payload"]
+    assert [
+        (change["operation"], change["data"]) for change in payload["changes"]
+    ] == [("delete", None)]
+    assert payload["has_more"]
+
+
+@pytest.mark.parametrize(
+    "query",
+    [{"since": -1}, {"since": "x"}, {"limit": 0}, {"limit": 501}],
+)
+def test_invalid_cursors_are_rejected(client, token, query):
+    response = client.get(
+        "/api/v1/changes", query_string={"access_token": token, **query}
+    )
+    assert response.status_code == 400
@@ -0,0 +1,123 @@
+import csv
+import io
+from datetime import date
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from src.extensions import jobs
+from src.extensions.database import db
+from src.extensions.export import COLUMNS, export_perdas
+from src.models import Job, Perda
+
+
+@pytest.fixture
+def perdas(seed):
+    """Five losses of the seed crop, 2021-04-01 to 2021-04-05, the even
+    days of evento 3 and the odd ones of evento 2"""
+    db.session.add_all(
+        Perda(
+            data=date(2021, 4, day),
+            evento=3 if day % 2 == 0 else 2,
+            produtor_rural_id=seed["produtor"],
+            lavoura_id=seed["lavoura"],
+        )
+        for day in range(2, 6)
+    )
+    db.session.commit()
+    return [perda.id for perda in Perda.query.order_by(Perda.id)]
+
+
+def _export(client, token, **query):
+    return client.get(
+        "/api/v1/perdas/export", query_string={"access_token": token, **query}
+    )
+
+
+def _csv_rows(data: str) -> list:
+    rows = list(csv.reader(io.StringIO(data)))
+    assert tuple(rows[0]) == COLUMNS
+    return rows[1:]
+
+
+def test_csv_export_has_the_filtered_losses(client, token, perdas):
+    response = _export(client, token, evento="3", inicio="2021-04-03")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert "filename=perdas.csv" in response.headers["Content-Disposition"]
+
+    rows = _csv_rows(response.get_data(as_text=True))
+    assert [(int(row[0]), row[1], row[3]) for row in rows] == [
+        (perdas[3], "2021-04-04", "GRANIZO")
+    ]
+    assert rows[0][5:7] == ["Produtor", "1" * 11]
+
+
+@pytest.mark.parametrize(
+    "file_format, read",
+    [
+        ("parquet", lambda data: pq.read_table(pa.BufferReader(data))),
+        ("arrow", lambda data: pa.ipc.open_stream(data).read_all()),
+    ],
+)
+def test_columnar_exports_have_every_loss(
+    client, token, perdas, file_format, read
+):
+    response = _export(client, token, format=file_format)
+    assert response.status_code == 200
+
+    table = read(response.data)
+    assert tuple(table.column_names) == COLUMNS
+    assert table.column("perda_id").to_pylist() == perdas
+    assert table.column("data").to_pylist()[0] == date(2021, 4, 1)
+    assert table.schema.field("evento").type == pa.int8()
+
+
+@pytest.mark.parametrize(
+    "query", [{"format": "xlsx"}, {"evento": "9"}, {"fim": "2021-04-31"}]
+)
+def test_invalid_exports_are_a_400(client, token, query):
+    assert _export(client, token, **query).status_code == 400
+
+
+@pytest.mark.env(EXPORT_BATCH_SIZE=2)
+def test_export_is_streamed_in_batches(app, perdas):
+    chunks = list(export_perdas())
+    # The header with the first batch, the other two, then an empty end
+    assert len(chunks) == 4
+    assert [len(chunk.splitlines()) for chunk in chunks] == [3, 2, 1, 0]
+    assert [int(row[0]) for row in _csv_rows("".join(chunks))] == perdas
+
+
+def test_background_export_is_downloaded(client, token, perdas):
+    response = _export(
+        client, token, format="parquet", evento="2", **{"async": "1"}
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["payload"]["id"]
+    jobs.run_job(jobs.claim_next())
+
+    job = Job.query.get(job_id)
+    assert job.status == Job.SUCCEEDED, job.error
+    response = client.get(
+        f"/api/v1/jobs/{job_id}/result", query_string={"access_token": token}
+    )
+    assert response.status_code == 200
+    assert "filename=perdas.parquet" in response.headers["Content-Disposition"]
+    table = pq.read_table(pa.BufferReader(response.data))
+    assert table.column("perda_id").to_pylist() == perdas[::2]
+
+
+def test_export_command_writes_the_file(app, perdas, tmp_path):
+    path = tmp_path / "perdas.csv"
+    result = app.test_cli_runner().invoke(
+        args=["export-perdas", "--fim", "2021-04-02", str(path)]
+    )
+    assert result.exit_code == 0, result.output
+    assert [int(row[0]) for row in _csv_rows(path.read_text())] == perdas[:2]
+
+    result = app.test_cli_runner().invoke(
+        args=["export-perdas", "--evento", "x", str(path)]
+    )
+    assert result.exit_code != 0
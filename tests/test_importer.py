@@ -0,0 +1,196 @@
+import io
+import os
+
+import pytest
+from sqlalchemy import event
+
+from src.extensions import capture, jobs
+from src.extensions.database import db
+from src.extensions.importer import InvalidFileError, import_lavouras
+from src.models import Job, Lavoura
+
+# A scratch PostgreSQL database, its tables are dropped after each test
+POSTGRESQL_URI = os.environ.get("TEST_POSTGRESQL_URI", "")
+
+CSV = """latitude,longitude,tipo
+-23.1,-51.1,SOJA
+-23.2,-51.2,MILHO
+91,-51.3,SOJA
+-23.1,-51.1,TRIGO
+-23.4,-51.4
+-23.5,-51.5,
+"""
+
+
+@pytest.fixture
+def captured(app):
+    delivered = []
+    capture.subscribe(app, (Lavoura,), delivered.extend)
+    return delivered
+
+
+def test_valid_rows_are_imported_and_the_rest_rejected(app):
+    result = import_lavouras(io.StringIO(CSV), chunk_size=2)
+
+    assert result["inseridas"] == 2
+    assert [
+        (rejected["linha"], rejected["motivo"])
+        for rejected in result["rejeicoes"]
+    ] == [
+        (4, "Invalid latitude"),
+        (5, "Duplicated coordinates"),
+        (6, "Expected 3 columns"),
+        (7, "Invalid tipo"),
+    ]
+    assert sorted(lavoura.tipo for lavoura in Lavoura.query) == [
+        "MILHO",
+        "SOJA",
+    ]
+
+
+def test_coordinates_already_stored_are_rejected(app):
+    db.session.add(Lavoura(latitude=-23.2, longitude=-51.2, tipo="SOJA"))
+    db.session.commit()
+
+    result = import_lavouras(io.StringIO(CSV))
+    assert result["inseridas"] == 1
+    assert Lavoura.query.count() == 2
+
+
+def test_rejections_go_to_the_report(app):
+    report = io.StringIO()
+    result = import_lavouras(io.StringIO(CSV), report=report)
+
+    assert result["rejeicoes"] == []
+    lines = report.getvalue().splitlines()
+    assert lines[0] == "linha,motivo,latitude,longitude,tipo"
+    assert len(lines) == 1 + result["rejeitadas"] == 5
+
+
+def test_wrong_header_is_refused(app):
+    with pytest.raises(InvalidFileError):
+        import_lavouras(io.StringIO("lat,lon,tipo\n-23.1,-51.1,SOJA\n"))
+
+
+def test_imported_crops_are_captured(app, captured):
+    import_lavouras(io.StringIO(CSV))
+
+    assert sorted(
+        (values["id"], values["tipo"]) for _, _, values in captured
+    ) == sorted((lavoura.id, lavoura.tipo) for lavoura in Lavoura.query)
+
+
+def _import(client, token, query=None, **kwargs):
+    return client.post(
+        "/api/v1/lavouras/import",
+        query_string={"access_token": token, **(query or {})},
+        **kwargs,
+    )
+
+
+def test_uploaded_file_is_imported(client, token):
+    response = _import(
+        client,
+        token,
+        data={"file": (io.BytesIO(CSV.encode()), "lavouras.csv")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 201
+    payload = response.get_json()["payload"]
+    assert (payload["inseridas"], payload["rejeitadas"]) == (2, 4)
+
+
+class _SpooledFile:
+    """Stands in for SpooledTemporaryFile before Python 3.11, which has no
+    readable() and so can not be wrapped in a TextIOWrapper"""
+
+    def __init__(self, *args, **kwargs):
+        self.buffer = io.BytesIO()
+
+    def __getattr__(self, name):
+        if name in ("readable", "writable", "seekable", "readinto"):
+            raise AttributeError(name)
+        return getattr(self.buffer, name)
+
+
+def test_uploads_without_readable_are_imported(client, token, monkeypatch):
+    monkeypatch.setattr(
+        "werkzeug.formparser.SpooledTemporaryFile", _SpooledFile
+    )
+    response = _import(
+        client,
+        token,
+        data={"file": (io.BytesIO(CSV.encode()), "lavouras.csv")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 201
+
+
+def test_request_body_is_imported(client, token):
+    response = _import(client, token, data=CSV.encode())
+    assert response.status_code == 201
+    assert Lavoura.query.count() == 2
+
+
+def test_uploaded_file_is_imported_in_the_background(client, token):
+    response = _import(
+        client,
+        token,
+        query={"async": "1"},
+        data={"file": (io.BytesIO(CSV.encode()), "lavouras.csv")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["payload"]["id"]
+    jobs.run_job(jobs.claim_next())
+
+    job = Job.query.get(job_id)
+    assert job.status == Job.SUCCEEDED, job.error
+    assert jobs.job_payload(job)["result"]["inseridas"] == 2
+
+
+@pytest.mark.parametrize(
+    "data, message",
+    [
+        (None, "You must provide a CSV file"),
+        ("latitude,longitude,tipo\n-23,-51,\xe7\n".encode("latin-1"), "UTF-8"),
+        (b"lat,lon\n", "header"),
+    ],
+)
+def test_unreadable_uploads_are_a_400(client, token, data, message):
+    response = _import(client, token, data=data)
+    assert response.status_code == 400
+    assert message in response.get_json()["message"]
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_crops_of_other_transactions_are_not_taken_as_imported(app, captured):
+    table = Lavoura.__table__
+    other = db.engine.connect()
+    transaction = other.begin()
+    # Takes an id below the imported ones, but commits after them
+    other.execute(table.insert(), latitude=-1, longitude=-1, tipo="SOJA")
+
+    def commit_other(connection, cursor, statement, *args):
+        if (
+            statement.startswith("INSERT INTO lavoura")
+            and transaction.is_active
+        ):
+            transaction.commit()
+
+    event.listen(db.engine, "after_cursor_execute", commit_other)
+    try:
+        import_lavouras(io.StringIO(CSV))
+    finally:
+        event.remove(db.engine, "after_cursor_execute", commit_other)
+        other.close()
+
+    assert Lavoura.query.count() == 3
+    assert sorted(values["tipo"] for _, _, values in captured) == [
+        "MILHO",
+        "SOJA",
+    ]
+    assert -1 not in [values["latitude"] for _, _, values in captured]
@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from src.extensions.database import db
+from src.models import Perda, ProdutorRural
+
+
+def _produtor(cpf):
+    return {"nome": "Produtor", "email": "p@x", "cpf": cpf}
+
+
+def _stall(committer):
+    # A flusher that never runs, so writes stay queued
+    committer.flusher = threading.Thread()
+
+
+@pytest.mark.env(INGEST_GROUP_COMMIT=True, INGEST_MAX_DELAY_MS=200)
+def test_bad_row_only_fails_its_own_write(app, seed):
+    committer = app.extensions["group_committer"]
+    # Both arrive within the delay, so they are flushed together
+    good = committer.submit(ProdutorRural, _produtor("2" * 11), timeout=1)
+    duplicate = committer.submit(ProdutorRural, _produtor("1" * 11), 1)
+
+    assert good.result(timeout=5)
+    with pytest.raises(IntegrityError):
+        duplicate.result(timeout=5)
+    db.session.rollback()
+    assert sorted(produtor.cpf for produtor in ProdutorRural.query) == [
+        "1" * 11,
+        "2" * 11,
+    ]
+
+
+@pytest.mark.env(
+    INGEST_GROUP_COMMIT=True, INGEST_QUEUE_SIZE=1, INGEST_TIMEOUT=0.1
+)
+def test_full_queue_is_a_503(client, token):
+    committer = client.application.extensions["group_committer"]
+    _stall(committer)
+    committer.submit(ProdutorRural, _produtor("2" * 11), timeout=1)
+
+    response = client.post(
+        "/api/v1/produtores/",
+        json={"access_token": token, **_produtor("3" * 11)},
+    )
+    assert response.status_code == 503
+
+
+@pytest.mark.env(INGEST_GROUP_COMMIT=True, INGEST_TIMEOUT=0.1)
+def test_unconfirmed_write_is_not_committed_later(client, token, seed):
+    committer = client.application.extensions["group_committer"]
+    _stall(committer)
+    perda = {
+        "data": "2021-04-02",
+        "evento": 1,
+        "produtor_rural_id": seed["produtor"],
+        "lavoura_id": seed["lavoura"],
+    }
+    response = client.post(
+        "/api/v1/perdas/", json={"access_token": token, **perda}
+    )
+    assert response.status_code == 503
+
+    # A running flusher skips the write the client gave up on
+    committer.flusher = None
+    response = client.post(
+        "/api/v1/perdas/",
+        json={"access_token": token, **perda, "evento": 3},
+    )
+    assert response.status_code == 201
+    db.session.rollback()
+    assert sorted(perda.evento for perda in Perda.query) == [2, 3]
@@ -0,0 +1,210 @@
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import select
+
+from src.extensions import jobs
+from src.extensions.authentication import create_user, generate_token
+from src.extensions.database import db
+from src.models import Job, Perda, ProdutorPerdaResumo
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    """Registers handlers for the duration of a test only"""
+
+    def register(kind, func, max_attempts=1):
+        monkeypatch.setitem(jobs.HANDLERS, kind, (func, max_attempts))
+
+    return register
+
+
+def _heartbeat(job_id):
+    table = Job.__table__
+    with db.engine.connect() as connection:
+        return connection.execute(
+            select([table.c.heartbeat_at]).where(table.c.id == job_id)
+        ).scalar()
+
+
+@pytest.mark.env(JOBS_HEARTBEAT_INTERVAL=0.05)
+def test_heartbeat_is_refreshed_while_the_handler_runs(app, handlers):
+    beats = []
+
+    def slow(context):
+        # Never reports progress
+        beats.append(_heartbeat(context.job_id))
+        time.sleep(0.5)
+        beats.append(_heartbeat(context.job_id))
+
+    handlers("slow", slow)
+    job_id = jobs.enqueue("slow").id
+    jobs.run_job(jobs.claim_next())
+
+    assert Job.query.get(job_id).status == Job.SUCCEEDED
+    assert beats[1] > beats[0]
+
+
+def test_progress_is_saved_while_the_handler_runs(app, handlers):
+    def reporting(context):
+        context.progress(0.5)
+        return Job.query.get(context.job_id).progress
+
+    handlers("reporting", reporting)
+    job_id = jobs.enqueue("reporting").id
+    jobs.run_job(jobs.claim_next())
+
+    job = Job.query.get(job_id)
+    assert job.status == Job.SUCCEEDED, job.error
+    assert jobs.job_payload(job)["result"] == 0.5
+
+
+def test_only_the_owner_sees_a_job(client, token):
+    create_user("other", "secret")
+    other = generate_token("other", "secret")
+    response = client.get(
+        "/api/v1/perdas/export",
+        query_string={"access_token": token, "async": "1"},
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["payload"]["id"]
+    jobs.run_job(jobs.claim_next())
+
+    path = f"/api/v1/jobs/{job_id}"
+    for method, url in (
+        (client.get, path),
+        (client.get, f"{path}/result"),
+        (client.post, f"{path}/retry"),
+        (client.delete, path),
+    ):
+        response = method(url, query_string={"access_token": other})
+        assert response.status_code == 404, url
+
+    response = client.get(path, query_string={"access_token": token})
+    assert response.get_json()["payload"]["status"] == Job.SUCCEEDED
+    response = client.get(
+        f"{path}/result", query_string={"access_token": token}
+    )
+    assert response.status_code == 200
+
+
+def _lose_worker(job_id):
+    # The worker stopped sending heartbeats long ago
+    job = Job.query.get(job_id)
+    job.heartbeat_at = datetime.utcnow() - timedelta(hours=1)
+    db.session.commit()
+
+
+def test_running_job_is_not_claimed_again(app, handlers):
+    handlers("noop", lambda context: None)
+    job_id = jobs.enqueue("noop").id
+
+    assert jobs.claim_next() == job_id
+    assert jobs.claim_next() is None
+
+
+def test_stale_job_is_claimed_again(app, handlers):
+    handlers("noop", lambda context: None, max_attempts=2)
+    job_id = jobs.enqueue("noop").id
+    jobs.claim_next()
+    _lose_worker(job_id)
+
+    assert jobs.claim_next() == job_id
+    assert Job.query.get(job_id).attempts == 2
+
+
+def test_stale_job_without_attempts_left_fails(app, handlers):
+    handlers("noop", lambda context: None)
+    job_id = jobs.enqueue("noop").id
+    jobs.claim_next()
+    _lose_worker(job_id)
+
+    assert jobs.claim_next() is None
+    db.session.rollback()
+    job = Job.query.get(job_id)
+    assert (job.status, job.attempts) == (Job.FAILED, 1)
+    assert job.error
+
+
+def test_concurrent_workers_claim_a_job_once(app, handlers):
+    handlers("noop", lambda context: None)
+    job_id = jobs.enqueue("noop").id
+    barrier = threading.Barrier(4)
+    claimed = []
+
+    def work():
+        with app.app_context():
+            barrier.wait()
+            claimed.append(jobs.claim_next())
+
+    workers = [threading.Thread(target=work) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert sorted(claimed, key=bool) == [None, None, None, job_id]
+
+
+def test_cli_params_are_decoded(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        args=["jobs", "enqueue", "build_tiles", "-p", "max_zoom=2"]
+    )
+    assert result.exit_code == 0, result.output
+    job_id = jobs.claim_next()
+    jobs.run_job(job_id)
+
+    job = Job.query.get(job_id)
+    assert job.status == Job.SUCCEEDED, job.error
+    assert jobs.job_payload(job)["result"] is None
+
+
+def test_cli_params_that_are_not_json_stay_text(app):
+    runner = app.test_cli_runner()
+    result = runner.invoke(
+        args=["jobs", "enqueue", "delete_perdas", "-p", "inicio=2021-04-02"]
+    )
+    assert result.exit_code == 0, result.output
+    job = Job.query.get(int(result.output))
+    assert job.params == '{"inicio": "2021-04-02"}'
+
+
+def test_losses_are_deleted_in_the_background(app, seed):
+    for evento in (1, 3, 3):
+        db.session.add(
+            Perda(
+                data=date(2021, 4, 2),
+                evento=evento,
+                produtor_rural_id=seed["produtor"],
+                lavoura_id=seed["lavoura"],
+            )
+        )
+    db.session.commit()
+
+    job_id = jobs.enqueue("delete_perdas", {"evento": 3}).id
+    jobs.run_job(jobs.claim_next())
+
+    job = Job.query.get(job_id)
+    assert job.status == Job.SUCCEEDED, job.error
+    assert jobs.job_payload(job)["result"] == {"deleted": 2}
+    assert sorted(perda.evento for perda in Perda.query) == [1, 2]
+    assert ProdutorPerdaResumo.query.get(seed["produtor"]).perdas == 2
+
+
+def test_summaries_are_rebuilt_in_the_background(app, seed):
+    ProdutorPerdaResumo.query.delete()
+    db.session.commit()
+
+    job_id = jobs.enqueue("rebuild_summaries").id
+    jobs.run_job(jobs.claim_next())
+
+    job = Job.query.get(job_id)
+    assert job.status == Job.SUCCEEDED, job.error
+    assert jobs.job_payload(job)["result"] == {
+        "produtor_perda_resumo": 1,
+        "lavoura_perda_resumo": 1,
+    }
+    assert ProdutorPerdaResumo.query.get(seed["produtor"]).perdas == 1
@@ -0,0 +1,24 @@
+import pytest
+
+
+@pytest.mark.env(MEMORY_PROFILING=True, MEMORY_PROFILING_SAMPLE_RATE=1)
+def test_batch_profile_survives_its_sub_requests(client, token):
+    response = client.post(
+        "/api/v1/batch",
+        json={
+            "access_token": token,
+            "requests": [
+                {"method": "GET", "path": "/api/v1/produtores/"},
+                {"method": "GET", "path": "/api/v1/lavouras/"},
+            ],
+        },
+    )
+    assert response.status_code == 200
+
+    profile = client.application.extensions["memory_profiler"].report()
+    batch = profile["routes"]["POST /api/v1/batch"]
+    assert batch["requests"] == 1
+    assert batch["traced"] == 1
+    assert [record["route"] for record in profile["recent"]] == [
+        "POST /api/v1/batch"
+    ]
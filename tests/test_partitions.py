@@ -0,0 +1,142 @@
+import importlib.util
+import os
+from datetime import date
+from pathlib import Path
+
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from src.extensions.database import db
+from src.extensions.partitions import list_partitions
+from src.models import Perda
+
+# A scratch PostgreSQL database, its tables are dropped after each test
+POSTGRESQL_URI = os.environ.get("TEST_POSTGRESQL_URI", "")
+
+MIGRATION = (
+    Path(__file__).parent.parent
+    / "src/extensions/database/migrations/versions/9b2e4f6c1d38_.py"
+)
+
+
+@pytest.fixture
+def partitioned(seed):
+    """Partitions `perda` the way its migration does, from the seed loss
+    of 2021 to the year after the current one"""
+    spec = importlib.util.spec_from_file_location("migration", MIGRATION)
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    with Operations.context(
+        MigrationContext.configure(db.session.connection())
+    ):
+        migration._partition_perda()
+    db.session.commit()
+    yield range(2021, date.today().year + 2)
+    db.session.rollback()
+    # Detached partitions are standalone tables, unknown to drop_all
+    for (name,) in db.session.execute(
+        text("SELECT tablename FROM pg_tables WHERE tablename LIKE 'perda_%'")
+    ).fetchall():
+        db.session.execute(text(f"DROP TABLE {name}"))
+    db.session.execute(text("DROP FUNCTION perda_unique_id() CASCADE"))
+    db.session.commit()
+
+
+def _invoke(app, *args):
+    return app.test_cli_runner().invoke(args=["perda-partitions", *args])
+
+
+def _partition_of(perda_id):
+    return db.session.execute(
+        text("SELECT tableoid::regclass::text FROM perda WHERE id = :id"),
+        {"id": perda_id},
+    ).scalar()
+
+
+@pytest.mark.parametrize(
+    "args", [("list",), ("create", "--years", "2"), ("detach", "2021")]
+)
+def test_commands_need_postgresql(app, args):
+    result = _invoke(app, *args)
+    assert result.exit_code != 0
+    assert "Only PostgreSQL databases have perda partitions" in result.output
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_partitions_are_listed(app, partitioned):
+    result = _invoke(app, "list")
+    assert result.exit_code == 0, result.output
+    assert result.output.split() == [f"perda_y{year}" for year in partitioned]
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_missing_partitions_are_created(app, seed, partitioned):
+    year = partitioned[-1] + 1
+    perda = Perda(
+        data=date(year, 3, 1),
+        evento=2,
+        produtor_rural_id=seed["produtor"],
+        lavoura_id=seed["lavoura"],
+    )
+    db.session.add(perda)
+    db.session.commit()
+    perda_id = perda.id
+    assert _partition_of(perda_id) == "perda_default"
+
+    result = _invoke(app, "create", "--years", "2")
+    assert result.exit_code == 0, result.output
+    assert result.output.split("\n")[:-1] == [f"Created perda_y{year}"]
+    assert list_partitions() == [*partitioned, year]
+    # Its rows moved out of the default partition
+    assert _partition_of(perda_id) == f"perda_y{year}"
+
+    result = _invoke(app, "create", "--years", "2")
+    assert (result.exit_code, result.output) == (0, "")
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_detached_partitions_keep_their_rows(app, seed, partitioned):
+    result = _invoke(app, "detach", "2021")
+    assert result.exit_code == 0, result.output
+    assert list_partitions() == list(partitioned)[1:]
+    assert Perda.query.count() == 0
+    assert db.session.execute(
+        text("SELECT id FROM perda_y2021")
+    ).fetchall() == [(seed["perda"],)]
+
+    result = _invoke(app, "detach", "2021")
+    assert result.exit_code != 0
+    assert "There is no perda_y2021" in result.output
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_ids_stay_unique_across_partitions(app, seed, partitioned):
+    # Another year is another partition, so only the trigger refuses it
+    db.session.add(
+        Perda(
+            id=seed["perda"],
+            data=date(2022, 4, 1),
+            evento=2,
+            produtor_rural_id=seed["produtor"],
+            lavoura_id=seed["lavoura"],
+        )
+    )
+    with pytest.raises(IntegrityError, match="duplicate perda id"):
+        db.session.commit()
+    db.session.rollback()
+    assert Perda.query.count() == 1
@@ -0,0 +1,33 @@
+import pytest
+
+from src.models import Perda
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        {"evento": [2]},
+        {"evento": {"codigo": 2}},
+        {"evento": True},
+        {"evento": "2"},
+        {"produtor_rural_id": True},
+        {"lavoura_id": [1]},
+        {"lavoura_id": 1.0},
+    ],
+)
+def test_mistyped_fields_are_rejected(client, token, seed, fields):
+    response = client.post(
+        "/api/v1/perdas/",
+        json=dict(
+            {
+                "access_token": token,
+                "data": "2021-04-02",
+                "evento": 2,
+                "produtor_rural_id": seed["produtor"],
+                "lavoura_id": seed["lavoura"],
+            },
+            **fields,
+        ),
+    )
+    assert response.status_code == 400
+    assert Perda.query.count() == 1
@@ -0,0 +1,118 @@
+import pytest
+
+from src.extensions.profiler import HEADER
+
+
+def _profiled(client, token, profiling_token="secret"):
+    return client.get(
+        "/api/v1/produtores/",
+        query_string={"access_token": token},
+        headers={HEADER: profiling_token},
+    )
+
+
+def _profile(client, token, profile_id, **query):
+    return client.get(
+        f"/api/v1/debug/profiles/{profile_id}",
+        query_string={"access_token": token, **query},
+    )
+
+
+@pytest.mark.env(PROFILING_TOKEN="secret")
+def test_requests_with_the_header_are_profiled(client, token):
+    response = _profiled(client, token)
+    assert response.status_code == 200
+    profile_id = response.headers["X-Profile-Id"]
+
+    report = _profile(client, token, profile_id).get_json()["payload"]
+    assert (report["id"], report["route"], report["status"]) == (
+        profile_id,
+        "GET /api/v1/produtores/",
+        200,
+    )
+    assert report["top"]
+    assert set(report["top"][0]) == {
+        "function",
+        "calls",
+        "primitive_calls",
+        "tottime",
+        "cumtime",
+    }
+
+    response = _profile(client, token, profile_id, format="collapsed")
+    assert response.mimetype == "text/plain"
+    assert response.get_data(as_text=True) == report["collapsed"]
+
+
+@pytest.mark.env(PROFILING_TOKEN="secret")
+def test_requests_without_the_token_are_not_profiled(client, token):
+    assert "X-Profile-Id" not in _profiled(client, token, "wrong").headers
+    response = client.get(
+        "/api/v1/produtores/", query_string={"access_token": token}
+    )
+    assert "X-Profile-Id" not in response.headers
+
+
+@pytest.mark.env(PROFILING_TOKEN="secret", PROFILING_HISTORY=1)
+def test_only_the_last_profiles_are_kept(client, token):
+    first = _profiled(client, token).headers["X-Profile-Id"]
+    last = _profiled(client, token).headers["X-Profile-Id"]
+
+    assert _profile(client, token, first).status_code == 404
+    assert _profile(client, token, last).status_code == 200
+
+
+def test_profiling_is_disabled_without_a_token(client, token):
+    assert "X-Profile-Id" not in _profiled(client, token).headers
+    response = _profile(client, token, "0" * 32)
+    assert response.status_code == 404
+    assert response.get_json()["message"] == "CPU profiling is disabled"
+
+
+def test_route_command_profiles_the_replayed_requests(app, token, tmp_path):
+    path = tmp_path / "stacks.txt"
+    result = app.test_cli_runner().invoke(
+        args=[
+            "profile-route",
+            "GET",
+            "/api/v1/produtores/",
+            "--user",
+            "tester",
+            "--repeat",
+            "3",
+            "--warmup",
+            "1",
+            "--top",
+            "5",
+            "--collapsed",
+            str(path),
+        ]
+    )
+    assert result.exit_code == 0, result.output
+
+    lines = result.output.splitlines()
+    assert lines[0].startswith("GET /api/v1/produtores/: 3 requests in")
+    assert "statuses {200: 3}" in lines[0]
+    assert lines[1].split() == ["ncalls", "tottime", "cumtime", "function"]
+    assert len(lines) == 2 + 5
+    assert all(
+        line.rsplit(" ", 1)[1].isdigit()
+        for line in path.read_text().splitlines()
+    )
+
+
+def test_route_command_sends_the_body(app, token):
+    result = app.test_cli_runner().invoke(
+        args=[
+            "profile-route",
+            "POST",
+            "/api/v1/produtores/",
+            "--user",
+            "tester",
+            "--data",
+            '{"nome": "Produtor", "email": "p@x", "cpf": "11111111111"}',
+        ]
+    )
+    assert result.exit_code == 0, result.output
+    # Without the body, it would be a 400
+    assert "statuses {201: 1}" in result.output.splitlines()[0]
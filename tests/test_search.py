@@ -0,0 +1,46 @@
+from sqlalchemy import event
+
+from src.extensions.database import db
+from src.models import ProdutorRural
+
+
+def _index_produtores():
+    # Created by migration d5e8a1f04b6c, that the tests do not run
+    db.session.execute(
+        "CREATE VIRTUAL TABLE produtor_rural_fts USING fts5("
+        " nome, content='produtor_rural', content_rowid='id',"
+        " tokenize='unicode61 remove_diacritics 2')"
+    )
+    db.session.execute(
+        "INSERT INTO produtor_rural_fts (produtor_rural_fts)"
+        " VALUES ('rebuild')"
+    )
+    db.session.commit()
+
+
+def test_search_has_the_loss_summaries(client, token, seed):
+    db.session.add(ProdutorRural(nome="Produtora", email="q@x", cpf="2" * 11))
+    db.session.commit()
+    _index_produtores()
+    statements = []
+
+    def _record(connection, cursor, statement, *args):
+        if statement.lstrip().startswith("SELECT"):
+            statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", _record)
+    try:
+        response = client.get(
+            "/api/v1/produtores/",
+            query_string={"access_token": token, "q": "produt"},
+        )
+    finally:
+        event.remove(db.engine, "before_cursor_execute", _record)
+
+    assert response.status_code == 200
+    produtores = response.get_json()["payload"]["produtores"]
+    assert {
+        produtor["nome"]: produtor["perdas"] for produtor in produtores
+    } == {"Produtor": 1, "Produtora": 0}
+    # The ranked ids, then the producers with their summaries
+    assert len(statements) == 2
@@ -0,0 +1,74 @@
+import gzip
+import hashlib
+import sqlite3
+from urllib.parse import urlsplit
+
+from src.extensions import jobs
+from src.extensions.snapshot import build_snapshot
+from src.models import Job
+
+
+def _snapshot(client, token, **kwargs):
+    return client.get(
+        "/api/v1/snapshot", query_string={"access_token": token}, **kwargs
+    )
+
+
+def test_no_snapshot_is_a_404(client, token):
+    assert _snapshot(client, token).status_code == 404
+
+
+def test_snapshot_has_the_catalogue_and_its_cursor(
+    client, token, seed, tmp_path
+):
+    latest = build_snapshot()
+    response = _snapshot(client, token)
+    assert response.status_code == 200
+    assert response.headers["X-Snapshot-Version"] == latest["version"]
+    assert hashlib.sha256(response.data).hexdigest() == latest["sha256"]
+
+    path = tmp_path / "offline.sqlite"
+    path.write_bytes(gzip.decompress(response.data))
+    connection = sqlite3.connect(str(path))
+    try:
+        assert [
+            connection.execute(f"SELECT id FROM {table}").fetchall()
+            for table in ("produtor_rural", "lavoura", "perda")
+        ] == [[(seed["produtor"],)], [(seed["lavoura"],)], [(seed["perda"],)]]
+        assert connection.execute(
+            "SELECT version, cursor FROM snapshot"
+        ).fetchall() == [(latest["version"], latest["cursor"])]
+    finally:
+        connection.close()
+
+
+def test_snapshot_downloads_are_conditional_and_resumable(client, token, seed):
+    latest = build_snapshot()
+    response = _snapshot(
+        client, token, headers={"If-None-Match": f'"{latest["version"]}"'}
+    )
+    assert response.status_code == 304
+
+    whole = _snapshot(client, token).data
+    response = _snapshot(client, token, headers={"Range": "bytes=10-"})
+    assert response.status_code == 206
+    assert response.data == whole[10:]
+
+
+def test_snapshot_job_result_is_the_snapshot(client, token, seed):
+    job_id = jobs.enqueue("build_snapshot", owner="tester").id
+    jobs.run_job(jobs.claim_next())
+
+    job = Job.query.get(job_id)
+    assert job.status == Job.SUCCEEDED, job.error
+    result = jobs.job_payload(job)["result"]
+    assert "file" not in result
+
+    response = client.get(
+        f"/api/v1/jobs/{job_id}/result", query_string={"access_token": token}
+    )
+    assert response.status_code == 303
+    location = urlsplit(response.headers["Location"])
+    response = client.get(f"{location.path}?{location.query}")
+    assert response.status_code == 200
+    assert response.headers["X-Snapshot-Version"] == result["version"]
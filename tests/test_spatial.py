@@ -0,0 +1,146 @@
+import threading
+from datetime import date, datetime
+
+import pytest
+
+from src.extensions.changes import LOGGED
+from src.extensions.database import db
+from src.extensions.spatial import get_index
+from src.models import ChangeLog, Lavoura, Perda
+
+
+def _vizinhos(client, token, perda_id):
+    response = client.get(
+        f"/api/v1/perdas/{perda_id}/vizinhos",
+        query_string={"access_token": token, "raio": 50, "dias": 30},
+    )
+    assert response.status_code == 200
+    return response.get_json()["payload"]["lavouras"]
+
+
+def _insert_elsewhere(model, **values) -> int:
+    """Inserts a row the way another process would, unseen by the hooks
+    of this one, but in the change log"""
+    # Ends the read transaction of the test session, as a request would,
+    # or it would keep reading from before the insert
+    db.session.rollback()
+    with db.engine.begin() as connection:
+        row_id = connection.execute(
+            model.__table__.insert(), values
+        ).inserted_primary_key[0]
+        connection.execute(
+            ChangeLog.__table__.insert(),
+            entity=LOGGED[model],
+            entity_id=row_id,
+            operation=ChangeLog.INSERT,
+            created_at=datetime.utcnow(),
+        )
+    return row_id
+
+
+def test_catches_up_with_other_processes(app, client, seed, token):
+    assert _vizinhos(client, token, seed["perda"]) == []
+
+    lavoura_id = _insert_elsewhere(
+        Lavoura, latitude=-23.52, longitude=-51.22, tipo="MILHO"
+    )
+    perda_id = _insert_elsewhere(
+        Perda,
+        data=date(2021, 4, 10),
+        evento=3,
+        produtor_rural_id=seed["produtor"],
+        lavoura_id=lavoura_id,
+    )
+    # Not due yet
+    assert _vizinhos(client, token, seed["perda"]) == []
+
+    app.extensions["spatial_index"].refresh().join()
+    lavouras = _vizinhos(client, token, seed["perda"])
+    assert [lavoura["id"] for lavoura in lavouras] == [lavoura_id]
+    assert [perda["id"] for perda in lavouras[0]["perdas"]] == [perda_id]
+
+
+def test_catches_up_with_ids_committed_out_of_order(app, client, seed, token):
+    late_id = _insert_elsewhere(
+        Lavoura, id=100, latitude=-23.52, longitude=-51.22, tipo="MILHO"
+    )
+    index = app.extensions["spatial_index"]
+    index.refresh().join()
+    assert len(_vizinhos(client, token, seed["perda"])) == 1
+
+    # Took its id before the one above, but committed after it
+    early_id = _insert_elsewhere(
+        Lavoura, id=50, latitude=-23.51, longitude=-51.21, tipo="SOJA"
+    )
+    index.refresh().join()
+    assert [
+        lavoura["id"] for lavoura in _vizinhos(client, token, seed["perda"])
+    ] == [early_id, late_id]
+
+
+def test_rebuilds_to_catch_unlogged_changes(app, client, seed, token):
+    lavoura_id = _insert_elsewhere(
+        Lavoura, latitude=-23.52, longitude=-51.22, tipo="MILHO"
+    )
+    index = app.extensions["spatial_index"]
+    index.refresh().join()
+    assert len(_vizinhos(client, token, seed["perda"])) == 1
+
+    db.session.rollback()
+    with db.engine.begin() as connection:
+        connection.execute(
+            Lavoura.__table__.delete().where(Lavoura.id == lavoura_id)
+        )
+    index.refresh().join()
+    assert len(_vizinhos(client, token, seed["perda"])) == 1
+
+    index.refresh(rebuild=True).join()
+    assert _vizinhos(client, token, seed["perda"]) == []
+
+
+def test_queries_do_not_wait_for_a_rebuild(app, client, seed, token):
+    index = app.extensions["spatial_index"]
+    old = get_index()
+    building = threading.Event()
+    release = threading.Event()
+    build = index.build
+
+    def slow_build():
+        building.set()
+        release.wait(5)
+        return build()
+
+    index.build = slow_build
+    thread = index.refresh(rebuild=True)
+    try:
+        assert building.wait(5)
+        # Answered by the current index, with the crops committed meanwhile
+        db.session.add(Lavoura(latitude=-23.52, longitude=-51.22, tipo="SOJA"))
+        db.session.commit()
+        assert len(_vizinhos(client, token, seed["perda"])) == 1
+    finally:
+        release.set()
+        thread.join()
+    new = get_index()
+    assert new is not old
+    assert len(new.lavouras_within(-23.5, -51.2, 50)[0]) == 2
+
+
+@pytest.mark.env(SPATIAL_BUILD_ON_STARTUP=True)
+def test_builds_once_the_server_takes_requests(app, client, seed, token):
+    index = app.extensions["spatial_index"]
+    # Not for CLI commands or job workers, which never take requests
+    assert index.thread is None and not index.built
+
+    client.get("/api/v1/produtores/", query_string={"access_token": token})
+    index.thread.join()
+    assert index.built
+
+
+def test_build_waits_for_the_tables(app):
+    db.drop_all()
+    index = app.extensions["spatial_index"]
+    index.refresh().join()
+    assert not index.built
+    db.create_all()
+    assert get_index() is index.copy
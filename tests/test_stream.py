@@ -0,0 +1,121 @@
+import os
+import threading
+from datetime import date
+
+import pytest
+
+from src.extensions.database import db
+from src.models import Perda
+
+# A scratch PostgreSQL database, its tables are dropped after each test
+POSTGRESQL_URI = os.environ.get("TEST_POSTGRESQL_URI", "")
+
+
+def _perda(seed, evento=1):
+    return Perda(
+        data=date(2021, 4, 2),
+        evento=evento,
+        produtor_rural_id=seed["produtor"],
+        lavoura_id=seed["lavoura"],
+    )
+
+
+def _stream(client, token):
+    return client.get(
+        "/api/v1/perdas/stream",
+        query_string={"access_token": token},
+        buffered=False,
+    )
+
+
+@pytest.mark.env(PERDA_STREAM_MAX_CLIENTS=1)
+def test_streams_are_capped(client, token):
+    notifier = client.application.extensions["perda_notifier"]
+    first = _stream(client, token)
+    assert first.status_code == 200
+
+    second = _stream(client, token)
+    assert second.status_code == 503
+    assert second.headers["Retry-After"]
+
+    # Never read, but closing it frees its place
+    first.close()
+    assert not notifier.subscribers
+    third = _stream(client, token)
+    assert third.status_code == 200
+    third.close()
+
+
+def test_committed_losses_are_streamed(client, token, seed):
+    response = _stream(client, token)
+    events = iter(response.response)
+    assert next(events).startswith(b"retry:")
+
+    db.session.add(_perda(seed, evento=3))
+    db.session.commit()
+    event = next(events).decode()
+    response.close()
+
+    assert "event: insert\n" in event
+    assert '"evento": 3' in event
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_postgresql_delivers_changes_of_other_sessions(app, seed):
+    notifier = app.extensions["perda_notifier"]
+    subscriber = notifier.subscribe()
+    assert notifier.listening.wait(10)
+
+    def write():
+        # Another session, as in another process: only the NOTIFY,
+        # received through the LISTEN connection, reaches the subscriber
+        with app.app_context():
+            db.session.add(_perda(seed, evento=5))
+            db.session.flush()
+            db.session.rollback()
+            db.session.add(_perda(seed, evento=6))
+            db.session.commit()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    writer.join()
+
+    change = subscriber.get(timeout=10)
+    assert (change["operation"], change["evento"]) == ("insert", 6)
+    assert subscriber.empty()
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_postgresql_notifies_only_committed_changes(app, seed):
+    notifier = app.extensions["perda_notifier"]
+    subscriber = notifier.subscribe()
+    assert notifier.listening.wait(10)
+
+    def write():
+        with app.app_context():
+            perda = Perda.query.get(seed["perda"])
+            # Flushed, but nothing changed
+            perda.evento = perda.evento
+            db.session.flush()
+            db.session.begin_nested()
+            db.session.add(_perda(seed, evento=5))
+            db.session.flush()
+            db.session.rollback()
+            db.session.commit()
+
+            perda.evento = 4
+            db.session.commit()
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    writer.join()
+
+    change = subscriber.get(timeout=10)
+    assert (change["operation"], change["evento"]) == ("update", 4)
+    assert subscriber.empty()
@@ -0,0 +1,210 @@
+import os
+import threading
+from datetime import date
+
+import numpy as np
+import pytest
+from sqlalchemy import event
+
+from src.extensions.database import db
+from src.extensions.tiles import (
+    build_tile,
+    cached_tile,
+    get_tile,
+    point_tiles,
+)
+from src.models import Lavoura, Perda, ProdutorRural
+
+# A scratch PostgreSQL database, its tables are dropped after each test
+POSTGRESQL_URI = os.environ.get("TEST_POSTGRESQL_URI", "")
+
+ZOOMS = (0, 4, 10)
+
+
+def _tile(lavoura: Lavoura, z: int) -> tuple:
+    x, y = point_tiles([lavoura.latitude], [lavoura.longitude], z)
+    return z, int(x[0]), int(y[0])
+
+
+def _cached(z: int, x: int, y: int) -> list:
+    return cached_tile(z, x, y)
+
+
+def _assert_fresh(tiles):
+    """Checks the cached tiles against tiles built from scratch"""
+    for tile in tiles:
+        cached = _cached(*tile)
+        built = build_tile(*tile)
+        assert len(cached) == len(built)
+        for cached_cluster, built_cluster in zip(cached, built):
+            for axis in ("latitude", "longitude"):
+                assert cached_cluster.pop(axis) == pytest.approx(
+                    built_cluster.pop(axis)
+                )
+            assert cached_cluster == built_cluster
+
+
+@pytest.fixture
+def lavoura(app, seed):
+    lavoura = Lavoura.query.get(seed["lavoura"])
+    for z in ZOOMS:
+        get_tile(*_tile(lavoura, z))
+    return lavoura
+
+
+def _perda(seed, lavoura_id=None, evento=3):
+    return Perda(
+        data=date(2021, 4, 2),
+        evento=evento,
+        produtor_rural_id=seed["produtor"],
+        lavoura_id=lavoura_id or seed["lavoura"],
+    )
+
+
+def test_cached_tiles_follow_inserts_and_deletes(seed, lavoura):
+    tiles = [_tile(lavoura, z) for z in ZOOMS]
+    neighbour = Lavoura(latitude=-23.51, longitude=-51.21, tipo="MILHO")
+    db.session.add(neighbour)
+    db.session.flush()
+    perda = _perda(seed, lavoura_id=neighbour.id)
+    db.session.add(perda)
+    db.session.commit()
+    _assert_fresh(tiles)
+    assert _cached(*tiles[0])[0]["lavouras"] == 2
+
+    db.session.delete(perda)
+    db.session.delete(neighbour)
+    db.session.commit()
+    _assert_fresh(tiles)
+    assert _cached(*tiles[0])[0]["lavouras"] == 1
+
+
+def test_cached_tiles_follow_updates(seed, lavoura):
+    tiles = [_tile(lavoura, z) for z in ZOOMS]
+    perda = Perda.query.get(seed["perda"])
+    perda.evento = 5
+    lavoura.tipo = "CAFE"
+    db.session.commit()
+    _assert_fresh(tiles)
+    assert _cached(*tiles[0])[0]["tipo"] == "CAFE"
+
+
+def test_moved_crop_rebuilds_its_tiles(seed, lavoura):
+    old_tiles = [_tile(lavoura, z) for z in ZOOMS]
+    lavoura.latitude, lavoura.longitude = 10.0, 20.0
+    db.session.commit()
+    new_tiles = [_tile(lavoura, z) for z in ZOOMS]
+    for tile in old_tiles[1:]:
+        assert _cached(*tile) is None
+    for tile in old_tiles + new_tiles:
+        assert get_tile(*tile) == build_tile(*tile)
+
+
+def test_rolled_back_change_leaves_the_cache(seed, lavoura):
+    tiles = [_tile(lavoura, z) for z in ZOOMS]
+    before = [_cached(*tile) for tile in tiles]
+    db.session.add(_perda(seed))
+    db.session.flush()
+    db.session.rollback()
+    assert [_cached(*tile) for tile in tiles] == before
+
+
+def test_loss_writes_one_tile_update(client, seed, lavoura, token):
+    statements = []
+
+    def _record(connection, cursor, statement, *args):
+        if "tile_" in statement:
+            statements.append(statement.split()[0])
+
+    engine = db.engine
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        response = client.post(
+            "/api/v1/perdas/",
+            json={
+                "access_token": token,
+                "data": "2021-04-03",
+                "evento": 1,
+                "produtor_rural_id": seed["produtor"],
+                "lavoura_id": seed["lavoura"],
+            },
+        )
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+    assert response.status_code == 201
+    # One atomic addition per counter, nothing read or locked first
+    assert statements == ["INSERT"]
+    _assert_fresh([_tile(lavoura, z) for z in ZOOMS])
+
+
+def test_large_changes_invalidate_instead(app, seed, lavoura):
+    app.config["TILE_INVALIDATION_MAX_KEYS"] = 2
+    far_tile = _tile(lavoura, 10)
+    db.session.add_all(
+        Lavoura(latitude=float(latitude), longitude=-50.0, tipo="SOJA")
+        for latitude in np.linspace(-30, -10, 20)
+    )
+    db.session.commit()
+    assert _cached(0, 0, 0) is None
+    # Outside the bounding box of the new crops
+    assert _cached(*far_tile) is not None
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI)
+def test_writers_of_other_counters_do_not_wait(app, seed, lavoura):
+    flushed = threading.Event()
+    done = threading.Event()
+    errors = []
+
+    def other_writer():
+        # Adds a crop, with a loss, to the same cells, and does not commit
+        # until the test one has. Its producer and crop are its own, so
+        # only the tiles could make the two wait for each other
+        with app.app_context():
+            try:
+                produtor = ProdutorRural(
+                    nome="Outro", email="o@x", cpf="2" * 11
+                )
+                neighbour = Lavoura(
+                    latitude=-23.51, longitude=-51.21, tipo="MILHO"
+                )
+                db.session.add_all((produtor, neighbour))
+                db.session.flush()
+                db.session.add(
+                    Perda(
+                        data=date(2021, 4, 2),
+                        evento=1,
+                        produtor_rural_id=produtor.id,
+                        lavoura_id=neighbour.id,
+                    )
+                )
+                db.session.flush()
+                flushed.set()
+                done.wait(10)
+                db.session.commit()
+            except Exception as e:
+                errors.append(e)
+                flushed.set()
+
+    thread = threading.Thread(target=other_writer)
+    thread.start()
+    try:
+        assert flushed.wait(10)
+        db.session.execute("SET lock_timeout = '2s'")
+        db.session.add(_perda(seed, evento=3))
+        db.session.commit()
+    finally:
+        done.set()
+        thread.join()
+    assert not errors
+
+    tiles = [_tile(lavoura, z) for z in ZOOMS]
+    _assert_fresh(tiles)
+    assert _cached(*tiles[0])[0]["perdas"] == {
+        "CHUVA EXCESSIVA": 1,
+        "GEADA": 1,
+        "GRANIZO": 1,
+    }
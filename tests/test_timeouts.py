@@ -0,0 +1,98 @@
+import json
+import os
+import time
+from datetime import date
+
+import pytest
+from sqlalchemy import event
+
+from src.extensions.database import db
+from src.models import Perda
+
+# A scratch PostgreSQL database, its tables are dropped after each test
+POSTGRESQL_URI = os.environ.get("TEST_POSTGRESQL_URI", "")
+
+
+@pytest.mark.env(
+    EXPORT_BATCH_SIZE=100,
+    STATEMENT_TIMEOUTS=json.dumps({"GET /api/v1/perdas/export": 100}),
+)
+def test_streamed_export_outlives_the_budget(client, token, seed):
+    values = [
+        {
+            "data": date(2021, 4, 2),
+            "evento": 1,
+            "produtor_rural_id": seed["produtor"],
+            "lavoura_id": seed["lavoura"],
+        }
+        for _ in range(2000)
+    ]
+    db.session.execute(Perda.__table__.insert(), values)
+    db.session.commit()
+
+    response = client.get(
+        "/api/v1/perdas/export",
+        query_string={"access_token": token},
+        buffered=False,
+    )
+    chunks = []
+    for chunk in response.response:
+        chunks.append(chunk)
+        # A slow client, the download lasts well past the budget
+        time.sleep(0.01)
+    response.close()
+
+    lines = "".join(
+        chunk.decode() if isinstance(chunk, bytes) else chunk
+        for chunk in chunks
+    ).splitlines()
+    # The header and every loss
+    assert len(lines) == 2002
+
+
+@pytest.mark.skipif(
+    not POSTGRESQL_URI, reason="TEST_POSTGRESQL_URI is not set"
+)
+@pytest.mark.env(
+    SQLALCHEMY_DATABASE_URI=POSTGRESQL_URI,
+    STATEMENT_TIMEOUTS=json.dumps(
+        {
+            "POST /api/v1/batch": 9000,
+            "GET /api/v1/produtores/": 5000,
+            "GET /api/v1/lavouras/": 7000,
+        }
+    ),
+)
+def test_sub_requests_of_a_transaction_get_their_own_budget(
+    client, token, seed
+):
+    budgets = []
+
+    def record(connection, cursor, statement, *args):
+        if statement.startswith("SET LOCAL statement_timeout"):
+            budgets.append(statement.rsplit(" ", 1)[-1])
+        elif "FROM produtor_rural" in statement:
+            budgets.append("produtores")
+        elif "FROM lavoura" in statement:
+            budgets.append("lavouras")
+
+    event.listen(db.engine, "before_cursor_execute", record)
+    try:
+        response = client.post(
+            "/api/v1/batch",
+            json={
+                "access_token": token,
+                "requests": [
+                    {"method": "GET", "path": "/api/v1/produtores/"},
+                    {"method": "GET", "path": "/api/v1/lavouras/"},
+                ],
+            },
+        )
+    finally:
+        event.remove(db.engine, "before_cursor_execute", record)
+
+    assert response.status_code == 200
+    # Neither GET ends the transaction, so the second one reads in the
+    # transaction the first one began, with the budget set before it
+    assert budgets[budgets.index("produtores") - 1] == "5000"
+    assert budgets[budgets.index("lavouras") - 1] == "7000"